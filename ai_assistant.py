@@ -3,6 +3,7 @@ import json
 import aiohttp
 import asyncio
 import logging
+from collections.abc import Mapping
 from ai_fallback import LocalAI
 
 logger = logging.getLogger(__name__)
@@ -182,8 +183,8 @@ Per utilizzare queste funzioni, seleziona uno dei comandi dal menu del bot.
             A string with suggestions
         """
         # Ensure we have a list of strings for proper formatting
-        if items and isinstance(items, list):
-            if isinstance(items[0], dict) and "name" in items[0]:
+        if items and isinstance(items, (list, tuple)):
+            if isinstance(items[0], Mapping) and "name" in items[0]:
                 # Format items with quantities for better context
                 formatted_items = [f"{item['name']} ({item['quantity']})" for item in items]
             else:
@@ -212,8 +213,8 @@ Per utilizzare queste funzioni, seleziona uno dei comandi dal menu del bot.
             A string with categorized items
         """
         # Ensure we have a list of strings for proper formatting
-        if items and isinstance(items, list):
-            if isinstance(items[0], dict) and "name" in items[0]:
+        if items and isinstance(items, (list, tuple)):
+            if isinstance(items[0], Mapping) and "name" in items[0]:
                 # Format items with quantities for better context
                 formatted_items = [f"{item['name']} ({item['quantity']})" for item in items]
             else:
@@ -243,8 +244,8 @@ Per utilizzare queste funzioni, seleziona uno dei comandi dal menu del bot.
             A string with the answer
         """
         # Ensure we have a list of strings for proper formatting
-        if items and isinstance(items, list):
-            if isinstance(items[0], dict) and "name" in items[0]:
+        if items and isinstance(items, (list, tuple)):
+            if isinstance(items[0], Mapping) and "name" in items[0]:
                 # Format items with quantities for better context
                 formatted_items = [f"{item['name']} ({item['quantity']})" for item in items]
             else:
@@ -273,8 +274,8 @@ Per utilizzare queste funzioni, seleziona uno dei comandi dal menu del bot.
             A string with the meal plan
         """
         # Ensure we have a list of strings for proper formatting
-        if items and isinstance(items, list):
-            if isinstance(items[0], dict) and "name" in items[0]:
+        if items and isinstance(items, (list, tuple)):
+            if isinstance(items[0], Mapping) and "name" in items[0]:
                 # Format items with quantities for better context
                 formatted_items = [f"{item['name']} ({item['quantity']})" for item in items]
             else:
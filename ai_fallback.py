@@ -5,6 +5,8 @@ senza dipendere da API esterne come OpenAI.
 """
 
 import random
+from collections.abc import Mapping
+from categorizer import Categorizer
 
 class LocalAI:
     """Una semplice classe che fornisce risposte AI generate localmente."""
@@ -139,6 +141,9 @@ class LocalAI:
                           "patatine surgelate", "bastoncini", "fruttifera"]
             }
         ]
+        # Le categorie compilate una volta sola, con i risultati nella cache condivisa
+        self.categorizer = Categorizer({category["name"]: category["items"] for category in self.categories})
+        self.category_emojis = {category["name"]: category["emoji"] for category in self.categories}
         
         self.meal_plan_templates = [
             """📅 Piano dei pasti per 3 giorni:
@@ -244,8 +249,8 @@ Suggerimento: bevi almeno 1,5 litri di acqua al giorno! 💧"""
         """
         # Estrai solo i nomi degli articoli se vengono forniti come dizionari
         item_names = []
-        if items and isinstance(items, list):
-            if isinstance(items[0], dict) and "name" in items[0]:
+        if items and isinstance(items, (list, tuple)):
+            if isinstance(items[0], Mapping) and "name" in items[0]:
                 item_names = [item["name"].lower() for item in items]
             else:
                 item_names = [str(item).lower() for item in items]
@@ -253,31 +258,16 @@ Suggerimento: bevi almeno 1,5 litri di acqua al giorno! 💧"""
         # Dizionario per tenere traccia degli articoli assegnati ad ogni categoria
         categorized = {}
         
-        # Prova a categorizzare gli articoli in base alla corrispondenza con le categorie predefinite
+        # Prova a categorizzare gli articoli in base alla corrispondenza con le categorie predefinite,
+        # altrimenti mettiamoli in "Altro"
         for item_name in item_names:
-            assigned = False
-            for category in self.categories:
-                for category_item in category["items"]:
-                    if category_item in item_name or item_name in category_item:
-                        if category["name"] not in categorized:
-                            categorized[category["name"]] = {
-                                "emoji": category["emoji"],
-                                "items": []
-                            }
-                        categorized[category["name"]]["items"].append(item_name)
-                        assigned = True
-                        break
-                if assigned:
-                    break
-            
-            # Se l'articolo non è stato assegnato, mettiamolo in "Altro"
-            if not assigned:
-                if "Altro" not in categorized:
-                    categorized["Altro"] = {
-                        "emoji": "📦",
-                        "items": []
-                    }
-                categorized["Altro"]["items"].append(item_name)
+            category_name = self.categorizer.categorize(item_name)
+            if category_name not in categorized:
+                categorized[category_name] = {
+                    "emoji": self.category_emojis.get(category_name, "📦"),
+                    "items": []
+                }
+            categorized[category_name]["items"].append(item_name)
         
         # Generiamo il testo della risposta
         response = ""
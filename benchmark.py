@@ -0,0 +1,939 @@
+#!/usr/bin/env python3
+"""
+Benchmark script for the shopping list storage and data structures.
+
+Usage: python benchmark.py [nome_benchmark ...]
+Without arguments every benchmark is run.
+"""
+
+import os
+import sys
+import time
+import asyncio
+import random
+import tempfile
+import threading
+import tracemalloc
+import multiprocessing
+
+from storage import Storage, WALStorage, ShardedStorage, SQLiteStorage
+from tests.bot_api import fake_bot_api, recorded_update
+
+SAMPLE_ITEMS = [
+    ("pane", "Pane e Cereali"), ("latte", "Latticini"), ("mele", "Frutta e Verdura"),
+    ("pasta", "Pane e Cereali"), ("pollo", "Carne e Pesce"), ("acqua", "Bevande"),
+    ("olio", "Condimenti"), ("gelato", "Surgelati"), ("ceci", "Legumi e Frutta secca"),
+    ("biscotti", "Snack e Dolci"), ("detersivo", "Prodotti per la Casa"), ("tv", "Altro"),
+]
+
+def make_dataset(num_lists, items_per_list=8, seed=42):
+    """
+    Build a synthetic dataset with a realistic mix of users and groups.
+
+    Args:
+        num_lists: Number of lists to generate
+        items_per_list: Average number of items per list
+        seed: Seed for the random generator
+
+    Returns:
+        A dict in the same format used by ShoppingList.lists
+    """
+    rng = random.Random(seed)
+    data = {}
+    for i in range(num_lists):
+        list_id = f"group_{1000000 + i}" if i % 5 == 0 else f"user_{1000000 + i}"
+        count = max(0, int(rng.gauss(items_per_list, items_per_list / 2)))
+        items = []
+        for _ in range(count):
+            name, category = rng.choice(SAMPLE_ITEMS)
+            quantity = rng.choice(["1", "1", "1", "2 pz", "500 g", "1,5 kg", "2 l"])
+            items.append({"name": name, "quantity": quantity, "category": category})
+        data[list_id] = items
+    return data
+
+def time_mutations(storage, data, mutations=200):
+    """
+    Measure the average cost of persisting a single changed list.
+
+    Returns:
+        Average milliseconds per mutation
+    """
+    list_ids = list(data.keys())
+    rng = random.Random(1)
+    start = time.perf_counter()
+    for _ in range(mutations):
+        list_id = rng.choice(list_ids)
+        data[list_id].append({"name": "pane", "quantity": "1", "category": "Pane e Cereali"})
+        storage.save_list(list_id, data[list_id], ("append", len(data[list_id]) - 1))
+    return (time.perf_counter() - start) * 1000 / mutations
+
+def bench_mutations():
+    """Per-mutation write cost of the storage backends as the dataset grows."""
+    backends = [
+        ("json", lambda tmp: Storage(os.path.join(tmp, "shopping_lists.json"))),
+        ("wal", lambda tmp: WALStorage(os.path.join(tmp, "shopping_lists.json"))),
+        ("sharded", lambda tmp: ShardedStorage(os.path.join(tmp, "shopping_lists"))),
+    ]
+    print("\n== Costo per mutazione (ms) ==")
+    print(f"{'liste':>8}" + "".join(f"{name:>10}" for name, _ in backends))
+    for num_lists in (100, 1000, 10000, 50000):
+        results = []
+        for name, factory in backends:
+            with tempfile.TemporaryDirectory() as tmp:
+                data = make_dataset(num_lists)
+                storage = factory(tmp)
+                storage.save(data)
+                # Few mutations on the slow path keep the run short
+                mutations = 20 if name == "json" and num_lists > 1000 else 500
+                results.append(time_mutations(storage, data, mutations))
+                storage.close()
+        print(f"{num_lists:>8}" + "".join(f"{r:>10.3f}" for r in results))
+
+def bench_sqlite():
+    """JSON and SQLite backends: load time and per-mutation cost at 1k, 10k and 100k lists."""
+    backends = [
+        ("json", lambda tmp: Storage(os.path.join(tmp, "shopping_lists.json"))),
+        ("sqlite", lambda tmp: SQLiteStorage(os.path.join(tmp, "shopping_lists.db"))),
+    ]
+    print("\n== JSON vs SQLite ==")
+    print(f"{'liste':>8} {'backend':>8} {'load ms':>10} {'mut ms':>10}")
+    for num_lists in (1000, 10000, 100000):
+        for name, factory in backends:
+            with tempfile.TemporaryDirectory() as tmp:
+                data = make_dataset(num_lists)
+                storage = factory(tmp)
+                storage.save(data)
+                storage.close()
+                storage = factory(tmp)
+                start = time.perf_counter()
+                data = storage.load()
+                load_ms = (time.perf_counter() - start) * 1000
+                mutations = max(5, 20000 // num_lists) if name == "json" else 2000
+                mutation_ms = time_mutations(storage, data, mutations)
+                storage.close()
+            print(f"{num_lists:>8} {name:>8} {load_ms:>10.1f} {mutation_ms:>10.3f}")
+
+def bench_write_behind():
+    """Disk writes and time for a burst of mutations on one group list, with and without write-behind."""
+    from shopping_list import ShoppingList
+    print("\n== Write-behind: 2000 aggiunte sulla stessa lista ==")
+    print(f"{'intervallo s':>12} {'scritture':>10} {'tempo s':>10}")
+    for interval in (0, 0.05, 0.5):
+        with tempfile.TemporaryDirectory() as tmp:
+            cwd = os.getcwd()
+            os.chdir(tmp)
+            try:
+                shopping_list = ShoppingList(flush_interval=interval, flush_max_pending=10000)
+                writes = []
+                # The JSON backend writes the file only through _write()
+                write = shopping_list.storage._write
+                shopping_list.storage._write = lambda *args: writes.append(1) or write(*args)
+                start = time.perf_counter()
+                for i in range(2000):
+                    shopping_list.add_item(-1001, f"articolo {i % 50}", 1)
+                shopping_list.close()
+                elapsed = time.perf_counter() - start
+            finally:
+                os.chdir(cwd)
+        print(f"{interval:>12} {len(writes):>10} {elapsed:>10.3f}")
+
+def bench_snapshot():
+    """Save/load throughput and file size of the JSON and binary snapshot formats."""
+    formats = [
+        ("json", {}),
+        ("binary", {"snapshot_format": "binary"}),
+        ("binary+zlib", {"snapshot_format": "binary", "compress": True}),
+    ]
+    print("\n== Formato dello snapshot ==")
+    print(f"{'liste':>8} {'formato':>12} {'MB':>8} {'save ms':>10} {'load ms':>10} {'liste/s':>10}")
+    for num_lists in (1000, 10000, 100000):
+        data = make_dataset(num_lists)
+        for name, options in formats:
+            with tempfile.TemporaryDirectory() as tmp:
+                storage = Storage(os.path.join(tmp, "shopping_lists"), **options)
+                start = time.perf_counter()
+                storage.save(data)
+                save_ms = (time.perf_counter() - start) * 1000
+                size = os.path.getsize(storage.filename) / 1e6
+                storage = Storage(storage.filename, **options)
+                start = time.perf_counter()
+                loaded = storage.load()
+                load_ms = (time.perf_counter() - start) * 1000
+                assert loaded == data
+            print(f"{num_lists:>8} {name:>12} {size:>8.2f} {save_ms:>10.1f} {load_ms:>10.1f} "
+                  f"{num_lists * 1000 / load_ms:>10.0f}")
+
+def bench_add_items(num_items=10000):
+    """Time to fill a single list, then to add every item again as a duplicate."""
+    from shopping_list import ShoppingList
+    print(f"\n== {num_items} aggiunte sulla stessa lista ==")
+    with tempfile.TemporaryDirectory() as tmp:
+        cwd = os.getcwd()
+        os.chdir(tmp)
+        try:
+            # Keep the disk out of the measure: a single write at the end. No
+            # item limit, to measure the copy of a list longer than the default one.
+            shopping_list = ShoppingList(flush_interval=3600, flush_max_pending=10 ** 9, max_items=0)
+            start = time.perf_counter()
+            for i in range(num_items):
+                shopping_list.add_item(-1001, f"articolo {i}")
+            fill = time.perf_counter() - start
+            start = time.perf_counter()
+            for i in range(num_items):
+                shopping_list.add_item(-1001, f"2 articolo {i}")
+            duplicates = time.perf_counter() - start
+            shopping_list.close()
+        finally:
+            os.chdir(cwd)
+    print(f"nuovi: {fill:.2f} s ({fill * 1e6 / num_items:.0f} us/articolo), "
+          f"duplicati: {duplicates:.2f} s ({duplicates * 1e6 / num_items:.0f} us/articolo)")
+
+def bench_remove_items(num_items=2000):
+    """Removing half of a list one item at a time and with a single remove_items call."""
+    from shopping_list import ShoppingList
+    print(f"\n== rimozione di {num_items // 2} articoli su {num_items} ==")
+    results = {}
+    for mode in ("remove_item", "remove_items"):
+        with tempfile.TemporaryDirectory() as tmp:
+            cwd = os.getcwd()
+            os.chdir(tmp)
+            try:
+                shopping_list = ShoppingList(flush_interval=0, max_items=0)
+                shopping_list.add_items(-1001, [f"articolo {i}" for i in range(num_items)])
+                items = shopping_list.get_items(-1001)
+                numbers = range(1, num_items + 1, 2)
+                start = time.perf_counter()
+                if mode == "remove_item":
+                    # Back to front, so the remaining indices stay valid
+                    for number in reversed(numbers):
+                        shopping_list.remove_item(-1001, number - 1)
+                else:
+                    shopping_list.remove_items(-1001, [items[number - 1].id for number in numbers])
+                results[mode] = time.perf_counter() - start
+                assert len(shopping_list.get_items(-1001)) == num_items - len(numbers)
+                shopping_list.close()
+            finally:
+                os.chdir(cwd)
+    print(f"remove_item: {results['remove_item']:.2f} s, remove_items: {results['remove_items'] * 1000:.1f} ms")
+
+def bench_snapshot_reads(readers=4, seconds=2.0, num_items=200):
+    """Reader threads walking a group list while a writer keeps changing it: every read must be consistent."""
+    from shopping_list import ShoppingList
+    print(f"\n== {readers} thread lettori e 1 scrittore su una lista di {num_items} articoli ==")
+    with tempfile.TemporaryDirectory() as tmp:
+        cwd = os.getcwd()
+        os.chdir(tmp)
+        try:
+            shopping_list = ShoppingList(flush_interval=3600, flush_max_pending=10 ** 9)
+            shopping_list.add_items(-1001, [f"articolo {i}" for i in range(num_items)])
+            stop = threading.Event()
+            reads = [0] * readers
+            inconsistent = [0] * readers
+            writes = 0
+
+            def read(reader):
+                while not stop.is_set():
+                    items = shopping_list.get_items(-1001)
+                    # A snapshot never changes: same length, same items, version only grows
+                    names = [item["name"] for item in items]
+                    if len(names) != len(items) or names != [item.name for item in items]:
+                        inconsistent[reader] += 1
+                    reads[reader] += 1
+
+            threads = [threading.Thread(target=read, args=(reader,)) for reader in range(readers)]
+            for thread in threads:
+                thread.start()
+            deadline = time.perf_counter() + seconds
+            while time.perf_counter() < deadline:
+                items = shopping_list.get_items(-1001)
+                shopping_list.remove_items(-1001, [items[writes % len(items)].id])
+                shopping_list.add_item(-1001, f"articolo {writes}")
+                shopping_list.update_quantity(-1001, writes % num_items, str(writes % 5 + 1))
+                writes += 3
+            stop.set()
+            for thread in threads:
+                thread.join()
+            shopping_list.close()
+        finally:
+            os.chdir(cwd)
+    print(f"letture/s: {sum(reads) / seconds:.0f}, scritture/s: {writes / seconds:.0f}, "
+          f"letture incoerenti: {sum(inconsistent)}")
+    return sum(inconsistent)
+
+def bench_concurrent_updates(chats=40, updates_per_chat=5, rate=100, concurrency=64,
+                             send_latency=0.05, ai_latency=0.5):
+    """Simulated chats: updates processed one at a time, as before, and concurrently with per-list locks."""
+    from shopping_list import ShoppingList
+    from list_locks import ListLocks
+    print(f"\n== {chats} chat, {updates_per_chat} update ciascuna, {rate} update/s "
+          f"(una chat su 10 chiede prima /pasti, {ai_latency} s) ==")
+    # Even chats send their updates in a burst, like group members editing the
+    # list together, odd chats spread them over the run
+    bursts = [(-(1000 + chat), number) for chat in range(0, chats, 2) for number in range(updates_per_chat)]
+    spread = [(-(1000 + chat), number) for number in range(updates_per_chat) for chat in range(1, chats, 2)]
+    updates = [update for pair in zip(bursts, spread) for update in pair]
+
+    def is_slow(chat_id, number):
+        return number == 0 and chat_id % 10 == 0
+
+    async def run(shopping_list, concurrent):
+        loop = asyncio.get_running_loop()
+        locks = ListLocks()
+        # Only one update at a time without concurrent processing
+        semaphore = asyncio.Semaphore(concurrency if concurrent else 1)
+        holders = {}
+        latencies = []
+        overlaps = 0
+
+        async def process(chat_id, number, arrival):
+            nonlocal overlaps
+            async with semaphore:
+                if is_slow(chat_id, number):
+                    # The AI call doesn't change the list and holds no lock
+                    await asyncio.sleep(ai_latency)
+                    return
+                list_id = shopping_list.get_list_id(chat_id)
+                async with locks.hold(list_id):
+                    holders[list_id] = holders.get(list_id, 0) + 1
+                    overlaps += holders[list_id] > 1
+                    shopping_list.add_item(chat_id, f"articolo {number}")
+                    holders[list_id] -= 1
+                # The reply, sent without holding the lock
+                await asyncio.sleep(send_latency)
+            latencies.append(loop.time() - arrival)
+
+        start = loop.time()
+        tasks = []
+        for position, (chat_id, number) in enumerate(updates):
+            arrival = start + position / rate
+            await asyncio.sleep(max(0.0, arrival - loop.time()))
+            tasks.append(asyncio.create_task(process(chat_id, number, arrival)))
+        await asyncio.gather(*tasks)
+        return loop.time() - start, sorted(latencies), overlaps, locks.stats()
+
+    print(f"{'modalità':>12} {'tempo s':>8} {'update/s':>9} {'p50 ms':>8} {'p95 ms':>8} "
+          f"{'sovrapposte':>11} {'fuori ordine':>12}")
+    for concurrent in (False, True):
+        with tempfile.TemporaryDirectory() as tmp:
+            cwd = os.getcwd()
+            os.chdir(tmp)
+            try:
+                shopping_list = ShoppingList(flush_interval=0.05)
+                elapsed, latencies, overlaps, stats = asyncio.run(run(shopping_list, concurrent))
+                # Every list must hold its items in the order the updates arrived
+                out_of_order = 0
+                for chat in range(chats):
+                    chat_id = -(1000 + chat)
+                    expected = [f"articolo {number}" for number in range(updates_per_chat)
+                                if not is_slow(chat_id, number)]
+                    out_of_order += shopping_list.get_item_names(chat_id) != expected
+                shopping_list.close()
+            finally:
+                os.chdir(cwd)
+        p50 = latencies[len(latencies) // 2] * 1000
+        p95 = latencies[int(len(latencies) * 0.95)] * 1000
+        mode = "concorrente" if concurrent else "sequenziale"
+        print(f"{mode:>12} {elapsed:>8.2f} {len(updates) / elapsed:>9.0f} {p50:>8.0f} {p95:>8.0f} "
+              f"{overlaps:>11} {out_of_order:>12}")
+    print(f"lock per lista: {stats}")
+
+def bench_stale_taps(members=5, num_items=20, rounds=200, seed=7):
+    """Group members tapping remove on the same rendered list: positional indices against item IDs."""
+    from shopping_list import ShoppingList
+    print(f"\n== {members} membri toccano Rimuovi sulla stessa lista di {num_items} articoli, {rounds} volte ==")
+    rng = random.Random(seed)
+    wrong = {"indice": 0, "id": 0}
+    with tempfile.TemporaryDirectory() as tmp:
+        cwd = os.getcwd()
+        os.chdir(tmp)
+        try:
+            shopping_list = ShoppingList(flush_interval=3600, flush_max_pending=10 ** 9)
+            for _ in range(rounds):
+                for mode in wrong:
+                    shopping_list.clear_list(-1001)
+                    shopping_list.add_items(-1001, [f"articolo {i}" for i in range(num_items)])
+                    # Every member sees the same rendered list and taps a different item
+                    rendered = shopping_list.get_items(-1001)
+                    taps = rng.sample(range(num_items), members)
+                    for position in taps:
+                        if mode == "indice":
+                            removed = shopping_list.remove_item(-1001, position)
+                        else:
+                            removed = (shopping_list.remove_items(-1001, [rendered[position].id]) or [None])[0]
+                        wrong[mode] += removed is None or removed.name != rendered[position].name
+            shopping_list.close()
+        finally:
+            os.chdir(cwd)
+    taps = members * rounds
+    print(f"articoli sbagliati o mancati: con l'indice {wrong['indice']} su {taps}, con l'ID {wrong['id']} su {taps}")
+    return wrong["id"]
+
+def _state_server_process(directory, path):
+    """Run the state server in its own process, as the Procfile does, until SIGTERM."""
+    os.chdir(directory)
+    os.environ["STATE_SOCKET"] = path
+    import state_server
+    state_server.main()
+
+def bench_state_server(num_items=20, calls=5000, handler_counts=(1, 64), handler_calls=100):
+    """
+    Latency of list calls on a local ShoppingList and through the state server,
+    running in its own process, then bot handlers calling it concurrently with
+    the blocking and the asyncio client.
+    """
+    from shopping_list import ShoppingList
+    from state_server import ShoppingListClient, AsyncShoppingListClient
+    print(f"\n== chiamate su una lista di {num_items} articoli: locale e tramite il server di stato ==")
+    print(f"{'':>10} {'get_items p50':>14} {'p99':>6} {'add_item p50':>13} {'p99':>6}  (us)")
+
+    async def run(client, blocking, handlers):
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        lag = 0.0
+
+        async def ticker():
+            # How late the event loop runs a 1 ms timer: the time a handler held it
+            nonlocal lag
+            while not stop.is_set():
+                start = loop.time()
+                await asyncio.sleep(0.001)
+                lag = max(lag, loop.time() - start - 0.001)
+
+        async def call(method, *args):
+            if blocking:
+                result = getattr(client, method)(*args)
+                return result.result() if method == "persisted" else result
+            return await getattr(client, method)(*args)
+
+        latencies = []
+
+        async def handler(number):
+            chat_id = -(3000 + number)
+            for i in range(handler_calls):
+                start = loop.time()
+                await call("add_item", chat_id, f"articolo {i % num_items}")
+                await call("get_items", chat_id)
+                # Now and then a handler waits for the disk
+                if i % 25 == 24:
+                    await call("persisted")
+                latencies.append(loop.time() - start)
+                # The reply
+                await asyncio.sleep(0)
+
+        ticker_task = asyncio.create_task(ticker())
+        start = loop.time()
+        await asyncio.gather(*(handler(number) for number in range(handlers)))
+        elapsed = loop.time() - start
+        stop.set()
+        await ticker_task
+        if not blocking:
+            client.close()
+        latencies.sort()
+        return elapsed, latencies, lag
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cwd = os.getcwd()
+        os.chdir(tmp)
+        path = os.path.join(tmp, "state.sock")
+        server = multiprocessing.Process(target=_state_server_process, args=(tmp, path))
+        server.start()
+        try:
+            local = ShoppingList(flush_interval=0.05)
+            client = ShoppingListClient(path)
+            local.add_items(-1001, [f"articolo {i}" for i in range(num_items)])
+            client.add_items(-1001, [f"articolo {i}" for i in range(num_items)])
+            for name, shopping_list in (("locale", local), ("socket", client)):
+                results = []
+                for call in (lambda i: shopping_list.get_items(-1001),
+                             lambda i: shopping_list.add_item(-1002, f"articolo {i % num_items}")):
+                    latencies = []
+                    for i in range(calls):
+                        start = time.perf_counter()
+                        call(i)
+                        latencies.append(time.perf_counter() - start)
+                    latencies.sort()
+                    results += [latencies[len(latencies) // 2] * 1e6, latencies[int(len(latencies) * 0.99)] * 1e6]
+                print(f"{name:>10} {results[0]:>14.0f} {results[1]:>6.0f} {results[2]:>13.0f} {results[3]:>6.0f}")
+            local.close()
+
+            print(f"\n== handler concorrenti, {handler_calls} aggiunte e letture ciascuno, "
+                  f"server di stato in un processo separato ==")
+            print(f"{'client':>10} {'handler':>8} {'chiamate/s':>11} {'p50 ms':>7} {'p99 ms':>7} {'loop bloccato ms':>17}")
+            for handlers in handler_counts:
+                for name, blocking in (("bloccante", True), ("asyncio", False)):
+                    shopping_list = client if blocking else AsyncShoppingListClient(path)
+                    elapsed, latencies, lag = asyncio.run(run(shopping_list, blocking, handlers))
+                    print(f"{name:>10} {handlers:>8} {handlers * handler_calls * 2 / elapsed:>11.0f} "
+                          f"{latencies[len(latencies) // 2] * 1000:>7.2f} "
+                          f"{latencies[int(len(latencies) * 0.99)] * 1000:>7.2f} {lag * 1000:>17.2f}")
+            client.close()
+        finally:
+            server.terminate()
+            server.join()
+            os.chdir(cwd)
+
+def bench_webhook(chats=50):
+    """Recorded updates POSTed to the local webhook server and handled by the bot, with a fake Bot API."""
+    import json
+    import socket
+    import aiohttp
+    from webhook import WebhookConfig, WebhookServer, SECRET_HEADER
+    texts = ["/start", "/aggiungi latte, pane", "/aggiungi", "uova", "/lista"]
+    print(f"\n== webhook: {len(texts)} update per chat, ognuna inviata dopo la risposta alla precedente ==")
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    config = WebhookConfig(url=None, listen="127.0.0.1", port=port, path="/telegram", secret_token="segreto")
+    url = f"http://127.0.0.1:{port}/telegram"
+
+    async def run(telegram_bot, chats, first_chat):
+        replies = {}
+
+        def on_send(chat_id, text):
+            replies.setdefault(chat_id, asyncio.Queue()).put_nowait(time.perf_counter())
+
+        api = fake_bot_api(on_send)
+        application = telegram_bot.build_application("123456:TEST", request=api)
+        server = WebhookServer(application, config)
+        await application.initialize()
+        await application.start()
+        await server.start()
+        acks, latencies = [], []
+        update_ids = iter(range(1, 10 ** 6))
+
+        async def chat(session, chat_id):
+            chat_replies = replies.setdefault(chat_id, asyncio.Queue())
+            for text in texts:
+                start = time.perf_counter()
+                async with session.post(url, json=recorded_update(next(update_ids), chat_id, text),
+                                        headers={SECRET_HEADER: config.secret_token}) as response:
+                    assert response.status == 200, response.status
+                acks.append(time.perf_counter() - start)
+                latencies.append(await chat_replies.get() - start)
+
+        async with aiohttp.ClientSession() as session:
+            start = time.perf_counter()
+            await asyncio.gather(*(chat(session, first_chat + number) for number in range(chats)))
+            elapsed = time.perf_counter() - start
+            # Requests that must be rejected without reaching the handlers
+            statuses = []
+            for headers, data in (({SECRET_HEADER: "sbagliato"}, json.dumps(recorded_update(0, 1, "/start"))),
+                                  ({}, json.dumps(recorded_update(0, 1, "/start"))),
+                                  ({SECRET_HEADER: config.secret_token}, "{non è json")):
+                async with session.post(url, data=data, headers=headers) as response:
+                    statuses.append(response.status)
+            await asyncio.sleep(0.1)
+        stats = server.stats()
+        unanswered = 1 in replies and not replies[1].empty()
+        await server.stop()
+        await application.stop()
+        await application.shutdown()
+        wrong_lists = sum([await telegram_bot.shopping_list.get_item_names(first_chat + number) != ["latte", "pane", "uova"]
+                           for number in range(chats)])
+        return elapsed, sorted(acks), sorted(latencies), statuses, stats, unanswered, wrong_lists
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cwd = os.getcwd()
+        os.chdir(tmp)
+        os.environ.pop("STATE_SOCKET", None)
+        # The fake Bot API has no rate limits to respect
+        send_rate = os.environ.get("BOT_SEND_RATE")
+        os.environ["BOT_SEND_RATE"] = "0"
+        try:
+            import telegram_bot
+
+            def percentile(values, fraction):
+                return values[int(len(values) * fraction)] * 1000
+
+            print(f"{'chat':>5} {'update/s':>9} {'HTTP p50':>9} {'p99':>6} {'risposta p50':>13} {'p99':>6}  (ms)")
+            for count, first_chat in ((1, 1000), (chats, 2000)):
+                elapsed, acks, latencies, statuses, stats, unanswered, wrong_lists = asyncio.run(
+                    run(telegram_bot, count, first_chat))
+                print(f"{count:>5} {count * len(texts) / elapsed:>9.0f} {percentile(acks, 0.5):>9.1f} "
+                      f"{percentile(acks, 0.99):>6.1f} {percentile(latencies, 0.5):>13.1f} "
+                      f"{percentile(latencies, 0.99):>6.1f}")
+            telegram_bot.shopping_list.close()
+        finally:
+            os.chdir(cwd)
+            _restore_env("BOT_SEND_RATE", send_rate)
+    print(f"liste sbagliate: {wrong_lists}; richieste non valide: stati {statuses}, "
+          f"gestite per errore: {unanswered}; contatori {stats}")
+
+def _fake_updates(chats, updates_per_chat, seed=42):
+    """
+    Generate the updates of many chats, interleaved at random but in order
+    within each chat: items added, then /lista. A third of the chats are groups.
+
+    Returns:
+        The list of update dicts
+    """
+    rng = random.Random(seed)
+    chat_ids = [-(10 ** 9 + number) if number % 3 == 0 else 10 ** 6 + number for number in range(chats)]
+    slots = [chat_id for chat_id in chat_ids for _ in range(updates_per_chat)]
+    rng.shuffle(slots)
+    sent = dict.fromkeys(chat_ids, 0)
+    updates = []
+    for update_id, chat_id in enumerate(slots, 1):
+        number = sent[chat_id]
+        sent[chat_id] += 1
+        if number == updates_per_chat - 1:
+            text = "/lista"
+        else:
+            name = SAMPLE_ITEMS[(chat_id + number) % len(SAMPLE_ITEMS)][0]
+            text = f"/aggiungi {name} {number}"
+        # Group members take turns
+        user_id = 5000 + number % 3 if chat_id < 0 else chat_id
+        updates.append(recorded_update(update_id, chat_id, text, user_id))
+    return updates
+
+class _ShardBotAPI:
+    """Picklable factory of the fake Bot API of the sharded workers, reporting back through queues."""
+
+    def __init__(self, ready, sent):
+        self.ready = ready
+        self.sent = sent
+
+    def __call__(self):
+        # Messages sent, and CPU time of the worker when it got ready
+        state = [0, 0.0]
+
+        def on_send(chat_id, text):
+            state[0] += 1
+
+        def on_initialize():
+            state[1] = time.process_time()
+            self.ready.put(True)
+
+        def on_shutdown():
+            self.sent.put((state[0], time.process_time() - state[1]))
+
+        return fake_bot_api(on_send, on_initialize, on_shutdown)
+
+def bench_sharded_bot(worker_counts=(1, 2, 4, 8), chats=600, updates_per_chat=6):
+    """Updates from a fake generator routed by list to 1, 2, 4 and 8 bot worker processes."""
+    from shopping_list import ShoppingList, split_items
+    from sharded_bot import ShardDispatcher
+    updates = _fake_updates(chats, updates_per_chat)
+    print(f"\n== {len(updates)} update da {chats} chat, smistate per lista ai processi worker "
+          f"({os.cpu_count()} CPU) ==")
+    context = multiprocessing.get_context("spawn")
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        cwd = os.getcwd()
+        os.chdir(tmp)
+        os.environ.pop("STATE_SOCKET", None)
+        # The fake Bot API has no rate limits to respect
+        send_rate = os.environ.get("BOT_SEND_RATE")
+        os.environ["BOT_SEND_RATE"] = "0"
+        # Required by more than one worker
+        backend = os.environ.get("STORAGE_BACKEND")
+        os.environ["STORAGE_BACKEND"] = "sharded"
+        try:
+            # The lists expected, from the same commands in the same order in one process
+            reference = ShoppingList(flush_interval=3600, flush_max_pending=10 ** 9)
+            for data in updates:
+                message = data["message"]
+                if message["text"].startswith("/aggiungi "):
+                    reference.add_items(message["chat"]["id"], split_items(message["text"].split(" ", 1)[1]),
+                                        message["from"]["id"])
+            chat_ids = {(data["message"]["chat"]["id"], data["message"]["from"]["id"]) for data in updates}
+            expected = {chat: reference.get_item_names(*chat) for chat in chat_ids}
+            reference.close()
+
+            print(f"{'worker':>6} {'update/s':>9} {'tempo s':>8} {'smistamento/s':>14} {'CPU ms/update':>14} "
+                  f"{'risposte':>9} {'liste sbagliate':>15}  distribuzione")
+            for workers in worker_counts:
+                directory = os.path.join(tmp, str(workers))
+                os.mkdir(directory)
+                os.chdir(directory)
+                ready, sent = context.Queue(), context.Queue()
+                dispatcher = ShardDispatcher("123456:TEST", workers, _ShardBotAPI(ready, sent))
+                dispatcher.start()
+                for _ in range(workers):
+                    ready.get(timeout=120)
+                start = time.perf_counter()
+                for data in updates:
+                    dispatcher.dispatch(data)
+                dispatch_time = time.perf_counter() - start
+                # Returns once every worker processed its updates and stopped
+                dispatcher.stop(timeout=600)
+                elapsed = time.perf_counter() - start
+                reports = [sent.get(timeout=10) for _ in range(workers)]
+                replies = sum(count for count, _ in reports)
+                # CPU time of all the workers: what N cores would share
+                cpu_per_update = sum(cpu for _, cpu in reports) * 1000 / len(updates)
+                stored = ShoppingList()
+                wrong = sum(stored.get_item_names(*chat) != names for chat, names in expected.items())
+                stored.close()
+                results.append(len(updates) / elapsed)
+                print(f"{workers:>6} {len(updates) / elapsed:>9.0f} {elapsed:>8.2f} "
+                      f"{len(updates) / dispatch_time:>14.0f} {cpu_per_update:>14.2f} {replies:>9} {wrong:>15}  "
+                      f"{dispatcher.dispatched}")
+        finally:
+            os.chdir(cwd)
+            _restore_env("BOT_SEND_RATE", send_rate)
+            _restore_env("STORAGE_BACKEND", backend)
+    return results
+
+def _restore_env(name, value):
+    """Set an environment variable back to a value read with os.environ.get()."""
+    if value is None:
+        os.environ.pop(name, None)
+    else:
+        os.environ[name] = value
+
+def _rate_limited_bot_api(latency):
+    """
+    A telegram.request.BaseRequest simulating the Bot API and its flood limits:
+    30 messages in any second overall, 20 per minute in a group and 60 per
+    minute in a private chat. Requests over a limit get a 429 with retry_after.
+    """
+    import json
+    from collections import deque
+    from telegram.request import BaseRequest
+
+    class RateLimitedBotAPI(BaseRequest):
+        def __init__(self):
+            self.overall = deque()
+            self.chats = {}
+            self.requests = {}
+            self.rejected = 0
+
+        async def initialize(self):
+            pass
+
+        async def shutdown(self):
+            pass
+
+        async def do_request(self, url, method, request_data=None, **kwargs):
+            endpoint = url.rsplit("/", 1)[-1]
+            parameters = request_data.parameters if request_data else {}
+            await asyncio.sleep(latency)
+            if endpoint == "getMe":
+                return 200, json.dumps({"ok": True, "result": {
+                    "id": 1, "is_bot": True, "first_name": "Spesa", "username": "spesa_bot"}}).encode()
+            now = time.monotonic()
+            chat_id = int(parameters["chat_id"])
+            window = self.chats.setdefault(chat_id, deque())
+            for times, span in ((self.overall, 1.0), (window, 60.0)):
+                while times and times[0] <= now - span:
+                    times.popleft()
+            limit = 20 if chat_id < 0 else 60
+            if len(self.overall) >= 30 or len(window) >= limit:
+                self.rejected += 1
+                retry_after = 1 if len(self.overall) >= 30 else int(window[0] + 60 - now) + 1
+                return 429, json.dumps({"ok": False, "error_code": 429, "parameters": {"retry_after": retry_after},
+                                        "description": f"Too Many Requests: retry after {retry_after}"}).encode()
+            self.overall.append(now)
+            window.append(now)
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            result = {"message_id": int(parameters.get("message_id", 1)), "date": int(now),
+                      "chat": {"id": chat_id, "type": "group" if chat_id < 0 else "private"},
+                      "text": parameters.get("text", "")}
+            return 200, json.dumps({"ok": True, "result": result}).encode()
+
+    return RateLimitedBotAPI()
+
+def bench_send_scheduler(chats=100, replies_per_chat=2, notifications=100, edited=20, edits=10, latency=0.03):
+    """A burst of replies, notifications and repeated edits against a simulated rate-limited Bot API."""
+    from telegram.error import RetryAfter
+    from telegram.ext import ExtBot
+    from send_scheduler import SendScheduler, PRIORITY_NOTIFICATION
+    print(f"\n== {chats * replies_per_chat} risposte a {chats} chat, {notifications} notifiche, "
+          f"{edited} messaggi modificati {edits} volte, limiti di Telegram simulati ==")
+    # A third of the chats are groups
+    chat_ids = [-(10 ** 9 + n) if n % 3 == 0 else 10 ** 6 + n for n in range(chats)]
+
+    async def run(scheduler):
+        api = _rate_limited_bot_api(latency)
+        bot = ExtBot("123456:TEST", request=api, get_updates_request=api, rate_limiter=scheduler)
+        await bot.initialize()
+        latencies = {"risposte": [], "notifiche": []}
+        errors = 0
+
+        async def send(kind, coroutine):
+            nonlocal errors
+            start = time.perf_counter()
+            try:
+                await coroutine
+            except RetryAfter:
+                # Without a scheduler nobody sends it again: the message is lost
+                errors += 1
+                return
+            latencies[kind].append(time.perf_counter() - start)
+
+        calls = []
+        for number in range(replies_per_chat):
+            calls += [send("risposte", bot.send_message(chat_id, f"risposta {number}")) for chat_id in chat_ids]
+        extra = {} if scheduler is None else {"rate_limit_args": PRIORITY_NOTIFICATION}
+        calls += [send("notifiche", bot.send_message(2 * 10 ** 6 + n, "promemoria", **extra))
+                  for n in range(notifications)]
+        # Progress shown by editing the same message again and again
+        calls += [send("modifiche", bot.edit_message_text(f"{step * 10}%", 3 * 10 ** 6 + n, 1))
+                  for step in range(edits) for n in range(edited)]
+        latencies["modifiche"] = []
+        start = time.perf_counter()
+        await asyncio.gather(*calls)
+        elapsed = time.perf_counter() - start
+        stats = scheduler.stats() if scheduler else None
+        await bot.shutdown()
+        return elapsed, latencies, errors, api, stats
+
+    print(f"{'':>13} {'tempo s':>8} {'persi':>6} {'429':>5} {'richieste':>10} "
+          f"{'risposte p95 s':>15} {'notifiche p95 s':>16}")
+    for name, scheduler in (("diretto", None), ("scheduler", SendScheduler())):
+        elapsed, latencies, errors, api, stats = asyncio.run(run(scheduler))
+        p95 = {kind: sorted(values)[int(len(values) * 0.95)] if values else 0.0
+               for kind, values in latencies.items()}
+        print(f"{name:>13} {elapsed:>8.2f} {errors:>6} {api.rejected:>5} {sum(api.requests.values()):>10} "
+              f"{p95['risposte']:>15.2f} {p95['notifiche']:>16.2f}")
+    print(f"scheduler: {stats}")
+
+def _reference_categorize(name):
+    """The original nested keyword scan, used to check the compiled categorizer."""
+    from categorizer import CATEGORY_KEYWORDS
+    name = name.lower().strip()
+    for category, keywords in CATEGORY_KEYWORDS.items():
+        for keyword in keywords:
+            if keyword in name or name in keyword:
+                return category
+    return "Altro"
+
+def bench_categorizer(random_names=100000):
+    """Differential check and speed of the compiled categorizer against the original scan."""
+    from categorizer import CATEGORY_KEYWORDS, Categorizer
+    # Without the cache, to measure the matching itself
+    categorizer = Categorizer(CATEGORY_KEYWORDS, cache=None)
+    rng = random.Random(7)
+    keywords = [keyword for words in CATEGORY_KEYWORDS.values() for keyword in words]
+    alphabet = sorted(set("".join(keywords)))
+    # Every keyword and keyword substring, combinations of keywords and random strings
+    names = {""}
+    for keyword in keywords:
+        for start in range(len(keyword)):
+            for end in range(start + 1, len(keyword) + 1):
+                names.add(keyword[start:end])
+    for _ in range(random_names):
+        first, second = rng.choice(keywords), rng.choice(keywords)
+        names.add(rng.choice([f"{first} {second}", f"{first} di {second}", first + second,
+                              f"{first[:rng.randint(1, len(first))]}{second[rng.randint(0, len(second) - 1):]}"]))
+        names.add("".join(rng.choice(alphabet) for _ in range(rng.randint(1, 16))))
+    names = sorted(names)
+
+    print(f"\n== Categorizzazione di {len(names)} nomi ==")
+    start = time.perf_counter()
+    expected = [_reference_categorize(name) for name in names]
+    reference_time = time.perf_counter() - start
+    start = time.perf_counter()
+    actual = [categorizer.categorize(name) for name in names]
+    compiled_time = time.perf_counter() - start
+    mismatches = [(name, e, a) for name, e, a in zip(names, expected, actual) if e != a]
+    print(f"scansione: {reference_time * 1e6 / len(names):.1f} us/nome, "
+          f"automa: {compiled_time * 1e6 / len(names):.1f} us/nome, differenze: {len(mismatches)}")
+    for name, e, a in mismatches[:10]:
+        print(f"  {name!r}: atteso {e}, ottenuto {a}")
+    return len(mismatches)
+
+def bench_item_memory(num_items=1000000):
+    """Memory per item of dict items, as loaded from JSON, and of Item objects."""
+    import json
+    from item import Item
+    # Lists of about 10 items, decoded from JSON like the storage does
+    encoded = json.dumps(make_dataset(num_items // 10, items_per_list=10))
+    print("\n== Memoria per articolo ==")
+    print(f"{'modello':>8} {'articoli':>10} {'byte/articolo':>14}")
+    for name in ("dict", "Item"):
+        tracemalloc.start()
+        data = json.loads(encoded)
+        if name == "Item":
+            data = {list_id: [Item.from_dict(item) for item in items] for list_id, items in data.items()}
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        count = sum(len(items) for items in data.values())
+        print(f"{name:>8} {count:>10} {size / count:>14.1f}")
+        del data
+
+def _multiprocess_writer(directory, worker, additions):
+    """Add items to the worker's own group list from a separate process."""
+    os.chdir(directory)
+    from shopping_list import ShoppingList
+    shopping_list = ShoppingList(flush_interval=0)
+    for i in range(additions):
+        shopping_list.add_item(-(1000 + worker), f"articolo {worker}-{i}", 1)
+    shopping_list.close()
+
+def bench_multiprocess(workers=4, additions=200, backends=("json", "wal", "sharded", "sqlite")):
+    """Several writer processes sharing one storage: every change of every process must survive."""
+    print(f"\n== {workers} processi, {additions} aggiunte ciascuno sullo stesso storage ==")
+    print(f"{'backend':>8} {'tempo (s)':>10} {'scritture/s':>12} {'letture vecchie':>16} {'modifiche perse':>16}")
+    total_lost = 0
+    for backend in backends:
+        with tempfile.TemporaryDirectory() as tmp:
+            cwd = os.getcwd()
+            saved_env = [(name, os.environ.get(name)) for name in ("STORAGE_BACKEND", "STORAGE_WAL_COMPACT_EVERY")]
+            os.environ["STORAGE_BACKEND"] = backend
+            # Compactions while the others are appending
+            os.environ["STORAGE_WAL_COMPACT_EVERY"] = "50"
+            os.chdir(tmp)
+            try:
+                from shopping_list import ShoppingList
+                reader = ShoppingList(flush_interval=0)
+                reader.add_item(-1, "pane", 1)
+                # Lists the reader has in memory while the writers change them
+                for worker in range(workers):
+                    reader.add_item(-(1000 + worker), "latte", 1)
+
+                start = time.perf_counter()
+                processes = [multiprocessing.Process(target=_multiprocess_writer, args=(tmp, worker, additions))
+                             for worker in range(workers)]
+                for process in processes:
+                    process.start()
+                for process in processes:
+                    process.join()
+                elapsed = time.perf_counter() - start
+
+                # The reader notices the changes and loads the lists again
+                stale = sum(additions + 1 - len(reader.get_items(-(1000 + worker))) for worker in range(workers))
+                # Writing after the others must not overwrite their items
+                for worker in range(workers):
+                    reader.add_item(-(1000 + worker), "uova", 1)
+                reader.close()
+                check = ShoppingList(flush_interval=0)
+                lost = sum(additions + 2 - len(check.get_items(-(1000 + worker))) for worker in range(workers))
+                lost += 0 if check.get_items(-1) else 1
+                check.close()
+            finally:
+                os.chdir(cwd)
+                for name, value in saved_env:
+                    _restore_env(name, value)
+        total_lost += stale + lost
+        print(f"{backend:>8} {elapsed:>10.2f} {workers * additions / elapsed:>12.0f} {stale:>16} {lost:>16}")
+    return total_lost
+
+BENCHMARKS = {
+    "mutations": bench_mutations,
+    "sqlite": bench_sqlite,
+    "write_behind": bench_write_behind,
+    "multiprocess": bench_multiprocess,
+    "snapshot": bench_snapshot,
+    "item_memory": bench_item_memory,
+    "add_items": bench_add_items,
+    "remove_items": bench_remove_items,
+    "snapshot_reads": bench_snapshot_reads,
+    "concurrent_updates": bench_concurrent_updates,
+    "stale_taps": bench_stale_taps,
+    "state_server": bench_state_server,
+    "webhook": bench_webhook,
+    "sharded_bot": bench_sharded_bot,
+    "send_scheduler": bench_send_scheduler,
+    "categorizer": bench_categorizer,
+}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f"Benchmark sconosciuto: {name}. Disponibili: {', '.join(BENCHMARKS)}")
+            sys.exit(1)
+        BENCHMARKS[name]()
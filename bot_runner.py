@@ -7,15 +7,17 @@ import os
 import logging
 import asyncio
 import signal
-import time
 from telegram import Update
 from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes
 
-from shopping_list import ShoppingList
+from shopping_list import parse_item_numbers
+from state_server import create_async_shopping_list
 from ai_assistant import AIAssistant
+from webhook import WebhookServer, webhook_config
+from send_scheduler import create_send_scheduler
 from constants import (
     START_MSG, HELP_MSG, ITEM_ADDED_MSG, LIST_EMPTY_MSG, 
-    LIST_HEADER_MSG, ITEM_REMOVED_MSG, LIST_CLEARED_MSG,
+    LIST_HEADER_MSG, ITEM_REMOVED_MSG, ITEMS_REMOVED_MSG, LIST_CLEARED_MSG,
     SUGGEST_RESPONSE_MSG, ERROR_MSG
 )
 
@@ -25,7 +27,9 @@ logging.basicConfig(level=logging.INFO,
 logger = logging.getLogger(__name__)
 
 # Initialize shopping list manager and AI assistant
-shopping_list = ShoppingList()
+# Writes happen on a background thread so handlers never block the event loop
+# With STATE_SOCKET set, the lists live in the shared state server (state_server.py)
+shopping_list = create_async_shopping_list(background_writes=True)
 ai_assistant = AIAssistant()
 
 def get_category_emoji(category):
@@ -85,8 +89,12 @@ def get_category_emoji(category):
     
     return "📦"  # Emoji predefinito per categorie non riconosciute
 
-# Keep track of running status
-bot_running = False
+# Update types the bot handles
+ALLOWED_UPDATES = ["message"]
+
+# Seconds the updates being processed, AI calls included, get to finish
+# when the bot stops. Hosts usually kill the process 30 seconds after SIGTERM.
+DRAIN_TIMEOUT = float(os.environ.get("BOT_DRAIN_TIMEOUT", "25"))
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a welcome message when the /start command is issued."""
@@ -123,13 +131,11 @@ async def add_item(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
     
     item = " ".join(context.args)
-    success, item_name, quantity, category = shopping_list.add_item(chat_id, item, user_id)
+    success, item_name, quantity, category = await shopping_list.add_item(chat_id, item, user_id)
     
     if success:
-        if quantity:
-            message = f"{ITEM_ADDED_MSG.format(item=item_name)} ({quantity})\n\n_{list_type}_"
-        else:
-            message = f"{ITEM_ADDED_MSG.format(item=item_name)}\n\n_{list_type}_"
+        # The message already shows the quantity
+        message = f"{ITEM_ADDED_MSG.format(item=item_name, quantity=quantity or '1')}\n\n_{list_type}_"
         await update.message.reply_text(message, parse_mode="Markdown")
     else:
         message = f"Non sono riuscito ad aggiungere l'articolo.\n\n_{list_type}_"
@@ -139,7 +145,7 @@ async def show_list(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Display the current shopping list."""
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
-    items = shopping_list.get_items(chat_id, user_id)
+    items = await shopping_list.get_items(chat_id, user_id)
     
     if not items:
         # Get list type (group or personal)
@@ -201,19 +207,26 @@ async def remove_item(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         await update.message.reply_text(message, parse_mode="Markdown")
         return
     
-    try:
-        index = int(context.args[0]) - 1
-        removed_item = shopping_list.remove_item(chat_id, index, user_id)
-        
-        if removed_item:
-            message = f"{ITEM_REMOVED_MSG.format(item=removed_item['name'])}\n\n_{list_type}_"
-            await update.message.reply_text(message, parse_mode="Markdown")
-        else:
-            message = f"Non ho trovato questo articolo nella tua lista.\n\n_{list_type}_"
-            await update.message.reply_text(message, parse_mode="Markdown")
-    except (ValueError, IndexError):
+    # One or more numbers and ranges, e.g. /rimuovi 1,3,5-7
+    items = await shopping_list.get_items(chat_id, user_id)
+    numbers = parse_item_numbers(" ".join(context.args), len(items))
+    if not numbers:
         message = f"Per favore, inserisci un numero valido. Usa /lista per vedere i numeri degli articoli.\n\n_{list_type}_"
         await update.message.reply_text(message, parse_mode="Markdown")
+        return
+    
+    removed_items = await shopping_list.remove_items(chat_id, [items[number - 1].id for number in numbers], user_id)
+    
+    if len(removed_items) == 1:
+        message = f"{ITEM_REMOVED_MSG.format(item=removed_items[0]['name'])}\n\n_{list_type}_"
+        await update.message.reply_text(message, parse_mode="Markdown")
+    elif removed_items:
+        names = ", ".join(item["name"] for item in removed_items)
+        message = f"{ITEMS_REMOVED_MSG.format(count=len(removed_items), items=names)}\n\n_{list_type}_"
+        await update.message.reply_text(message, parse_mode="Markdown")
+    else:
+        message = f"Non ho trovato questo articolo nella tua lista.\n\n_{list_type}_"
+        await update.message.reply_text(message, parse_mode="Markdown")
 
 async def clear_list(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Clear the entire shopping list."""
@@ -223,7 +236,7 @@ async def clear_list(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     # Get list type (group or personal)
     list_type = shopping_list.get_list_type(chat_id)
     
-    shopping_list.clear_list(chat_id, user_id)
+    await shopping_list.clear_list(chat_id, user_id)
     message = f"{LIST_CLEARED_MSG}\n\n_{list_type}_"
     await update.message.reply_text(message, parse_mode="Markdown")
 
@@ -231,7 +244,7 @@ async def suggest(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Get AI-powered suggestions based on the current shopping list."""
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
-    items = shopping_list.get_items(chat_id, user_id)
+    items = await shopping_list.get_items(chat_id, user_id)
     item_names = [item["name"] for item in items]  # Extract just the names for AI
     
     # Get list type (group or personal)
@@ -257,7 +270,7 @@ async def ai_help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Get AI assistance with shopping list or meal planning."""
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
-    items = shopping_list.get_items(chat_id, user_id)
+    items = await shopping_list.get_items(chat_id, user_id)
     item_names = [item["name"] for item in items]  # Extract just the names for AI
     
     # Get list type (group or personal)
@@ -290,7 +303,7 @@ async def categorize(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     """Categorize items in the shopping list."""
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
-    items = shopping_list.get_items(chat_id, user_id)
+    items = await shopping_list.get_items(chat_id, user_id)
     item_names = [item["name"] for item in items]  # Extract just the names for AI
     
     # Get list type (group or personal)
@@ -316,7 +329,7 @@ async def meal_plan(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Generate a meal plan based on items in the shopping list."""
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
-    items = shopping_list.get_items(chat_id, user_id)
+    items = await shopping_list.get_items(chat_id, user_id)
     item_names = [item["name"] for item in items]  # Extract just the names for AI
     
     # Get list type (group or personal)
@@ -338,45 +351,57 @@ async def meal_plan(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         logger.error(f"Error in meal_plan command: {e}")
         await update.message.reply_text(ERROR_MSG)
 
-def handle_sigterm(signum, frame):
-    """Handle termination signals correctly"""
-    logger.info("Received SIGTERM, shutting down bot...")
-    global bot_running
-    bot_running = False
-    # Wait for cleanup
-    time.sleep(2)
-    logger.info("Bot gracefully shut down")
-    exit(0)
-
 def run_bot_forever():
     """Run the bot with proper error handling and recovery"""
-    global bot_running
-    bot_running = True
-    
-    # Set up signal handlers
-    signal.signal(signal.SIGTERM, handle_sigterm)
-    signal.signal(signal.SIGINT, handle_sigterm)
-    
-    while bot_running:
+    asyncio.run(run_until_stopped())
+    # The last changes, written after every handler finished
+    shopping_list.close()
+    logger.info("Bot gracefully shut down")
+
+async def run_until_stopped():
+    """Run the bot, restarting it after errors, until SIGTERM or SIGINT."""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop_event.set)
+    # Read once: a wrong webhook configuration raises here instead of being retried
+    config = webhook_config()
+    
+    while not stop_event.is_set():
         try:
             logger.info("Starting Telegram bot...")
-            # Run the bot asynchronously
-            asyncio.run(run_bot())
+            await run_bot(stop_event, config)
+            # Stopped, or not configured
+            return
         except Exception as e:
             logger.error(f"Bot error: {e}")
             logger.info("Restarting bot in 10 seconds...")
-            time.sleep(10)
+            try:
+                # A signal during the wait stops right away
+                await asyncio.wait_for(stop_event.wait(), 10)
+            except asyncio.TimeoutError:
+                pass
 
-async def run_bot():
-    """Run the bot with proper shutdown handling"""
-    # Get the token from environment variable
-    token = os.environ.get("TELEGRAM_TOKEN")
-    if not token:
-        logger.error("TELEGRAM_TOKEN environment variable not set!")
-        return
-    
-    # Create the Application
-    application = ApplicationBuilder().token(token).build()
+def build_application(token, request=None):
+    """
+    Create the bot Application with all its handlers.
+
+    Args:
+        token: The Telegram bot token
+        request: The telegram.request.BaseRequest used to call the Bot API,
+            an HTTPXRequest by default
+
+    Returns:
+        The Application, not initialized yet
+    """
+    # Outgoing messages are queued per chat and sent within Telegram's rate limits
+    builder = ApplicationBuilder().token(token)
+    if request is not None:
+        builder.request(request)
+    send_scheduler = create_send_scheduler()
+    if send_scheduler:
+        builder.rate_limiter(send_scheduler)
+    application = builder.build()
     
     # Add command handlers
     application.add_handler(CommandHandler("start", start))
@@ -389,30 +414,124 @@ async def run_bot():
     application.add_handler(CommandHandler("ai", ai_help))
     application.add_handler(CommandHandler("categorie", categorize))
     application.add_handler(CommandHandler("pasti", meal_plan))
+    return application
+
+async def run_bot(stop_event, config=None, request=None):
+    """
+    Run the bot until stop_event is set, then stop it cleanly.
+
+    Args:
+        stop_event: An asyncio.Event that stops the bot
+        config: The WebhookConfig to receive the updates with, None to poll them
+        request: Passed to build_application()
+    """
+    # Get the token from environment variable
+    token = os.environ.get("TELEGRAM_TOKEN")
+    if not token:
+        logger.error("TELEGRAM_TOKEN environment variable not set!")
+        return
+    
+    application = build_application(token, request)
     
     # Notify the user to interact with the bot through Telegram
     logger.info("The bot is running. Please interact with it through Telegram.")
     
-    # Start the Bot with proper shutdown
-    stop_signal = asyncio.Future()
-    
-    # Run the bot and handle shutdown
     await application.initialize()
-    await application.start()
-    
-    logger.info("Bot is up and running!")
-    
-    # Keep the bot running until stop_signal is set
-    while not stop_signal.done() and bot_running:
+    webhook = None
+    try:
+        await application.start()
+        
+        # Receive the updates: pushed by Telegram to the webhook server with
+        # WEBHOOK_URL or BOT_MODE=webhook, polled otherwise
+        if config:
+            webhook = WebhookServer(application, config)
+            await webhook.start(allowed_updates=ALLOWED_UPDATES)
+        else:
+            await application.updater.start_polling(allowed_updates=ALLOWED_UPDATES)
+        
+        logger.info("Bot is up and running!")
+        await stop_event.wait()
+        logger.info("Shutting down bot...")
+    finally:
+        await drain(application, webhook)
+        await application.shutdown()
+
+async def drain(application, webhook=None, timeout=None):
+    """
+    Stop receiving updates, then let the ones already received finish.
+
+    Handlers still running after the timeout are cancelled, and awaited, so
+    that Application.shutdown() never runs under them.
+
+    Args:
+        application: The Application to stop
+        webhook: The WebhookServer receiving the updates, None when polling
+        timeout: Seconds to wait for the handlers, DRAIN_TIMEOUT by default
+    """
+    timeout = DRAIN_TIMEOUT if timeout is None else timeout
+    if webhook:
+        await webhook.stop()
+    elif application.updater and application.updater.running:
+        await application.updater.stop()
+    if not application.running:
+        return
+    # Application.stop() processes the queued updates and waits for the handlers
+    stopping = asyncio.ensure_future(application.stop())
+    done, _ = await asyncio.wait({stopping}, timeout=timeout)
+    if not done:
+        dropped = drop_queued_updates(application)
+        logger.error(f"Handlers still running after {timeout} s, {dropped} updates not processed: cancelling them")
+        tasks = [stopping] + update_tasks(application)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    elif stopping.exception():
+        logger.error(f"Error stopping the bot: {stopping.exception()}")
+    else:
+        logger.info("Updates in flight processed")
+
+def update_tasks(application):
+    """
+    Get the tasks of an Application processing updates: its update fetcher,
+    which also runs the handlers of updates processed one at a time, and the
+    tasks of updates processed concurrently. python-telegram-bot names them
+    "Application:<bot id>:...".
+
+    Args:
+        application: An initialized Application
+
+    Returns:
+        A list of asyncio.Task
+    """
+    prefix = f"Application:{application.bot.id}:"
+    return [task for task in asyncio.all_tasks() if task.get_name().startswith(prefix)]
+
+def drop_queued_updates(application):
+    """
+    Remove the updates that haven't started from the update queue, keeping
+    the stop marker put there by Application.stop().
+
+    Args:
+        application: The Application being stopped
+
+    Returns:
+        The number of updates removed
+    """
+    dropped = 0
+    markers = []
+    while True:
         try:
-            await asyncio.sleep(1)
-        except asyncio.CancelledError:
+            item = application.update_queue.get_nowait()
+        except asyncio.QueueEmpty:
             break
-    
-    # Proper shutdown
-    logger.info("Shutting down bot...")
-    await application.stop()
-    await application.shutdown()
+        application.update_queue.task_done()
+        if isinstance(item, Update):
+            dropped += 1
+        else:
+            markers.append(item)
+    for marker in markers:
+        application.update_queue.put_nowait(marker)
+    return dropped
 
 if __name__ == "__main__":
-    run_bot_forever()
\ No newline at end of file
+    run_bot_forever()
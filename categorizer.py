@@ -0,0 +1,283 @@
+"""
+Keyword based categorization of shopping list items.
+
+An item belongs to the first category, in declaration order, with a keyword
+that contains the item name or is contained in it. The keyword tables are
+compiled once into an Aho-Corasick automaton, which finds every keyword
+contained in the name in a single pass, and a table of all the keyword
+substrings, which finds the keywords containing the name with one lookup.
+Categorizing a name is therefore linear in its length, whatever the number
+of keywords.
+
+Users add the same few hundred names over and over, so results are also
+kept in a bounded LRU cache shared by every categorizer.
+"""
+
+import os
+import itertools
+import threading
+from collections import OrderedDict, deque
+
+DEFAULT_CATEGORY = "Altro"
+
+# Categorie con parole chiave associate, in ordine di priorità
+CATEGORY_KEYWORDS = {
+    "Frutta e Verdura": ["mela", "mele", "banana", "banane", "arancia", "arance", "carota", "carote", 
+                        "zucchina", "zucchine", "pomodoro", "pomodori", "insalata", "lattuga", "spinaci", 
+                        "fragola", "fragole", "kiwi", "pesca", "pesche", "melanzana", "melanzane", 
+                        "broccolo", "broccoli", "patata", "patate", "cipolla", "cipolle", "aglio", 
+                        "peperone", "peperoni", "funghi", "fungo", "sedano", "finocchio", "finocchi",
+                        "limone", "limoni", "zucca", "mango", "melone", "anguria", "verdura", "frutta"],
+
+    "Carne e Pesce": ["carne", "pollo", "tacchino", "maiale", "manzo", "bistecca", "hamburger", 
+                     "salsiccia", "salsicce", "pesce", "tonno", "salmone", "merluzzo", "acciughe", 
+                     "prosciutto", "salame", "bresaola", "speck", "mortadella", "pancetta", "wurstel",
+                     "cotoletta", "polpette", "gamberi", "calamari", "coscia", "petto", "fettina",
+                     "alici", "vongole", "cozze", "frutti di mare"],
+
+    "Latticini": ["latte", "formaggio", "formaggi", "mozzarella", "yogurt", "burro", "panna", 
+                 "ricotta", "parmigiano", "grana", "pecorino", "gorgonzola", "stracchino", 
+                 "scamorza", "mascarpone", "kefir", "brie", "caciotta", "uova", "uovo",
+                 "fiordilatte", "latticino", "latticini", "philadelphia", "crescenza",
+                 "fontina", "emmental", "asiago"],
+
+    "Pane e Cereali": ["pane", "pasta", "riso", "cereali", "farina", "cracker", "crackers", "grissini", 
+                       "pizza", "avena", "orzo", "farro", "quinoa", "cous cous", "mais", "muesli",
+                       "biscotti", "fette biscottate", "croissant", "brioche", "cornetto", "cornetti",
+                       "panino", "panini", "baguette", "piadina", "focaccia", "chapati", "tortilla"],
+
+    "Bevande": ["acqua", "succo", "tè", "tea", "the", "caffè", "caffe", "vino", "birra", "soda", 
+               "limonata", "aranciata", "cola", "energy drink", "tisana", "smoothie", "spremuta",
+               "bibita", "bibite", "bevanda", "bevande", "whisky", "vodka", "rum", "gin", "liquore",
+               "champagne", "spumante", "prosecco", "beverage", "gassosa", "chinotto"],
+
+    "Condimenti": ["sale", "pepe", "olio", "aceto", "spezia", "spezie", "erba", "erbe", "salsa", 
+                  "maionese", "ketchup", "senape", "zucchero", "tabasco", "soia", "pesto",
+                  "curry", "paprika", "origano", "basilico", "rosmarino", "timo", "cannella",
+                  "noce moscata", "zafferano", "curcuma", "condimento", "condimenti"],
+
+    "Surgelati": ["surgelato", "surgelati", "gelato", "gelati", "ghiacciolo", "ghiaccioli", 
+                 "verdure surgelate", "pesce surgelato", "pizza surgelata", "bastoncini", "sofficini",
+                 "congelato", "congelati", "frozen", "cubetti di ghiaccio"],
+
+    "Legumi e Frutta secca": ["legumi", "lenticchie", "ceci", "fagioli", "fave", "piselli", 
+                             "soia", "arachidi", "noci", "nocciole", "mandorle", "pistacchi", 
+                             "anacardi", "frutta secca", "semi", "tofu", "seitan", "tempeh",
+                             "lupini", "pinoli", "semi di zucca", "semi di girasole", "semi di lino",
+                             "castagne", "datteri", "albicocche secche", "prugne secche"],
+
+    "Snack e Dolci": ["biscotti", "cioccolato", "cioccolata", "caramelle", "caramella", "torta", 
+                     "merendine", "patatine", "snack", "dolci", "dolce", "wafer", "nutella", 
+                     "marmellata", "miele", "gelato", "budino", "crostata", "bombolone",
+                     "patatine", "chips", "noccioline", "barretta", "dessert", "cialda", "cono"],
+
+    "Prodotti da Forno": ["pane", "focaccia", "brioche", "cornetto", "biscotti", "torta", "crostata",
+                         "pizza", "panino", "panini", "grissini", "cracker", "fette biscottate",
+                         "piadina", "ciabatta", "baguette", "filone", "ciambella"],
+
+    "Prodotti per la Casa": ["detersivo", "sapone", "carta igienica", "fazzoletti", "asciugamani", 
+                            "tovaglioli", "piatti", "bicchieri", "posate", "spugna", "spugne", 
+                            "candeggina", "ammoniaca", "sgrassatore", "sacchetti", "lampadina", 
+                            "batterie", "pile", "scottex", "salviette", "fiammiferi"]
+}
+
+class CategoryCache:
+    """Bounded LRU cache of categorization results."""
+
+    def __init__(self, maxsize=4096):
+        """
+        Initialize the cache.
+
+        Args:
+            maxsize: Maximum number of cached results, 0 to disable the cache
+        """
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Get a cached result.
+
+        Args:
+            key: The cache key
+
+        Returns:
+            The cached category, or None if it isn't cached
+        """
+        with self._lock:
+            category = self._entries.get(key)
+            if category is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            return category
+
+    def put(self, key, category):
+        """
+        Cache a result, evicting the least recently used one if the cache is full.
+
+        Args:
+            key: The cache key
+            category: The category to cache
+        """
+        if not self.maxsize:
+            return
+        with self._lock:
+            self._entries[key] = category
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Drop every cached result."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Get statistics about the cache.
+
+        Returns:
+            A dict with size, hits, misses and hit rate
+        """
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+# Shared by every categorizer: keys include the version of the keyword table
+category_cache = CategoryCache(int(os.environ.get("CATEGORY_CACHE_SIZE", "4096")))
+
+# Version of each keyword table compiled so far: categorizers with the same
+# table share their cached results, a changed table gets a new version
+_table_versions = {}
+_next_version = itertools.count(1)
+_versions_lock = threading.Lock()
+
+class Categorizer:
+    """Categorize item names with a compiled keyword table."""
+
+    def __init__(self, categories, default=DEFAULT_CATEGORY, cache=category_cache):
+        """
+        Compile the keyword table.
+
+        Args:
+            categories: A dict mapping each category name to its keywords,
+                in priority order
+            default: Category of names that match no keyword
+            cache: The CategoryCache for the results, None to disable caching
+        """
+        self.default = default
+        self.cache = cache
+        self.update(categories)
+
+    def update(self, categories):
+        """
+        Replace the keyword table.
+
+        Cached results of the previous table are never returned again, as the
+        cache keys include the version of the table content.
+
+        Args:
+            categories: A dict mapping each category name to its keywords,
+                in priority order
+        """
+        names = list(categories)
+        # Category index used when nothing matches, after every real category
+        no_match = len(names)
+
+        # Trie of the keywords: transitions, and the best category of the
+        # keywords ending in each node
+        goto = [{}]
+        best = [no_match]
+        substrings = {}
+        for index, keywords in enumerate(categories.values()):
+            for keyword in keywords:
+                node = 0
+                for char in keyword:
+                    next_node = goto[node].get(char)
+                    if next_node is None:
+                        next_node = len(goto)
+                        goto[node][char] = next_node
+                        goto.append({})
+                        best.append(no_match)
+                    node = next_node
+                best[node] = min(best[node], index)
+                # Every substring of the keyword, the empty one included
+                for start in range(len(keyword) + 1):
+                    for end in range(start, len(keyword) + 1):
+                        substring = keyword[start:end]
+                        if index < substrings.get(substring, no_match):
+                            substrings[substring] = index
+
+        # Failure links, in breadth-first order so that a node's link is
+        # complete before its children's. A node also reports the keywords
+        # ending at its failure node, which are suffixes of its own.
+        fail_links = [0] * len(goto)
+        queue = deque(goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in goto[node].items():
+                fail = fail_links[node]
+                while fail and char not in goto[fail]:
+                    fail = fail_links[fail]
+                fail = goto[fail].get(char, 0)
+                fail_links[child] = fail if fail != child else 0
+                best[child] = min(best[child], best[fail_links[child]])
+                queue.append(child)
+
+        content = tuple((name, tuple(keywords)) for name, keywords in categories.items())
+        with _versions_lock:
+            version = _table_versions.setdefault(content, next(_next_version))
+        # Swapped in one assignment, so concurrent calls see either table
+        self._table = (version, names, goto, fail_links, best, substrings)
+
+    @property
+    def categories(self):
+        """The category names, in priority order."""
+        return self._table[1]
+
+    def categorize(self, name):
+        """
+        Get the category of an item name.
+
+        Args:
+            name: The item name, matched case-insensitively
+
+        Returns:
+            A string with the category name
+        """
+        name = name.lower().strip()
+        table = self._table
+        if self.cache is None:
+            return self._match(table, name)
+        key = (table[0], name)
+        category = self.cache.get(key)
+        if category is None:
+            category = self._match(table, name)
+            self.cache.put(key, category)
+        return category
+
+    def _match(self, table, name):
+        _, names, goto, fail_links, best_categories, substrings = table
+        no_match = len(names)
+        best = substrings.get(name, no_match)
+        node = 0
+        for char in name:
+            while node and char not in goto[node]:
+                node = fail_links[node]
+            node = goto[node].get(char, 0)
+            if best_categories[node] < best:
+                best = best_categories[node]
+        return names[best] if best < no_match else self.default
+
+
+# Compiled once for the whole process
+categorizer = Categorizer(CATEGORY_KEYWORDS)
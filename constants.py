@@ -30,6 +30,7 @@ HELP_MSG = """
 
 /rimuovi [numero] - Rimuovi un articolo dalla lista usando il suo numero
   • Esempio: `/rimuovi 1`
+  • Più articoli insieme: `/rimuovi 1,3,5-7`
 
 /svuota - Cancella l'intera lista
 
@@ -47,10 +48,14 @@ HELP_MSG = """
 
 # Shopping list messages
 ITEM_ADDED_MSG = "✅ \"{item}\" aggiunto alla tua lista della spesa! (Quantità: {quantity})"
+ITEMS_ADDED_MSG = "✅ {count} articoli aggiunti alla tua lista della spesa:"
 LIST_EMPTY_MSG = "📝 La tua lista della spesa è vuota. Aggiungi qualcosa con /aggiungi [articolo]"
 LIST_HEADER_MSG = "📝 *La tua lista della spesa:*"
 ITEM_REMOVED_MSG = "🗑️ \"{item}\" rimosso dalla lista!"
+ITEMS_REMOVED_MSG = "🗑️ {count} articoli rimossi dalla lista: {items}"
 LIST_CLEARED_MSG = "🧹 La tua lista della spesa è stata svuotata!"
+LIST_FULL_MSG = "⚠️ La lista della spesa è piena: rimuovi qualche articolo prima di aggiungerne altri."
+LIST_CHANGED_MSG = "🔄 La lista è cambiata nel frattempo, ecco quella aggiornata."
 QUANTITY_UPDATED_MSG = "✏️ Quantità aggiornata per \"{item}\": {quantity}"
 
 # AI suggestion messages
@@ -93,5 +98,8 @@ STATE_WAITING_QUANTITY = "waiting_quantity"
 STATE_WAITING_REMOVE = "waiting_remove"
 STATE_WAITING_QUESTION = "waiting_question"
 
+# Update types handled by telegram_bot.py
+ALLOWED_UPDATES = ["message", "callback_query"]
+
 # Error message
 ERROR_MSG = "❌ Mi dispiace, c'è stato un errore. Riprova più tardi."
@@ -0,0 +1,218 @@
+"""
+Compact representation of a shopping list item.
+
+A three-key dict costs about 180 bytes plus its own copies of the quantity
+and category strings. Item keeps the same data in three slots: names and
+quantities are interned, so repeated values share one string, and the
+category is a small int index into a registry of category names.
+The quantity is also kept parsed (see quantity.py) next to its display text.
+
+Items and the lists holding them are never changed in place: a change
+builds a new item (Item.replace) and a new ListSnapshot, so a snapshot
+handed to a reader stays the same however long it is used.
+"""
+
+import sys
+import random
+import threading
+from collections.abc import Mapping
+from quantity import parse_quantity, format_quantity
+
+# Category names by id, and ids by name. Unknown categories are added on first use.
+_CATEGORY_NAMES = []
+_CATEGORY_IDS = {}
+_registry_lock = threading.Lock()
+
+def category_id(category):
+    """
+    Get the small int id of a category, registering it if it's new.
+
+    Args:
+        category: The category name, or None
+
+    Returns:
+        The category id
+    """
+    try:
+        return _CATEGORY_IDS[category]
+    except KeyError:
+        with _registry_lock:
+            if category not in _CATEGORY_IDS:
+                # Publish the id only once the name can be looked up
+                _CATEGORY_NAMES.append(category)
+                _CATEGORY_IDS[category] = len(_CATEGORY_NAMES) - 1
+            return _CATEGORY_IDS[category]
+
+# None means the item has no category
+category_id(None)
+
+# Default of Item.replace() for a field that doesn't change
+_UNCHANGED = object()
+
+_ID_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+def new_item_id():
+    """
+    Generate a short random item ID.
+
+    IDs are random rather than sequential so that processes sharing the
+    storage, and restarts, never hand out an ID that is still in use.
+    Callers check it against the IDs already in the list.
+
+    Returns:
+        A string of up to 6 base-36 digits
+    """
+    value = random.getrandbits(30)
+    digits = []
+    while True:
+        value, digit = divmod(value, 36)
+        digits.append(_ID_DIGITS[digit])
+        if not value:
+            return "".join(reversed(digits))
+
+class Item(Mapping):
+    """
+    A shopping list item.
+
+    It behaves like a read-only dict with the keys "name", "quantity" and
+    "category" (present only when set), so code written for dict items
+    keeps working: item["name"], item.get("category", "Altro"), dict(item).
+    The stable ID is only an attribute, and is stored as "id".
+    """
+
+    __slots__ = ("id", "name", "quantity", "amount", "_category")
+
+    KEYS = ("name", "quantity", "category")
+
+    def __init__(self, name, quantity="1", category=None, item_id=None):
+        self.id = item_id
+        self.name = sys.intern(name)
+        self.quantity = sys.intern(str(quantity))
+        # The parsed quantity, None if it isn't a number with a unit
+        self.amount = parse_quantity(self.quantity)
+        self._category = category_id(category)
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Create an item from its stored dict form.
+
+        Args:
+            data: A dict with "name" and optionally "quantity", "category" and "id"
+
+        Returns:
+            An Item
+        """
+        return cls(data["name"], data.get("quantity", "1"), data.get("category"), data.get("id"))
+
+    def to_dict(self):
+        """
+        Get the dict form of the item, used for storage and serialization.
+
+        Returns:
+            A new dict
+        """
+        data = {"name": self.name, "quantity": self.quantity}
+        if self._category:
+            data["category"] = _CATEGORY_NAMES[self._category]
+        if self.id is not None:
+            data["id"] = self.id
+        return data
+
+    def replace(self, quantity=None, amount=None, category=_UNCHANGED):
+        """
+        Get a copy of the item with some fields changed.
+
+        Args:
+            quantity: The new quantity as typed
+            amount: The new quantity as a quantity.Quantity, whose display
+                text is rebuilt
+            category: The new category
+
+        Returns:
+            A new Item with the same ID
+        """
+        item = Item.__new__(Item)
+        item.id = self.id
+        item.name = self.name
+        if amount is not None:
+            item.amount = amount
+            item.quantity = sys.intern(format_quantity(amount))
+        elif quantity is not None:
+            item.quantity = sys.intern(str(quantity))
+            item.amount = parse_quantity(item.quantity)
+        else:
+            item.quantity = self.quantity
+            item.amount = self.amount
+        item._category = self._category if category is _UNCHANGED else category_id(category)
+        return item
+
+    @property
+    def category(self):
+        return _CATEGORY_NAMES[self._category]
+
+    def __getitem__(self, key):
+        if key == "name":
+            return self.name
+        if key == "quantity":
+            return self.quantity
+        if key == "category" and self._category:
+            return _CATEGORY_NAMES[self._category]
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self.KEYS if self._category else self.KEYS[:2])
+
+    def __len__(self):
+        return 3 if self._category else 2
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+class ListSnapshot(tuple):
+    """
+    An immutable shopping list at one version.
+
+    Being a tuple, it can be read from any thread without locks while
+    writers publish newer snapshots of the same list.
+    """
+
+    def __new__(cls, items=(), version=0):
+        snapshot = super().__new__(cls, items)
+        snapshot.version = version
+        # Position of each item ID, built on first lookup
+        snapshot._positions = None
+        return snapshot
+
+    def position(self, item_id):
+        """
+        Get the position of an item by its ID.
+
+        Args:
+            item_id: The ID of the item
+
+        Returns:
+            The position, or None if the item isn't in the list
+        """
+        positions = self._positions
+        if positions is None:
+            # Built by whichever thread looks up first: every build is the same
+            positions = {item.id: position for position, item in enumerate(self)}
+            self._positions = positions
+        return positions.get(item_id)
+
+    def get_item(self, item_id):
+        """
+        Get an item by its ID.
+
+        Args:
+            item_id: The ID of the item
+
+        Returns:
+            The item, or None if it isn't in the list
+        """
+        position = self.position(item_id)
+        return None if position is None else self[position]
+
+    def __repr__(self):
+        return f"ListSnapshot({list(self)!r}, version={self.version})"
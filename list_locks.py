@@ -0,0 +1,110 @@
+"""
+Per-list locks for bot handlers processing updates concurrently.
+
+With concurrent update processing, a slow handler in one chat no longer
+blocks the others, but two updates for the same list could interleave at
+every await. Handlers hold the lock of a list while they read and change
+it, so the changes to a list keep the order of the updates. The replies are
+sent after releasing the lock: a slow send doesn't hold up the next change.
+
+ConversationHandler keeps the state of each conversation by chat and user,
+and is not safe when updates of the same conversation run concurrently: the
+answer to a prompt could be handled before the prompt set the state.
+ConversationOrderProcessor processes the updates of each chat and user one
+at a time, in order, and those of different conversations concurrently.
+"""
+
+import time
+import asyncio
+from contextlib import asynccontextmanager
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+class ListLocks:
+    """Asyncio locks by list_id, created on first use and dropped when unused."""
+
+    def __init__(self):
+        # list_id -> [lock, number of holders and waiters]
+        self._locks = {}
+
+        # Counters to see how often handlers of the same list collide
+        self.acquisitions = 0
+        self.contended = 0
+        self.wait_time = 0.0
+
+    @asynccontextmanager
+    async def hold(self, list_id):
+        """
+        Hold the lock of a list for the duration of an async with block.
+
+        Args:
+            list_id: The identifier of the list
+        """
+        entry = self._locks.get(list_id)
+        if entry is None:
+            entry = self._locks[list_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            lock = entry[0]
+            if lock.locked():
+                self.contended += 1
+                start = time.perf_counter()
+                await lock.acquire()
+                self.wait_time += time.perf_counter() - start
+            else:
+                await lock.acquire()
+            self.acquisitions += 1
+            try:
+                yield
+            finally:
+                lock.release()
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[list_id]
+
+    def stats(self):
+        """
+        Get statistics about the locks.
+
+        Returns:
+            A dict with the lists currently locked or waited for, acquisitions,
+            contended acquisitions and the average wait in milliseconds
+        """
+        return {
+            "active": len(self._locks),
+            "acquisitions": self.acquisitions,
+            "contended": self.contended,
+            "avg_wait_ms": self.wait_time * 1000 / self.contended if self.contended else 0.0,
+        }
+
+class ConversationOrderProcessor(BaseUpdateProcessor):
+    """Process updates concurrently, except those of the same chat and user, which keep their order."""
+
+    def __init__(self, max_concurrent_updates):
+        """
+        Initialize the processor.
+
+        Args:
+            max_concurrent_updates: The maximum number of updates processed at once.
+                Updates waiting for an earlier one of their conversation count too.
+        """
+        super().__init__(max_concurrent_updates)
+        # One lock per conversation, the key ConversationHandler uses by default
+        self.conversations = ListLocks()
+
+    async def do_process_update(self, update, coroutine):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        user = update.effective_user if isinstance(update, Update) else None
+        if chat is None and user is None:
+            # Not part of a conversation
+            await coroutine
+            return
+        async with self.conversations.hold((chat.id if chat else None, user.id if user else None)):
+            await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
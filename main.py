@@ -6,11 +6,13 @@ from flask import Flask, render_template, jsonify
 from telegram import Update
 from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes, MessageHandler, filters
 
-from shopping_list import ShoppingList
+from shopping_list import parse_item_numbers
+from state_server import create_async_shopping_list
 from ai_assistant import AIAssistant
+from webhook import webhook_config, run_webhook
 from constants import (
     START_MSG, HELP_MSG, ITEM_ADDED_MSG, LIST_EMPTY_MSG, 
-    LIST_HEADER_MSG, ITEM_REMOVED_MSG, LIST_CLEARED_MSG,
+    LIST_HEADER_MSG, ITEM_REMOVED_MSG, ITEMS_REMOVED_MSG, LIST_CLEARED_MSG,
     SUGGEST_RESPONSE_MSG, ERROR_MSG
 )
 
@@ -46,7 +48,9 @@ logging.basicConfig(level=logging.INFO,
 logger = logging.getLogger(__name__)
 
 # Initialize shopping list manager and AI assistant
-shopping_list = ShoppingList()
+# Writes happen on a background thread so handlers never block the event loop
+# With STATE_SOCKET set, the lists live in the shared state server (state_server.py)
+shopping_list = create_async_shopping_list(background_writes=True)
 ai_assistant = AIAssistant()
 
 # Create Flask app
@@ -96,13 +100,11 @@ async def add_item(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
     
     item = " ".join(context.args)
-    success, item_name, quantity, category = shopping_list.add_item(chat_id, item, user_id)
+    success, item_name, quantity, category = await shopping_list.add_item(chat_id, item, user_id)
     
     if success:
-        if quantity:
-            message = f"{ITEM_ADDED_MSG.format(item=item_name)} ({quantity})\n\n_{list_type}_"
-        else:
-            message = f"{ITEM_ADDED_MSG.format(item=item_name)}\n\n_{list_type}_"
+        # The message already shows the quantity
+        message = f"{ITEM_ADDED_MSG.format(item=item_name, quantity=quantity or '1')}\n\n_{list_type}_"
         await update.message.reply_text(message, parse_mode="Markdown")
     else:
         message = f"Non sono riuscito ad aggiungere l'articolo.\n\n_{list_type}_"
@@ -112,7 +114,7 @@ async def show_list(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Display the current shopping list."""
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
-    items = shopping_list.get_items(chat_id, user_id)
+    items = await shopping_list.get_items(chat_id, user_id)
     
     # Get list type (group or personal)
     list_type = shopping_list.get_list_type(chat_id)
@@ -181,19 +183,26 @@ async def remove_item(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         await update.message.reply_text(message, parse_mode="Markdown")
         return
     
-    try:
-        index = int(context.args[0]) - 1
-        removed_item = shopping_list.remove_item(chat_id, index, user_id)
-        
-        if removed_item:
-            message = f"{ITEM_REMOVED_MSG.format(item=removed_item)}\n\n_{list_type}_"
-            await update.message.reply_text(message, parse_mode="Markdown")
-        else:
-            message = f"Non ho trovato questo articolo nella tua lista.\n\n_{list_type}_"
-            await update.message.reply_text(message, parse_mode="Markdown")
-    except (ValueError, IndexError):
+    # One or more numbers and ranges, e.g. /rimuovi 1,3,5-7
+    items = await shopping_list.get_items(chat_id, user_id)
+    numbers = parse_item_numbers(" ".join(context.args), len(items))
+    if not numbers:
         message = f"Per favore, inserisci un numero valido. Usa /lista per vedere i numeri degli articoli.\n\n_{list_type}_"
         await update.message.reply_text(message, parse_mode="Markdown")
+        return
+    
+    removed_items = await shopping_list.remove_items(chat_id, [items[number - 1].id for number in numbers], user_id)
+    
+    if len(removed_items) == 1:
+        message = f"{ITEM_REMOVED_MSG.format(item=removed_items[0]['name'])}\n\n_{list_type}_"
+        await update.message.reply_text(message, parse_mode="Markdown")
+    elif removed_items:
+        names = ", ".join(item["name"] for item in removed_items)
+        message = f"{ITEMS_REMOVED_MSG.format(count=len(removed_items), items=names)}\n\n_{list_type}_"
+        await update.message.reply_text(message, parse_mode="Markdown")
+    else:
+        message = f"Non ho trovato questo articolo nella tua lista.\n\n_{list_type}_"
+        await update.message.reply_text(message, parse_mode="Markdown")
 
 async def clear_list(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Clear the entire shopping list."""
@@ -203,7 +212,7 @@ async def clear_list(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     # Get list type (group or personal)
     list_type = shopping_list.get_list_type(chat_id)
     
-    shopping_list.clear_list(chat_id, user_id)
+    await shopping_list.clear_list(chat_id, user_id)
     message = f"{LIST_CLEARED_MSG}\n\n_{list_type}_"
     await update.message.reply_text(message, parse_mode="Markdown")
 
@@ -211,7 +220,7 @@ async def suggest(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Get AI-powered suggestions based on the current shopping list."""
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
-    items = shopping_list.get_items(chat_id, user_id)
+    items = await shopping_list.get_items(chat_id, user_id)
     item_names = [item["name"] for item in items]  # Extract just the names for AI
     
     # Get list type (group or personal)
@@ -237,7 +246,7 @@ async def ai_help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Get AI assistance with shopping list or meal planning."""
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
-    items = shopping_list.get_items(chat_id, user_id)
+    items = await shopping_list.get_items(chat_id, user_id)
     item_names = [item["name"] for item in items]  # Extract just the names for AI
     
     # Get list type (group or personal)
@@ -270,7 +279,7 @@ async def categorize(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     """Categorize items in the shopping list."""
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
-    items = shopping_list.get_items(chat_id, user_id)
+    items = await shopping_list.get_items(chat_id, user_id)
     item_names = [item["name"] for item in items]  # Extract just the names for AI
     
     # Get list type (group or personal)
@@ -296,7 +305,7 @@ async def meal_plan(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Generate a meal plan based on items in the shopping list."""
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
-    items = shopping_list.get_items(chat_id, user_id)
+    items = await shopping_list.get_items(chat_id, user_id)
     item_names = [item["name"] for item in items]  # Extract just the names for AI
     
     # Get list type (group or personal)
@@ -392,9 +401,14 @@ def main():
     logger.info("The bot is running. Please interact with it through Telegram.")
     logger.info("Bot feature checks are available through the web interface.")
     
-    # Start the Bot
-    logger.info("Starting bot polling...")
-    application.run_polling(allowed_updates=["message"])
+    # Start the Bot, in webhook mode with WEBHOOK_URL or BOT_MODE=webhook
+    config = webhook_config()
+    if config:
+        logger.info("Starting bot webhook...")
+        run_webhook(application, config, allowed_updates=["message"])
+    else:
+        logger.info("Starting bot polling...")
+        application.run_polling(allowed_updates=["message"])
 
 def start_bot_thread():
     """Start the Telegram bot in a separate process."""
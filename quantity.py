@@ -0,0 +1,90 @@
+"""
+Structured quantities for shopping list items.
+
+Quantities are typed by users as free text ("1,5 kg", "500g", "3 pz"). They
+are parsed once into a (value, unit) pair in a canonical unit, grams for
+weights, millilitres for volumes and pieces for counts, so that merging two
+quantities is a plain sum. The text shown to users is rebuilt from the pair.
+"""
+
+import re
+from functools import lru_cache
+from typing import NamedTuple
+
+# A number with an optional decimal part, then an optional unit
+QUANTITY_PATTERN = re.compile(r'^(\d+(?:[,.]\d+)?)\s*([^\W\d_]*)\.?$')
+
+# Unit as typed -> (canonical unit, factor)
+UNITS = {
+    "mg": ("g", 0.001), "g": ("g", 1), "gr": ("g", 1), "grammo": ("g", 1), "grammi": ("g", 1),
+    "hg": ("g", 100), "etto": ("g", 100), "etti": ("g", 100),
+    "kg": ("g", 1000), "chilo": ("g", 1000), "chili": ("g", 1000),
+    "ml": ("ml", 1), "cl": ("ml", 10), "dl": ("ml", 100),
+    "l": ("ml", 1000), "lt": ("ml", 1000), "litro": ("ml", 1000), "litri": ("ml", 1000),
+    "": ("pz", 1), "pz": ("pz", 1), "pezzo": ("pz", 1), "pezzi": ("pz", 1),
+}
+
+# Canonical unit -> larger unit used for display from 1000 up
+_DISPLAY_UNITS = {"g": "kg", "ml": "l"}
+
+class Quantity(NamedTuple):
+    """A quantity in a canonical unit."""
+
+    value: float
+    unit: str
+
+@lru_cache(maxsize=1024)
+def parse_quantity(text):
+    """
+    Parse a quantity string.
+
+    Units that are not weights, volumes or pieces ("2 bottiglie") are kept
+    as typed, so they can still be summed with the same unit.
+
+    Args:
+        text: The quantity as typed, e.g. "1,5 kg"
+
+    Returns:
+        A Quantity, or None if the text is not a number with an optional unit
+    """
+    match = QUANTITY_PATTERN.match(text.strip().lower())
+    if not match:
+        return None
+    amount, unit = match.groups()
+    unit, factor = UNITS.get(unit, (unit, 1))
+    return Quantity(float(amount.replace(',', '.')) * factor, unit)
+
+def _format_number(value):
+    return f"{value:.3f}".rstrip("0").rstrip(".").replace(".", ",")
+
+def format_quantity(quantity):
+    """
+    Get the display string of a quantity.
+
+    Args:
+        quantity: A Quantity
+
+    Returns:
+        The string shown to users, e.g. "1,5 kg", or "1" for a single piece
+    """
+    value, unit = quantity
+    if unit == "pz" and value == 1:
+        return "1"
+    if unit in _DISPLAY_UNITS and value >= 1000:
+        return f"{_format_number(value / 1000)} {_DISPLAY_UNITS[unit]}"
+    return f"{_format_number(value)} {unit}"
+
+def add_quantities(first, second):
+    """
+    Sum two quantities.
+
+    Args:
+        first: A Quantity or None
+        second: A Quantity or None
+
+    Returns:
+        The total, or None if either is unknown or the units differ
+    """
+    if first is None or second is None or first.unit != second.unit:
+        return None
+    return Quantity(first.value + second.value, first.unit)
@@ -0,0 +1,330 @@
+"""
+Outbound message scheduler for the Telegram bot.
+
+Handlers call reply_text, edit_text and delete directly. Telegram allows
+about 30 messages per second overall, about one per second in a chat and
+20 per minute in a group; above that it answers with RetryAfter errors.
+SendScheduler is a telegram.ext rate limiter, so every Bot API request
+of the application goes through it:
+
+- requests for a chat wait in that chat's queue, in order, and at most one
+  per chat is in flight;
+- a global token bucket and one bucket per chat decide when the next one
+  can go, and among the chats that can send, interactive replies go before
+  notifications;
+- an edit of a message that is still queued replaces the queued edit of the
+  same message, since only the last text would be visible anyway;
+- on RetryAfter the chat is paused for the time Telegram asks, and the
+  request is sent again.
+
+Requests without a chat (answerCallbackQuery, getMe, setWebhook) are sent
+right away.
+"""
+
+import os
+import asyncio
+import logging
+import itertools
+from collections import deque
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+logger = logging.getLogger(__name__)
+
+# Priorities, passed as rate_limit_args; lower goes first. Not 0: PTB drops falsy rate_limit_args
+PRIORITY_INTERACTIVE = 1
+PRIORITY_NOTIFICATION = 2
+
+# Endpoints that don't answer the user and can wait for the replies of other chats
+NOTIFICATION_ENDPOINTS = frozenset({"deleteMessage", "sendChatAction"})
+
+# Edits whose queued request a newer one of the same message replaces
+COALESCED_ENDPOINTS = frozenset({"editMessageText", "editMessageCaption", "editMessageReplyMarkup"})
+
+# Number of recent requests the latency percentiles are computed on
+LATENCY_SAMPLES = 1000
+
+class TokenBucket:
+    """Allow rate events per second on average, and bursts of up to burst events."""
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def delay(self, now):
+        """
+        Get how long until a token is available.
+
+        Args:
+            now: The current time of the event loop
+
+        Returns:
+            Seconds to wait, 0 if a token is available
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def full(self, now):
+        return self.delay(now) == 0 and self.tokens >= self.burst
+
+class _Request:
+    """A queued Bot API request and the callers waiting for its result."""
+
+    __slots__ = ("callback", "args", "kwargs", "endpoint", "message_id", "priority", "sequence",
+                 "futures", "queued", "retries")
+
+    def __init__(self, callback, args, kwargs, endpoint, message_id, priority, sequence, queued):
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+        self.endpoint = endpoint
+        self.message_id = message_id
+        self.priority = priority
+        self.sequence = sequence
+        self.futures = [asyncio.get_running_loop().create_future()]
+        self.queued = queued
+        self.retries = 0
+
+class _Chat:
+    """The queue and rate limit of one chat."""
+
+    __slots__ = ("requests", "bucket", "busy", "paused_until")
+
+    def __init__(self, bucket):
+        self.requests = deque()
+        self.bucket = bucket
+        # A request of the chat is being sent
+        self.busy = False
+        self.paused_until = 0.0
+
+class SendScheduler(BaseRateLimiter):
+    """Queue the Bot API requests of each chat and send them within Telegram's limits."""
+
+    def __init__(self, global_rate=30.0, chat_rate=1.0, group_rate=20 / 60, chat_burst=3, max_retries=5):
+        """
+        Initialize the scheduler.
+
+        Args:
+            global_rate: Messages per second to all chats
+            chat_rate: Messages per second to a private chat
+            group_rate: Messages per second to a group
+            chat_burst: Messages a chat can receive at once before its rate applies
+            max_retries: Times a request is sent again after RetryAfter before the error is raised
+        """
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._chats = {}
+        self._global = None
+        self._sequence = itertools.count()
+        self._wakeup = None
+        self._task = None
+
+        # Counters and recent latencies, see stats()
+        self.queued = 0
+        self.max_queued = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.retries = 0
+        self._waits = deque(maxlen=LATENCY_SAMPLES)
+        self._latencies = deque(maxlen=LATENCY_SAMPLES)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        """Stop the scheduler. Requests still queued fail with CancelledError."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for chat in self._chats.values():
+            for request in chat.requests:
+                for future in request.futures:
+                    future.cancel()
+        self._chats.clear()
+        self.queued = 0
+        logger.info(f"Send scheduler stopped: {self.stats()}")
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if chat_id is None:
+            return await self._send_now(callback, args, kwargs)
+        loop = asyncio.get_running_loop()
+        if self._task is None:
+            # No burst: Telegram counts the messages of any one second
+            self._global = TokenBucket(self.global_rate, 1, loop.time())
+            self._wakeup = asyncio.Event()
+            self._task = loop.create_task(self._run())
+        try:
+            # Integer IDs may arrive as strings; @channel names stay strings
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            pass
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            is_group = not isinstance(chat_id, int) or chat_id < 0
+            rate = self.group_rate if is_group else self.chat_rate
+            chat = self._chats[chat_id] = _Chat(TokenBucket(rate, self.chat_burst, loop.time()))
+
+        message_id = data.get("message_id")
+        if endpoint in COALESCED_ENDPOINTS and message_id is not None:
+            for queued in chat.requests:
+                if queued.endpoint == endpoint and queued.message_id == message_id:
+                    # The newer edit takes the place of the queued one, and its callers get its result
+                    queued.callback, queued.args, queued.kwargs = callback, args, kwargs
+                    future = loop.create_future()
+                    queued.futures.append(future)
+                    self.coalesced += 1
+                    return await future
+
+        if rate_limit_args is None:
+            rate_limit_args = PRIORITY_NOTIFICATION if endpoint in NOTIFICATION_ENDPOINTS else PRIORITY_INTERACTIVE
+        request = _Request(callback, args, kwargs, endpoint, message_id, rate_limit_args,
+                           next(self._sequence), loop.time())
+        chat.requests.append(request)
+        self.queued += 1
+        self.max_queued = max(self.max_queued, self.queued)
+        self._wakeup.set()
+        return await request.futures[0]
+
+    async def _send_now(self, callback, args, kwargs):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                self.retries += 1
+                logger.info(f"Rate limit hit, retrying in {e.retry_after} s")
+                await asyncio.sleep(e.retry_after)
+
+    async def _run(self):
+        """Send the queued requests as soon as the rate limits allow."""
+        loop = asyncio.get_running_loop()
+        while True:
+            self._wakeup.clear()
+            now = loop.time()
+            chosen = None
+            wait = None
+            for chat_id, chat in list(self._chats.items()):
+                if chat.busy:
+                    continue
+                if not chat.requests:
+                    if chat.bucket.full(now) and chat.paused_until <= now:
+                        # Nothing left to limit
+                        del self._chats[chat_id]
+                    continue
+                delay = max(chat.paused_until - now, chat.bucket.delay(now))
+                if delay > 0:
+                    wait = delay if wait is None else min(wait, delay)
+                    continue
+                head = chat.requests[0]
+                if chosen is None or (head.priority, head.sequence) < (chosen.requests[0].priority,
+                                                                        chosen.requests[0].sequence):
+                    chosen = chat
+            if chosen is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            delay = self._global.delay(now)
+            if delay > 0:
+                # Choose again afterwards: a more urgent request may have arrived
+                await asyncio.sleep(delay)
+                continue
+            self._global.take()
+            chosen.bucket.take()
+            chosen.busy = True
+            request = chosen.requests.popleft()
+            self.queued -= 1
+            loop.create_task(self._send(chosen, request))
+
+    async def _send(self, chat, request):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        try:
+            result = await request.callback(*request.args, **request.kwargs)
+        except RetryAfter as e:
+            # The pause holds for the next requests of the chat even if this one gives up
+            chat.paused_until = loop.time() + e.retry_after
+            if request.retries < self.max_retries:
+                request.retries += 1
+                self.retries += 1
+                logger.info(f"Rate limit hit on {request.endpoint}, pausing the chat for {e.retry_after} s")
+                # Sent again first, before the later requests of the chat
+                chat.requests.appendleft(request)
+                self.queued += 1
+                return
+            self._finish(request, error=e)
+        except Exception as e:
+            self._finish(request, error=e)
+        else:
+            self.sent += 1
+            self._waits.append(start - request.queued)
+            self._latencies.append(loop.time() - request.queued)
+            self._finish(request, result=result)
+        finally:
+            chat.busy = False
+            self._wakeup.set()
+
+    @staticmethod
+    def _finish(request, result=None, error=None):
+        for future in request.futures:
+            if future.done():
+                # The caller was cancelled
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def stats(self):
+        """
+        Get statistics about the outbound requests.
+
+        Returns:
+            A dict with the requests queued now and at most, sent, coalesced and
+            retried, and the 50th and 95th percentile in milliseconds of the time
+            spent in the queue and until the request was done
+        """
+        def percentile(values, fraction):
+            if not values:
+                return 0.0
+            return sorted(values)[int(len(values) * fraction)] * 1000
+
+        return {
+            "queued": self.queued,
+            "max_queued": self.max_queued,
+            "chats": len(self._chats),
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "retries": self.retries,
+            "wait_p50_ms": percentile(self._waits, 0.5),
+            "wait_p95_ms": percentile(self._waits, 0.95),
+            "latency_p50_ms": percentile(self._latencies, 0.5),
+            "latency_p95_ms": percentile(self._latencies, 0.95),
+        }
+
+def create_send_scheduler():
+    """
+    Create the scheduler configured by the environment.
+
+    BOT_SEND_RATE is the overall rate, 0 to send without a scheduler, and
+    BOT_CHAT_SEND_RATE the rate of a private chat.
+
+    Returns:
+        A SendScheduler, or None
+    """
+    global_rate = float(os.environ.get("BOT_SEND_RATE", "30"))
+    if global_rate <= 0:
+        return None
+    return SendScheduler(global_rate=global_rate, chat_rate=float(os.environ.get("BOT_CHAT_SEND_RATE", "1")))
@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+"""
+Chat-sharded bot runtime: one dispatcher process and N worker processes.
+
+A single bot process handles every chat on one event loop, under one GIL.
+Here the dispatcher only receives the updates, by polling or webhook, reads
+the chat and user of each one from its JSON and sends it to the worker
+owning that list: crc32(list_id) % N. Every worker runs the telegram_bot.py
+Application with a ShoppingList of its own, so the lists of a shard are only
+ever loaded and changed by one process, and updates of the same list reach
+it in the order they arrived. Rendering, categorization and the rest of the
+handlers' work spread over N cores.
+
+Workers share the storage files. With more than one worker the sharded or
+sqlite backend is required, since they keep the writes of each list apart:
+with the single JSON document of the other backends every change of a worker
+would rewrite the lists of all the others. STATE_SOCKET is ignored by the
+workers, since a shared state server would put every list back behind a
+single process.
+
+Usage: TELEGRAM_TOKEN=... BOT_WORKERS=4 STORAGE_BACKEND=sharded python sharded_bot.py
+"""
+
+import os
+import sys
+import zlib
+import queue
+import signal
+import asyncio
+import logging
+import threading
+import multiprocessing
+import aiohttp
+from telegram import Bot, Update
+from shopping_list import ShoppingList
+from webhook import WebhookServer, webhook_config
+from constants import ALLOWED_UPDATES
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_API_URL = "https://api.telegram.org/bot{token}/{method}"
+
+# Seconds a getUpdates request waits for new updates
+POLL_TIMEOUT = 50
+
+# Seconds to wait before calling the Bot API again after an error
+RETRY_DELAY = 5
+
+# Storage backends several workers can write to without rewriting each other's lists
+SHARED_BACKENDS = ("sharded", "sqlite")
+
+def shard_of(list_id, workers):
+    """
+    Get the worker owning a list.
+
+    crc32 rather than hash(), which is salted differently in every process.
+
+    Args:
+        list_id: The identifier of the list
+        workers: The number of workers
+
+    Returns:
+        The worker index, from 0 to workers - 1
+    """
+    return zlib.crc32(list_id.encode()) % workers
+
+def run_worker(token, shard, workers, updates, request_factory=None):
+    """
+    Entry point of a worker process: run the bot on the updates of one shard.
+
+    Args:
+        token: The Telegram bot token
+        shard: The index of the worker
+        workers: The number of workers
+        updates: The multiprocessing.Queue of update dicts, None to stop
+        request_factory: Callable creating the telegram.request.BaseRequest
+            used to call the Bot API, an HTTPXRequest by default
+    """
+    # The dispatcher stops the workers once it stopped receiving, so that
+    # they finish the updates already sent to them
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    os.environ.pop("STATE_SOCKET", None)
+    # Telegram's overall limit is for the bot: each worker gets its share.
+    # Chats are in one shard only, so their own limits stay as they are.
+    send_rate = float(os.environ.get("BOT_SEND_RATE", "30"))
+    os.environ["BOT_SEND_RATE"] = str(send_rate / workers)
+    # Imported here: the module creates the ShoppingList of this process
+    import telegram_bot
+    application = telegram_bot.build_application(token, request_factory() if request_factory else None)
+    logger.info(f"Worker {shard} started")
+    try:
+        asyncio.run(_serve_shard(application, updates))
+    finally:
+        telegram_bot.shopping_list.close()
+        logger.info(f"Worker {shard} stopped")
+
+async def _serve_shard(application, updates):
+    """Feed the updates of the queue to the application until the stop marker."""
+    loop = asyncio.get_running_loop()
+    finished = asyncio.Event()
+
+    def read():
+        parent = multiprocessing.parent_process()
+        while True:
+            try:
+                data = updates.get(timeout=1.0)
+            except queue.Empty:
+                if parent is not None and not parent.is_alive():
+                    logger.error("Dispatcher gone, stopping")
+                    break
+                continue
+            if data is None:
+                break
+            try:
+                update = Update.de_json(data, application.bot)
+            except (ValueError, TypeError, KeyError) as e:
+                logger.error(f"Invalid update {data.get('update_id')}: {e}")
+                continue
+            loop.call_soon_threadsafe(application.update_queue.put_nowait, update)
+        # Runs after every update put on the queue above
+        loop.call_soon_threadsafe(finished.set)
+
+    await application.initialize()
+    try:
+        await application.start()
+        threading.Thread(target=read, name="shard-reader", daemon=True).start()
+        await finished.wait()
+        # Processes the updates still queued before returning
+        await application.stop()
+    finally:
+        await application.shutdown()
+
+class ShardDispatcher:
+    """Route updates to worker processes by the list they are about."""
+
+    # The list of an update is found like ShoppingList does
+    _get_list_id = ShoppingList._get_list_id
+
+    def __init__(self, token, workers, request_factory=None):
+        """
+        Create the workers. They are started by start().
+
+        Args:
+            token: The Telegram bot token
+            workers: The number of worker processes
+            request_factory: Passed to the workers, see run_worker()
+
+        Raises:
+            ValueError: With more than one worker, if STORAGE_BACKEND isn't sharded or sqlite
+        """
+        backend = os.environ.get("STORAGE_BACKEND", "json").lower()
+        if workers > 1 and backend not in SHARED_BACKENDS:
+            raise ValueError(f"{workers} workers need STORAGE_BACKEND={' or '.join(SHARED_BACKENDS)}, "
+                             f"not {backend}")
+        self.token = token
+        self.workers = workers
+        # Used to register the webhook
+        self.bot = None
+        # Fresh interpreters: no event loop, threads or lists inherited from the dispatcher
+        context = multiprocessing.get_context("spawn")
+        self._queues = [context.Queue() for _ in range(workers)]
+        self._processes = [
+            context.Process(target=run_worker, args=(token, shard, workers, self._queues[shard], request_factory),
+                            name=f"bot-shard-{shard}")
+            for shard in range(workers)
+        ]
+
+        # Updates sent to each worker
+        self.dispatched = [0] * workers
+
+    def start(self):
+        """Start the worker processes."""
+        for process in self._processes:
+            process.start()
+        logger.info(f"Started {self.workers} bot workers")
+
+    def list_id_of(self, data):
+        """
+        Get the list an update is about, without parsing the whole update.
+
+        Args:
+            data: The update as received, a dict
+
+        Returns:
+            The list identifier, or None if the update has no chat or user
+        """
+        for key, value in data.items():
+            if key == "update_id" or not isinstance(value, dict):
+                continue
+            user = value.get("from") or value.get("user")
+            user_id = user.get("id") if user else None
+            # Callback queries carry the chat in their message
+            chat = value.get("chat") or (value.get("message") or {}).get("chat")
+            if chat:
+                return self._get_list_id(chat["id"], user_id)
+            if user_id is not None:
+                return self._get_list_id(user_id, user_id)
+            return None
+        return None
+
+    def dispatch(self, data):
+        """
+        Send an update to the worker owning its list.
+
+        Args:
+            data: The update as received, a dict
+
+        Returns:
+            The index of the worker
+        """
+        list_id = self.list_id_of(data)
+        if list_id is None:
+            # No list, so no order to keep
+            shard = data["update_id"] % self.workers
+        else:
+            shard = shard_of(list_id, self.workers)
+        self._queues[shard].put(data)
+        self.dispatched[shard] += 1
+        return shard
+
+    def stop(self, timeout=30.0):
+        """
+        Let the workers finish the updates dispatched so far, then wait for them.
+
+        Args:
+            timeout: Seconds to wait for each worker before terminating it
+        """
+        for updates in self._queues:
+            updates.put(None)
+        for process in self._processes:
+            if process.pid is None:
+                continue
+            process.join(timeout)
+            if process.is_alive():
+                logger.error(f"{process.name} didn't stop in {timeout} s, terminating it")
+                process.terminate()
+                process.join()
+        logger.info(f"Bot workers stopped, updates dispatched: {self.dispatched}")
+
+    def stats(self):
+        """
+        Get statistics about the dispatched updates.
+
+        Returns:
+            A dict with the number of workers, the updates sent to each and the workers alive
+        """
+        return {
+            "workers": self.workers,
+            "dispatched": list(self.dispatched),
+            "alive": sum(process.is_alive() for process in self._processes),
+        }
+
+    async def poll(self, stop_event, allowed_updates=None):
+        """
+        Receive the updates with getUpdates and dispatch them until stop_event is set.
+
+        The raw JSON is forwarded as is: the updates are parsed by the workers.
+
+        Args:
+            stop_event: An asyncio.Event that stops polling
+            allowed_updates: The update types to receive
+        """
+        offset = 0
+        timeout = aiohttp.ClientTimeout(total=POLL_TIMEOUT + 10)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            stopped = asyncio.ensure_future(stop_event.wait())
+            webhook_deleted = False
+            try:
+                while not stop_event.is_set():
+                    if webhook_deleted:
+                        call = self._call(session, "getUpdates", {
+                            "offset": offset, "timeout": POLL_TIMEOUT, "allowed_updates": allowed_updates,
+                        })
+                    else:
+                        # getUpdates is refused while a webhook is set
+                        call = self._call(session, "deleteWebhook")
+                    request = asyncio.ensure_future(call)
+                    await asyncio.wait({request, stopped}, return_when=asyncio.FIRST_COMPLETED)
+                    if not request.done():
+                        # Not confirmed by a later offset: Telegram sends them again
+                        request.cancel()
+                        break
+                    try:
+                        updates = request.result()
+                    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, RuntimeError) as e:
+                        action = "getting updates" if webhook_deleted else "deleting the webhook"
+                        logger.error(f"Error {action}: {e}")
+                        await asyncio.wait({stopped}, timeout=RETRY_DELAY)
+                        continue
+                    if not webhook_deleted:
+                        webhook_deleted = True
+                        logger.info("Polling for updates...")
+                        continue
+                    for data in updates:
+                        self.dispatch(data)
+                        offset = data["update_id"] + 1
+            finally:
+                stopped.cancel()
+            if offset:
+                # Confirm the last updates dispatched, as python-telegram-bot's
+                # Updater does when it stops: Telegram would send them again
+                # after a restart, and the items would be added twice
+                try:
+                    await self._call(session, "getUpdates", {
+                        "offset": offset, "timeout": 0, "limit": 1, "allowed_updates": allowed_updates,
+                    })
+                except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, RuntimeError) as e:
+                    logger.error(f"Error confirming the last updates: {e}")
+
+    async def _call(self, session, method, parameters=None):
+        url = TELEGRAM_API_URL.format(token=self.token, method=method)
+        async with session.post(url, json=parameters or {}) as response:
+            body = await response.json()
+        if not body.get("ok"):
+            raise RuntimeError(f"{method} failed: {body.get('description')}")
+        return body["result"]
+
+class _DispatchingWebhook(WebhookServer):
+    """Webhook server handing the updates to a ShardDispatcher."""
+
+    async def deliver(self, data):
+        self.application.dispatch(data)
+
+async def serve(dispatcher, allowed_updates=None, stop_event=None):
+    """
+    Run the dispatcher and its workers until stopped.
+
+    Args:
+        dispatcher: A ShardDispatcher, not started yet
+        allowed_updates: The update types to receive
+        stop_event: An asyncio.Event that stops the bot, by default one set by SIGINT and SIGTERM
+    """
+    loop = asyncio.get_running_loop()
+    if stop_event is None:
+        stop_event = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop_event.set)
+    # Before starting the workers: a wrong configuration stops here
+    config = webhook_config()
+    dispatcher.start()
+    try:
+        if config:
+            webhook = _DispatchingWebhook(dispatcher, config)
+            try:
+                if config.url:
+                    # Only needed to register the webhook
+                    async with Bot(dispatcher.token) as dispatcher.bot:
+                        await webhook.start(allowed_updates)
+                else:
+                    await webhook.start(allowed_updates)
+                await stop_event.wait()
+            finally:
+                await webhook.stop()
+        else:
+            await dispatcher.poll(stop_event, allowed_updates)
+    finally:
+        # Joining the workers blocks
+        await loop.run_in_executor(None, dispatcher.stop)
+
+def main():
+    logging.basicConfig(
+        format="%(asctime)s - %(processName)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+    )
+    token = os.environ.get("TELEGRAM_TOKEN")
+    if not token:
+        logger.error("TELEGRAM_TOKEN environment variable not set!")
+        return 1
+    workers = int(os.environ.get("BOT_WORKERS", "0")) or os.cpu_count() or 1
+    try:
+        dispatcher = ShardDispatcher(token, workers)
+    except ValueError as e:
+        logger.error(str(e))
+        return 1
+    asyncio.run(serve(dispatcher, ALLOWED_UPDATES))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,31 +1,603 @@
 import json
 import os
 import re
-from storage import Storage
+import time
+import random
+import atexit
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from categorizer import categorizer
+from item import Item, ListSnapshot, new_item_id
+from quantity import parse_quantity, add_quantities
+from storage import create_storage
+from write_behind import WriteBehind
+
+logger = logging.getLogger(__name__)
+
+# Common Italian quantity patterns for the text of an added item
+# Pattern 1: "2 kg di patate" (quantità + unità + "di" + nome)
+QUANTITY_UNIT_NAME_PATTERN = re.compile(r'^(\d+(?:[,.]\d+)?)\s*([a-zA-Z]*)\s+(?:di\s+)(.+)$')
+# Pattern 2: "3 patate" (quantità + nome)
+QUANTITY_NAME_PATTERN = re.compile(r'^(\d+(?:[,.]\d+)?)\s+(.+)$')
+# Pattern 3: "patate (2kg)" (nome + quantità tra parentesi)
+NAME_QUANTITY_PATTERN = re.compile(r'^(.+?)\s*\((\d+(?:[,.]\d+)?\s*[a-zA-Z]*)\)$')
+# Separators between the items of a pasted list: new lines, semicolons, commas
+# that are not decimal commas, and the word "e"
+ITEM_SEPARATOR_PATTERN = re.compile(r'\s*(?:[\n;]|(?<!\d),|,(?!\d)|\s[eE]\s)\s*')
+# Item numbers and ranges as typed with /rimuovi: "1,3,5-7"
+ITEM_NUMBERS_PATTERN = re.compile(r'^(\d+)(?:-(\d+))?$')
+
+def split_items(text):
+    """
+    Split a pasted shopping list into the texts of its items.
+
+    Args:
+        text: e.g. "pane, latte, 2 kg di patate e mele (6)"
+
+    Returns:
+        A list of item texts, stripped and without empty ones
+    """
+    return [part.strip() for part in ITEM_SEPARATOR_PATTERN.split(text) if part.strip()]
+
+def parse_item_numbers(text, count):
+    """
+    Parse item numbers and ranges, as shown to users (starting from 1).
+
+    Args:
+        text: e.g. "1,3,5-7" or "2 4"
+        count: The number of items in the list
+
+    Returns:
+        The sorted numbers without duplicates, or None if the text is not
+        valid or a number is not in the list
+    """
+    numbers = set()
+    for part in re.split(r'[,;\s]+', re.sub(r'\s*-\s*', '-', text.strip())):
+        if not part:
+            continue
+        match = ITEM_NUMBERS_PATTERN.match(part)
+        if not match:
+            return None
+        first = int(match.group(1))
+        last = int(match.group(2) or first)
+        if not 1 <= first <= last <= count:
+            return None
+        numbers.update(range(first, last + 1))
+    return sorted(numbers) or None
 
 class ShoppingList:
-    """Class to manage shopping lists for different users and groups."""
-
-    def __init__(self):
-        """Initialize the shopping list manager."""
-        self.storage = Storage("shopping_lists.json")
-        lists_data = self.storage.load() or {}
-
-        # Convert old format to new format if needed
-        self.lists = {}
-        for id_key, items in lists_data.items():
-            if isinstance(items, list):
-                # Convert old format (list of strings) to new format (list of dicts)
-                self.lists[id_key] = [{"name": item, "quantity": "1"} for item in items]
+    """
+    Class to manage shopping lists for different users and groups.
+
+    Every list in memory is an immutable ListSnapshot stamped with the list
+    version. Reads return the current snapshot without locking; writers,
+    one at a time, build the changed list and publish it as a new snapshot.
+
+    A cache hit doesn't wait for writers nor for their disk writes; a list
+    that is not in memory, or that another process changed, is read from
+    storage by the caller.
+
+    Copying makes every change O(n) in the size of the list: an update
+    takes about 13 us at 20 items, 36 us at 1000 and 180 us at 10000.
+    Lists are therefore bounded to max_items items, well above any real
+    shopping list, instead of using a chunked structure that every reader
+    would have to walk.
+    """
+
+    # Schema migrations in order: the version each one brings the stored
+    # lists to, and the method that converts a single list
+    MIGRATIONS = [
+        (1, "_convert_old_format"),
+        (2, "_repair_corrupted_data"),
+        (3, "_assign_item_ids"),
+    ]
+    SCHEMA_VERSION = 3
+
+    def __init__(self, flush_interval=None, flush_max_pending=None, cache_size=None, cache_idle=None,
+                 background_writes=None, max_items=None):
+        """
+        Initialize the shopping list manager.
+
+        Lists are loaded from storage on first access and kept in memory in
+        a bounded LRU cache.
+
+        Args:
+            flush_interval: Seconds changes may wait before being written. 0 writes
+                every change immediately. Defaults to STORAGE_FLUSH_INTERVAL or 0.
+            flush_max_pending: Number of pending changes that forces a write.
+                Defaults to STORAGE_FLUSH_MAX_PENDING or 100.
+            cache_size: Maximum number of lists kept in memory, 0 for no limit.
+                Defaults to SHOPPING_LIST_CACHE_SIZE or 10000.
+            cache_idle: Seconds after which an unused list is evicted, 0 to never
+                evict idle lists. Defaults to SHOPPING_LIST_CACHE_IDLE or 3600.
+            background_writes: Whether changes are written by a background thread
+                even when flush_interval is 0, so that callers running in an
+                event loop never wait for the disk. Defaults to
+                STORAGE_BACKGROUND_WRITES or False.
+            max_items: Maximum number of items in a list, 0 for no limit.
+                Defaults to SHOPPING_LIST_MAX_ITEMS or 1000.
+        """
+        if flush_interval is None:
+            flush_interval = float(os.environ.get("STORAGE_FLUSH_INTERVAL", "0"))
+        if flush_max_pending is None:
+            flush_max_pending = int(os.environ.get("STORAGE_FLUSH_MAX_PENDING", "100"))
+        if cache_size is None:
+            cache_size = int(os.environ.get("SHOPPING_LIST_CACHE_SIZE", "10000"))
+        if cache_idle is None:
+            cache_idle = float(os.environ.get("SHOPPING_LIST_CACHE_IDLE", "3600"))
+        if background_writes is None:
+            background_writes = os.environ.get("STORAGE_BACKGROUND_WRITES", "0") == "1"
+        if max_items is None:
+            max_items = int(os.environ.get("SHOPPING_LIST_MAX_ITEMS", "1000"))
+        self.max_items = max_items
+
+        self.storage = create_storage("shopping_lists.json", schema_version=self.SCHEMA_VERSION)
+        self._migrate()
+
+        # Lists currently in memory, least recently used first
+        self.lists = OrderedDict()
+        self._last_access = {}
+        # Position of the first item with each normalized name, and the item
+        # IDs in use, per list in memory. Only used by writers.
+        self._name_indexes = {}
+        self._id_sets = {}
+        self.cache_size = cache_size
+        self.cache_idle = cache_idle
+        self._cache_stats = {"hits": 0, "misses": 0, "evictions": 0, "loads": 0, "load_time": 0.0}
+
+        # Lists changed since they were last written, and a version per list
+        # that grows with every change. Versions only live in memory: they
+        # start from a random number in every process, so a version shown
+        # before a restart, or by another process, doesn't match by chance.
+        self._dirty = set()
+        self._versions = {}
+        # Lists other processes changed, not dropped yet because a writer was busy
+        self._stale = set()
+        self._first_version = random.getrandbits(30)
+        self._lock = threading.Lock()
+        # Keeps writes of the same list in order between the flusher and evictions
+        self._flush_lock = threading.Lock()
+        # Serializes the writers, which copy the current snapshot and publish a new one.
+        # Taken before _flush_lock and _lock.
+        self._write_lock = threading.RLock()
+        self._write_behind = None
+        if flush_interval > 0 or background_writes:
+            self._write_behind = WriteBehind(self._flush_dirty, flush_interval, flush_max_pending)
+        atexit.register(self.close)
+
+    def _get_list(self, list_id, create=False):
+        """
+        Get the current snapshot of a list, loading it from storage if it is
+        not in memory.
+
+        Args:
+            list_id: The identifier of the list
+            create: Whether to create the list if it doesn't exist
+
+        Returns:
+            The ListSnapshot, or None if it doesn't exist and create is False
+        """
+        now = time.monotonic()
+        self._refresh()
+        # Only the LRU bookkeeping is locked, so a cache hit doesn't wait for writers
+        with self._lock:
+            items = self.lists.get(list_id)
+            if items is not None:
+                self.lists.move_to_end(list_id)
+                self._last_access[list_id] = now
+                evict = self._eviction_candidate(now) is not None
+                self._cache_stats["hits"] += 1
+            else:
+                self._cache_stats["misses"] += 1
+        if items is None:
+            start = time.perf_counter()
+            stored = self.storage.load_list(list_id)
+            load_time = time.perf_counter() - start
+            with self._lock:
+                self._cache_stats["loads"] += 1
+                self._cache_stats["load_time"] += load_time
+            if stored is None and not create:
+                return None
+            loaded = [Item.from_dict(item) for item in stored] if stored is not None else []
+            # Items written without an ID, e.g. by an older version sharing the storage
+            ids = set()
+            for item in loaded:
+                if item.id is None or item.id in ids:
+                    item.id = self._new_id(ids)
+                ids.add(item.id)
+            with self._lock:
+                # Another thread may have loaded or changed the list meanwhile
+                items = self.lists.get(list_id)
+                if items is None:
+                    items = ListSnapshot(loaded, self._versions.get(list_id, self._first_version))
+                    self.lists[list_id] = items
+                self._last_access[list_id] = now
+                evict = self._eviction_candidate(now) is not None
+        if evict:
+            if self._write_behind is not None:
+                # Evicting takes the writers' locks and may write the list:
+                # left to the flusher thread, which evicts after every flush
+                self._write_behind.mark_dirty()
             else:
-                self.lists[id_key] = items
+                self._evict(now)
+        return items
+
+    def _refresh(self):
+        """
+        Drop the cached lists that another process changed in storage, so
+        they are loaded again on their next access.
+
+        A list with unwritten local changes is kept: its next write replaces
+        the other process's version of that list.
+
+        Readers don't wait for a writer of this process: while one holds the
+        writers' lock the lists are kept until the next call after it.
+        """
+        changed = self.storage.refresh()
+        if not changed and not self._stale:
+            return
+        with self._lock:
+            self._stale.update(changed)
+        if not self._write_lock.acquire(blocking=False):
+            return
+        try:
+            with self._lock:
+                changed, self._stale = self._stale, set()
+                for list_id in changed:
+                    if list_id in self.lists and list_id not in self._dirty:
+                        del self.lists[list_id]
+                        self._last_access.pop(list_id, None)
+                        self._name_indexes.pop(list_id, None)
+                        self._id_sets.pop(list_id, None)
+                        self._versions[list_id] = self._versions.get(list_id, self._first_version) + 1
+        finally:
+            self._write_lock.release()
+
+    def _evict(self, now):
+        """
+        Evict least recently used lists while the cache is over capacity or
+        they have been idle for too long.
+
+        Snapshots already handed to readers stay valid after their list is
+        evicted.
+
+        Args:
+            now: The current time.monotonic() value
+        """
+        while True:
+            with self._lock:
+                list_id = self._eviction_candidate(now)
+            if list_id is None:
+                return
+            with self._write_lock, self._flush_lock:
+                with self._lock:
+                    # Another thread may have evicted or used it meanwhile
+                    if self._eviction_candidate(now) != list_id:
+                        continue
+                    dirty = list_id in self._dirty
+                    items = self.lists[list_id]
+                # Flush the list before dropping it
+                if dirty and not self.storage.save_delta({list_id: self._copy_list(items)}):
+                    with self._lock:
+                        self.lists.move_to_end(list_id)
+                    return
+                with self._lock:
+                    self._dirty.discard(list_id)
+                    del self.lists[list_id]
+                    del self._last_access[list_id]
+                    self._name_indexes.pop(list_id, None)
+                    self._id_sets.pop(list_id, None)
+                    self._cache_stats["evictions"] += 1
+
+    def _eviction_candidate(self, now):
+        """
+        Get the least recently used list if it has to be evicted. Call with _lock held.
+
+        Args:
+            now: The current time.monotonic() value
 
-        # Ripulisci i dati corrotti
-        self._repair_corrupted_data()
+        Returns:
+            The identifier of the list, or None
+        """
+        if len(self.lists) <= 1:
+            return None
+        list_id = next(iter(self.lists))
+        over_capacity = self.cache_size and len(self.lists) > self.cache_size
+        idle = self.cache_idle and now - self._last_access[list_id] > self.cache_idle
+        return list_id if over_capacity or idle else None
+
+    def _name_index(self, list_id, items):
+        """
+        Get the index from normalized item name to position for a list in
+        memory, building it on first use.
 
-        # Save the converted data
-        if self.lists and self.lists != lists_data:
-            self.storage.save(self.lists)
+        Args:
+            list_id: The identifier of the list
+            items: The current items of the list
+
+        Returns:
+            A dict mapping each normalized name to the position of its first item
+        """
+        index = self._name_indexes.get(list_id)
+        if index is None:
+            index = {}
+            for position, item in enumerate(items):
+                index.setdefault(item.name.lower(), position)
+            self._name_indexes[list_id] = index
+        return index
+
+    def _id_set(self, list_id, items):
+        """
+        Get the set of item IDs in use in a list in memory, building it on first use.
+
+        Args:
+            list_id: The identifier of the list
+            items: The current items of the list
+
+        Returns:
+            The set of IDs
+        """
+        ids = self._id_sets.get(list_id)
+        if ids is None:
+            ids = {item.id for item in items}
+            self._id_sets[list_id] = ids
+        return ids
+
+    def _new_id(self, used_ids):
+        """
+        Generate an item ID that is not in use.
+
+        Args:
+            used_ids: The IDs already in use in the list
+
+        Returns:
+            A new item ID
+        """
+        item_id = new_item_id()
+        while item_id in used_ids:
+            item_id = new_item_id()
+        return item_id
+
+    def _unindex_item(self, list_id, items, position, item):
+        """
+        Update the indexes of a list after the item at position was removed.
+
+        Args:
+            list_id: The identifier of the list
+            items: The items of the list, without the removed one
+            position: The position the item was removed from
+            item: The removed item
+        """
+        ids = self._id_sets.get(list_id)
+        if ids is not None:
+            ids.discard(item.id)
+        index = self._name_indexes.get(list_id)
+        if index is None:
+            return
+        key = item.name.lower()
+        first = index.get(key) == position
+        if first:
+            del index[key]
+        # Shift the items after the removed one before looking for a duplicate:
+        # positions in items are already the shifted ones
+        for name, indexed in index.items():
+            if indexed > position:
+                index[name] = indexed - 1
+        if first:
+            # A later item with the same name becomes the first one
+            for later, other in enumerate(items[position:], start=position):
+                if other.name.lower() == key:
+                    index[key] = later
+                    break
+
+    def cache_stats(self):
+        """
+        Get statistics about the in-memory list cache.
+
+        Returns:
+            A dict with resident lists, hits, misses, hit rate, evictions and
+            the average load latency in milliseconds
+        """
+        with self._lock:
+            stats = dict(self._cache_stats)
+            resident = len(self.lists)
+        lookups = stats["hits"] + stats["misses"]
+        return {
+            "resident": resident,
+            "hits": stats["hits"],
+            "misses": stats["misses"],
+            "hit_rate": stats["hits"] / lookups if lookups else 0.0,
+            "evictions": stats["evictions"],
+            "avg_load_ms": stats["load_time"] * 1000 / stats["loads"] if stats["loads"] else 0.0,
+        }
+
+    def _migrate(self):
+        """
+        Bring the stored lists to SCHEMA_VERSION.
+
+        The schema version is recorded in the storage metadata, so every
+        migration runs once: on an up to date storage this only reads the
+        version. A failed migration is retried on the next start.
+        """
+        version = self.storage.get_meta("schema_version", 0)
+        if version >= self.SCHEMA_VERSION:
+            return
+        steps = [getattr(self, name) for target, name in self.MIGRATIONS if target > version]
+        start = time.perf_counter()
+        changed_lists = {}
+        for list_id in self.storage.list_ids():
+            stored = self.storage.load_list(list_id)
+            items = stored
+            for step in steps:
+                items = step(items)
+            if items != stored:
+                changed_lists[list_id] = items
+        if changed_lists and not self.storage.save_delta(changed_lists):
+            logger.error(f"Error migrating shopping lists to schema version {self.SCHEMA_VERSION}")
+            return
+        self.storage.set_meta("schema_version", self.SCHEMA_VERSION)
+        logger.info(f"Migrated shopping lists from schema version {version} to {self.SCHEMA_VERSION} "
+                    f"({len(changed_lists)} lists changed, {time.perf_counter() - start:.2f} s)")
+
+    def _convert_old_format(self, items):
+        """
+        Convert a list from the old format (list of strings) to the new one (list of dicts).
+
+        Args:
+            items: The stored list
+
+        Returns:
+            The converted list
+        """
+        if not isinstance(items, list):
+            return items
+        return [{"name": item, "quantity": "1"} if isinstance(item, str) else item
+                for item in items]
+
+    def _assign_item_ids(self, items):
+        """
+        Give every item of a list a stable ID, unique within the list.
+
+        Args:
+            items: The stored list
+
+        Returns:
+            The list with an "id" in every item
+        """
+        used_ids = {item["id"] for item in items if "id" in item}
+        if len(used_ids) == len(items):
+            return items
+        assigned = []
+        seen = set()
+        for item in items:
+            if "id" not in item or item["id"] in seen:
+                item = dict(item, id=self._new_id(used_ids))
+                used_ids.add(item["id"])
+            seen.add(item["id"])
+            assigned.append(item)
+        return assigned
+
+    def _save(self, list_id, items, change=None):
+        """
+        Publish the new items of a list as its current snapshot and persist
+        them, immediately or through the write-behind flusher.
+
+        Args:
+            list_id: The identifier of the list that changed
+            items: The new items of the list
+            change: Optional (operation, index) tuple describing a single-item change
+        """
+        with self._lock:
+            version = self._versions.get(list_id, self._first_version) + 1
+            self._versions[list_id] = version
+            snapshot = ListSnapshot(items, version)
+            self.lists[list_id] = snapshot
+            self._last_access.setdefault(list_id, time.monotonic())
+            self._dirty.add(list_id)
+        if self._write_behind is not None:
+            self._write_behind.mark_dirty()
+        elif self.storage.save_list(list_id, self._copy_list(snapshot), change):
+            with self._lock:
+                self._dirty.discard(list_id)
+
+    def _copy_list(self, items):
+        """
+        Get a list in the plain dict form written to storage.
+
+        Args:
+            items: A ListSnapshot
+
+        Returns:
+            A new list of dicts
+        """
+        return [item.to_dict() for item in items]
+
+    def _flush_dirty(self):
+        """
+        Write every list changed since the last flush with a single delta,
+        then evict the lists over the cache limits.
+
+        Returns:
+            True if successful, False otherwise
+        """
+        written = self._write_dirty()
+        self._evict(time.monotonic())
+        return written
+
+    def _write_dirty(self):
+        """
+        Write every list changed since the last flush with a single delta.
+
+        Returns:
+            True if successful, False otherwise
+        """
+        with self._flush_lock:
+            with self._lock:
+                if not self._dirty:
+                    return True
+                dirty, self._dirty = self._dirty, set()
+                # The current snapshots stay the same while writers publish newer ones.
+                # Dirty lists are never evicted, so they are all in memory.
+                snapshots = {list_id: self.lists[list_id] for list_id in dirty}
+            try:
+                changed_lists = {list_id: self._copy_list(items) for list_id, items in snapshots.items()}
+                written = self.storage.save_delta(changed_lists)
+            except Exception as e:
+                logger.error(f"Error writing {len(dirty)} changed lists: {e}")
+                written = False
+            if not written:
+                # Retry on the next flush
+                with self._lock:
+                    self._dirty.update(dirty)
+                if self._write_behind is not None:
+                    self._write_behind.mark_dirty()
+                return False
+            return True
+
+    def get_version(self, chat_id, user_id=None):
+        """
+        Get the version of a shopping list, which grows with every change.
+
+        Args:
+            chat_id: The telegram chat ID
+            user_id: The telegram user ID (optional, used for private chats)
+
+        Returns:
+            The version number of the list
+        """
+        return self._versions.get(self._get_list_id(chat_id, user_id), self._first_version)
+
+    def persisted(self):
+        """
+        Get a future that completes once every change made so far is written.
+
+        In an event loop, wait for it with asyncio.wrap_future().
+
+        Returns:
+            A concurrent.futures.Future
+        """
+        if self._write_behind is not None:
+            return self._write_behind.written()
+        future = Future()
+        future.set_result(None)
+        return future
+
+    def flush(self):
+        """Write all pending changes to storage."""
+        if self._write_behind is not None:
+            self._write_behind.flush()
+        else:
+            self._flush_dirty()
+
+    def close(self):
+        """Write all pending changes and release the storage."""
+        if self._write_behind is not None:
+            self._write_behind.close()
+            self._write_behind = None
+        self._flush_dirty()
+        self.storage.close()
 
     def _get_list_id(self, chat_id, user_id=None):
         """
@@ -48,6 +620,19 @@ class ShoppingList:
             # This is a private chat, use user_id as list identifier
             return f"user_{user_id if user_id else chat_id}"
 
+    def get_list_id(self, chat_id, user_id=None):
+        """
+        Get the identifier of the list used by a chat, e.g. to lock it.
+
+        Args:
+            chat_id: The Telegram chat ID
+            user_id: The Telegram user ID (optional, used for private chats)
+
+        Returns:
+            The list identifier
+        """
+        return self._get_list_id(chat_id, user_id)
+
     def _extract_real_name(self, name_dict):
         """
         Estrae il nome reale da un dizionario potenzialmente annidato.
@@ -69,44 +654,48 @@ class ShoppingList:
         else:
             return str(name_dict["name"])
 
-    def _repair_corrupted_data(self):
+    def _repair_corrupted_data(self, items):
         """
-        Ripara i dati corrotti nelle liste.
+        Ripara i dati corrotti in una lista.
+
+        Args:
+            items: La lista da riparare
+
+        Returns:
+            La lista riparata
         """
-        for user_id, items in self.lists.items():
-            if not isinstance(items, list):
-                self.lists[user_id] = []
+        if not isinstance(items, list):
+            return []
+
+        repaired_items = []
+        for item in items:
+            # Se l'elemento non è un dizionario, saltalo
+            if not isinstance(item, dict):
                 continue
 
-            repaired_items = []
-            for item in items:
-                # Se l'elemento non è un dizionario, saltalo
-                if not isinstance(item, dict):
-                    continue
-
-                # Se name è un dizionario annidato, estraiamo il nome reale
-                if "name" in item and isinstance(item["name"], dict):
-                    real_name = self._extract_real_name(item["name"])
-                    if real_name:
-                        # Categorize the item if it doesn't have a category
-                        if "category" not in item:
-                            category = self._categorize_item(real_name)
-                        else:
-                            category = item.get("category", "")
-
-                        repaired_items.append({
-                            "name": real_name,
-                            "quantity": item.get("quantity", "1"),
-                            "category": category
-                        })
-                # Se l'elemento ha una struttura valida, lo manteniamo
-                elif "name" in item and isinstance(item["name"], str):
-                    # Ensure all items have a category
+            # Se name è un dizionario annidato, estraiamo il nome reale
+            if "name" in item and isinstance(item["name"], dict):
+                real_name = self._extract_real_name(item["name"])
+                if real_name:
+                    # Categorize the item if it doesn't have a category
                     if "category" not in item:
-                        item["category"] = self._categorize_item(item["name"])
-                    repaired_items.append(item)
-
-            self.lists[user_id] = repaired_items
+                        category = self._categorize_item(real_name)
+                    else:
+                        category = item.get("category", "")
+
+                    repaired_items.append({
+                        "name": real_name,
+                        "quantity": item.get("quantity", "1"),
+                        "category": category
+                    })
+            # Se l'elemento ha una struttura valida, lo manteniamo
+            elif "name" in item and isinstance(item["name"], str):
+                # Ensure all items have a category
+                if "category" not in item:
+                    item = dict(item, category=self._categorize_item(item["name"]))
+                repaired_items.append(item)
+
+        return repaired_items
 
     def _categorize_item(self, item_name):
         """
@@ -118,78 +707,41 @@ class ShoppingList:
         Returns:
             A string with the category name
         """
-        # Lista di categorie con parole chiave associate
-        categories = {
-            "Frutta e Verdura": ["mela", "mele", "banana", "banane", "arancia", "arance", "carota", "carote", 
-                                "zucchina", "zucchine", "pomodoro", "pomodori", "insalata", "lattuga", "spinaci", 
-                                "fragola", "fragole", "kiwi", "pesca", "pesche", "melanzana", "melanzane", 
-                                "broccolo", "broccoli", "patata", "patate", "cipolla", "cipolle", "aglio", 
-                                "peperone", "peperoni", "funghi", "fungo", "sedano", "finocchio", "finocchi",
-                                "limone", "limoni", "zucca", "mango", "melone", "anguria", "verdura", "frutta"],
-
-            "Carne e Pesce": ["carne", "pollo", "tacchino", "maiale", "manzo", "bistecca", "hamburger", 
-                             "salsiccia", "salsicce", "pesce", "tonno", "salmone", "merluzzo", "acciughe", 
-                             "prosciutto", "salame", "bresaola", "speck", "mortadella", "pancetta", "wurstel",
-                             "cotoletta", "polpette", "gamberi", "calamari", "coscia", "petto", "fettina",
-                             "alici", "vongole", "cozze", "frutti di mare"],
-
-            "Latticini": ["latte", "formaggio", "formaggi", "mozzarella", "yogurt", "burro", "panna", 
-                         "ricotta", "parmigiano", "grana", "pecorino", "gorgonzola", "stracchino", 
-                         "scamorza", "mascarpone", "kefir", "brie", "caciotta", "uova", "uovo",
-                         "fiordilatte", "latticino", "latticini", "philadelphia", "crescenza",
-                         "fontina", "emmental", "asiago"],
-
-            "Pane e Cereali": ["pane", "pasta", "riso", "cereali", "farina", "cracker", "crackers", "grissini", 
-                               "pizza", "avena", "orzo", "farro", "quinoa", "cous cous", "mais", "muesli",
-                               "biscotti", "fette biscottate", "croissant", "brioche", "cornetto", "cornetti",
-                               "panino", "panini", "baguette", "piadina", "focaccia", "chapati", "tortilla"],
-
-            "Bevande": ["acqua", "succo", "tè", "tea", "the", "caffè", "caffe", "vino", "birra", "soda", 
-                       "limonata", "aranciata", "cola", "energy drink", "tisana", "smoothie", "spremuta",
-                       "bibita", "bibite", "bevanda", "bevande", "whisky", "vodka", "rum", "gin", "liquore",
-                       "champagne", "spumante", "prosecco", "beverage", "gassosa", "chinotto"],
-
-            "Condimenti": ["sale", "pepe", "olio", "aceto", "spezia", "spezie", "erba", "erbe", "salsa", 
-                          "maionese", "ketchup", "senape", "zucchero", "tabasco", "soia", "pesto",
-                          "curry", "paprika", "origano", "basilico", "rosmarino", "timo", "cannella",
-                          "noce moscata", "zafferano", "curcuma", "condimento", "condimenti"],
-
-            "Surgelati": ["surgelato", "surgelati", "gelato", "gelati", "ghiacciolo", "ghiaccioli", 
-                         "verdure surgelate", "pesce surgelato", "pizza surgelata", "bastoncini", "sofficini",
-                         "congelato", "congelati", "frozen", "cubetti di ghiaccio"],
-
-            "Legumi e Frutta secca": ["legumi", "lenticchie", "ceci", "fagioli", "fave", "piselli", 
-                                     "soia", "arachidi", "noci", "nocciole", "mandorle", "pistacchi", 
-                                     "anacardi", "frutta secca", "semi", "tofu", "seitan", "tempeh",
-                                     "lupini", "pinoli", "semi di zucca", "semi di girasole", "semi di lino",
-                                     "castagne", "datteri", "albicocche secche", "prugne secche"],
-
-            "Snack e Dolci": ["biscotti", "cioccolato", "cioccolata", "caramelle", "caramella", "torta", 
-                             "merendine", "patatine", "snack", "dolci", "dolce", "wafer", "nutella", 
-                             "marmellata", "miele", "gelato", "budino", "crostata", "bombolone",
-                             "patatine", "chips", "noccioline", "barretta", "dessert", "cialda", "cono"],
-
-            "Prodotti da Forno": ["pane", "focaccia", "brioche", "cornetto", "biscotti", "torta", "crostata",
-                                 "pizza", "panino", "panini", "grissini", "cracker", "fette biscottate",
-                                 "piadina", "ciabatta", "baguette", "filone", "ciambella"],
-
-            "Prodotti per la Casa": ["detersivo", "sapone", "carta igienica", "fazzoletti", "asciugamani", 
-                                    "tovaglioli", "piatti", "bicchieri", "posate", "spugna", "spugne", 
-                                    "candeggina", "ammoniaca", "sgrassatore", "sacchetti", "lampadina", 
-                                    "batterie", "pile", "scottex", "salviette", "fiammiferi"]
-        }
+        return categorizer.categorize(item_name)
+
+    def _parse_item_text(self, item_text):
+        """
+        Split the text of an added item into name and quantity.
+
+        Args:
+            item_text: The item with optional quantity (e.g. "2 kg di patate")
+
+        Returns:
+            A tuple (item_name, quantity)
+        """
+        item_text = item_text.strip()
+
+        match = QUANTITY_UNIT_NAME_PATTERN.match(item_text)
+        if match:
+            # Format: "2 kg di patate"
+            amount, unit, name = match.groups()
+            return name.strip(), f"{amount} {unit}".strip()
 
-        # Normalizza il nome dell'articolo
-        item_name = item_name.lower().strip()
+        match = QUANTITY_NAME_PATTERN.match(item_text)
+        if match:
+            # Format: "3 patate"
+            amount, name = match.groups()
+            # Se non c'è unità di misura, assumiamo "pezzi"
+            # Per 1 pezzo, manteniamo semplicemente "1"
+            return name.strip(), "1" if amount == "1" else f"{amount} pz"
 
-        # Controlla se il nome dell'articolo contiene una delle parole chiave
-        for category, keywords in categories.items():
-            for keyword in keywords:
-                if keyword in item_name or item_name in keyword:
-                    return category
+        match = NAME_QUANTITY_PATTERN.match(item_text)
+        if match:
+            # Format: "patate (2kg)"
+            name, amount = match.groups()
+            return name.strip(), amount.strip()
 
-        # Se non viene trovata nessuna corrispondenza, restituisci "Altro"
-        return "Altro"
+        return item_text, "1"
 
     def add_item(self, chat_id, item_text, user_id=None):
         """
@@ -202,113 +754,120 @@ class ShoppingList:
 
         Returns:
             A tuple (success, item_name, quantity, category) where success is a boolean,
-            item_name is the name of the item, quantity is the quantity string, and category is the item category
+            item_name is the name of the item, quantity is the quantity string, and category is the item category.
+            success is False when the list already has max_items items.
         """
-        list_id = self._get_list_id(chat_id, user_id)
-        if list_id not in self.lists:
-            self.lists[list_id] = []
+        return self.add_items(chat_id, [item_text], user_id)[0]
 
-        # Parse quantity from the item text
-        # Common Italian quantity patterns: "2 kg di patate", "3 patate", "patate (2kg)"
-        item_text = item_text.strip()
-        quantity = "1"
-        item_name = item_text
+    def add_items(self, chat_id, item_texts, user_id=None):
+        """
+        Add several items to a shopping list, saving it once.
+
+        Args:
+            chat_id: The telegram chat ID
+            item_texts: The items to add, each with optional quantity (see split_items)
+            user_id: The telegram user ID (optional, used for private chats)
 
-        # Pattern 1: "2 kg di patate" (quantità + unità + "di" + nome)
-        pattern1 = re.compile(r'^(\d+(?:[,.]\d+)?)\s*([a-zA-Z]*)\s+(?:di\s+)(.+)$')
-        # Pattern 2: "3 patate" (quantità + nome)
-        pattern2 = re.compile(r'^(\d+(?:[,.]\d+)?)\s+(.+)$')
-        # Pattern 3: "patate (2kg)" (nome + quantità tra parentesi)
-        pattern3 = re.compile(r'^(.+?)\s*\((\d+(?:[,.]\d+)?\s*[a-zA-Z]*)\)$')
+        Returns:
+            A list with an add_item result tuple for every item
+        """
+        list_id = self._get_list_id(chat_id, user_id)
+        with self._write_lock:
+            snapshot = self._get_list(list_id, create=True)
+            items = list(snapshot)
+            results = []
+            changes = []
+            for item_text in item_texts:
+                result, change = self._add_to_list(list_id, items, item_text)
+                results.append(result)
+                if change is not None:
+                    changes.append(change)
+            if changes:
+                # A single change can still be written as one row
+                self._save(list_id, items, changes[0] if len(changes) == 1 else None)
+        return results
+
+    def _add_to_list(self, list_id, items, item_text):
+        """
+        Add an item to the working copy of a list, without saving it.
 
-        match1 = pattern1.match(item_text)
-        match2 = pattern2.match(item_text) 
-        match3 = pattern3.match(item_text)
+        Args:
+            list_id: The identifier of a list in memory
+            items: The working copy of its items, changed in place
+            item_text: The item to add, with optional quantity
 
-        if match1:
-            # Format: "2 kg di patate"
-            amount, unit, name = match1.groups()
-            quantity = f"{amount} {unit}".strip()
-            item_name = name.strip()
-        elif match2:
-            # Format: "3 patate"
-            amount, name = match2.groups()
-            # Se non c'è unità di misura, assumiamo "pezzi"
-            if amount == "1":
-                quantity = "1"  # Per 1 pezzo, manteniamo semplicemente "1"
-            else:
-                quantity = f"{amount} pz"
-            item_name = name.strip()
-        elif match3:
-            # Format: "patate (2kg)"
-            name, amount = match3.groups()
-            item_name = name.strip()
-            quantity = amount.strip()
+        Returns:
+            A tuple (result, change) with the add_item result and the change to save
+        """
+        item_name, quantity = self._parse_item_text(item_text)
 
         # Automatically categorize the item
         category = self._categorize_item(item_name)
 
         # Check if the item already exists
-        item_exists = False
-        for i, existing_item in enumerate(self.lists[list_id]):
-            # Verifica se l'elemento esiste già, gestendo sia il caso di "name" che è una stringa,
-            # sia il caso di "name" che è un dizionario (per proteggere da corruzione dati)
-            existing_name = existing_item.get("name", "")
-            if isinstance(existing_name, dict) and "name" in existing_name:
-                # Caso di corruzione dati, estrai il nome vero
-                real_name = self._extract_real_name(existing_name)
-                if real_name.lower() == item_name.lower():
-                    # Sostituisci completamente l'elemento corrotto
-                    self.lists[list_id][i] = {
-                        "name": item_name, 
-                        "quantity": quantity,
-                        "category": category  # Aggiungi categoria
-                    }
-                    item_exists = True
-                    break
-            elif isinstance(existing_name, str) and existing_name.lower() == item_name.lower():
-                # Caso normale, somma le quantità se possibile
-                if quantity != "1":  # Se c'è una nuova quantità specificata
-                    try:
-                        # Estrai i numeri dalle stringhe di quantità
-                        old_quantity = float(''.join(filter(str.isdigit, existing_item["quantity"].replace(',', '.'))))
-                        new_quantity = float(''.join(filter(str.isdigit, quantity.replace(',', '.'))))
-                        # Estrai l'unità di misura se presente
-                        unit = ''.join(filter(str.isalpha, quantity))
-                        # Somma le quantità e mantieni l'unità di misura
-                        total = old_quantity + new_quantity
-                        self.lists[list_id][i]["quantity"] = f"{total}{unit}" if unit else str(total)
-                    except ValueError:
-                        # Se non riusciamo a convertire i numeri, sostituisci semplicemente la quantità
-                        self.lists[list_id][i]["quantity"] = quantity
-                self.lists[list_id][i]["category"] = category  # Aggiorna categoria
-                item_exists = True
-                break
-
-        if not item_exists and item_name:
+        change = None
+        index = self._name_index(list_id, items)
+        i = index.get(item_name.lower())
+        if i is not None:
+            existing_item = items[i]
+            # Somma le quantità se possibile
+            if quantity != "1":  # Se c'è una nuova quantità specificata
+                total = add_quantities(existing_item.amount, parse_quantity(quantity))
+                if total is not None:
+                    existing_item = existing_item.replace(amount=total)
+                else:
+                    # Unità diverse o quantità non numeriche: sostituisci semplicemente la quantità
+                    existing_item = existing_item.replace(quantity=quantity)
+            items[i] = existing_item.replace(category=category)  # Aggiorna categoria
+            change = ("update", i)
+        elif item_name:
+            if self.max_items and len(items) >= self.max_items:
+                # The list is full: only existing items can still change
+                return (False, item_name, quantity, category), None
             # Add new item with category
-            self.lists[list_id].append({
-                "name": item_name, 
-                "quantity": quantity,
-                "category": category
-            })
+            ids = self._id_set(list_id, items)
+            item = Item(item_name, quantity, category, self._new_id(ids))
+            ids.add(item.id)
+            items.append(item)
+            index[item_name.lower()] = len(items) - 1
+            change = ("append", len(items) - 1)
 
-        self.storage.save(self.lists)
-        return (True, item_name, quantity, category)
+        return (True, item_name, quantity, category), change
 
     def get_items(self, chat_id, user_id=None):
         """
         Get all items in a shopping list.
 
+        The result is an immutable snapshot: later changes to the list don't
+        affect it, so it can be read from any thread without locking.
+
         Args:
             chat_id: The telegram chat ID
             user_id: The telegram user ID (optional, used for private chats)
 
         Returns:
-            A list of item dictionaries with 'name', 'quantity', and 'category' keys
+            A ListSnapshot of items, mappings with 'name', 'quantity', and 'category'
+            keys and an 'id' attribute; its 'version' is the list version it shows
         """
         list_id = self._get_list_id(chat_id, user_id)
-        return self.lists.get(list_id, [])
+        items = self._get_list(list_id)
+        if items is None:
+            return ListSnapshot((), self._versions.get(list_id, self._first_version))
+        return items
+
+    def get_item(self, chat_id, item_id, user_id=None):
+        """
+        Get an item of a shopping list by its ID.
+
+        Args:
+            chat_id: The telegram chat ID
+            item_id: The ID of the item
+            user_id: The telegram user ID (optional, used for private chats)
+
+        Returns:
+            The item, or None if it isn't in the list
+        """
+        return self.get_items(chat_id, user_id).get_item(item_id)
 
     def get_item_names(self, chat_id, user_id=None):
         """
@@ -337,12 +896,49 @@ class ShoppingList:
             The removed item if successful, None otherwise
         """
         list_id = self._get_list_id(chat_id, user_id)
-        if list_id in self.lists and 0 <= index < len(self.lists[list_id]):
-            removed_item = self.lists[list_id].pop(index)
-            self.storage.save(self.lists)
-            return removed_item
+        with self._write_lock:
+            snapshot = self._get_list(list_id)
+            if snapshot is not None and 0 <= index < len(snapshot):
+                removed_item = snapshot[index]
+                items = snapshot[:index] + snapshot[index + 1:]
+                self._unindex_item(list_id, items, index, removed_item)
+                self._save(list_id, items, ("delete", index))
+                return removed_item
         return None
 
+    def remove_items(self, chat_id, item_ids, user_id=None):
+        """
+        Remove several items from a shopping list by ID, saving it once.
+
+        IDs that are not in the list, e.g. of items already removed from
+        another chat message, are ignored.
+
+        Args:
+            chat_id: The telegram chat ID
+            item_ids: The IDs of the items to remove
+            user_id: The telegram user ID (optional, used for private chats)
+
+        Returns:
+            The removed items, in list order
+        """
+        list_id = self._get_list_id(chat_id, user_id)
+        with self._write_lock:
+            snapshot = self._get_list(list_id)
+            if not snapshot:
+                return []
+            positions = sorted({position for position in map(snapshot.position, item_ids)
+                                if position is not None})
+            if not positions:
+                return []
+            removed = [snapshot[position] for position in positions]
+            removed_ids = {item.id for item in removed}
+            items = [item for item in snapshot if item.id not in removed_ids]
+            self._id_set(list_id, snapshot).difference_update(removed_ids)
+            # Rebuilt on next use, cheaper than shifting it once per removed item
+            self._name_indexes.pop(list_id, None)
+            self._save(list_id, items, ("delete", positions[0]) if len(positions) == 1 else None)
+        return removed
+
     def clear_list(self, chat_id, user_id=None):
         """
         Clear an entire shopping list.
@@ -352,9 +948,11 @@ class ShoppingList:
             user_id: The telegram user ID (optional, used for private chats)
         """
         list_id = self._get_list_id(chat_id, user_id)
-        if list_id in self.lists:
-            self.lists[list_id] = []
-            self.storage.save(self.lists)
+        with self._write_lock:
+            if self._get_list(list_id) is not None:
+                self._name_indexes[list_id] = {}
+                self._id_sets[list_id] = set()
+                self._save(list_id, ())
 
     def update_quantity(self, chat_id, index, quantity, user_id=None):
         """
@@ -370,12 +968,39 @@ class ShoppingList:
             True if successful, False otherwise
         """
         list_id = self._get_list_id(chat_id, user_id)
-        if list_id in self.lists and 0 <= index < len(self.lists[list_id]):
-            self.lists[list_id][index]["quantity"] = quantity
-            self.storage.save(self.lists)
-            return True
+        with self._write_lock:
+            snapshot = self._get_list(list_id)
+            if snapshot is not None and 0 <= index < len(snapshot):
+                items = list(snapshot)
+                items[index] = items[index].replace(quantity=quantity)
+                self._save(list_id, items, ("update", index))
+                return True
         return False
 
+    def update_item_quantity(self, chat_id, item_id, quantity, user_id=None):
+        """
+        Update the quantity of an item in the shopping list by its ID.
+
+        Args:
+            chat_id: The telegram chat ID
+            item_id: The ID of the item to update
+            quantity: The new quantity
+            user_id: The telegram user ID (optional, used for private chats)
+
+        Returns:
+            True if successful, False otherwise
+        """
+        list_id = self._get_list_id(chat_id, user_id)
+        with self._write_lock:
+            snapshot = self._get_list(list_id)
+            position = snapshot.position(item_id) if snapshot is not None else None
+            if position is None:
+                return False
+            items = list(snapshot)
+            items[position] = items[position].replace(quantity=quantity)
+            self._save(list_id, items, ("update", position))
+        return True
+
     def is_group_chat(self, chat_id):
         """
         Check if the given chat_id is a group chat.
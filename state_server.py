@@ -0,0 +1,650 @@
+"""
+Shared shopping list state for all the bot and web processes.
+
+The state server is the only process that owns a ShoppingList. The bots
+and the web workers talk to it over a Unix domain socket through
+ShoppingListClient, which has the same methods, so every process sees one
+authoritative copy of the lists in memory. Bot handlers, which run in an
+event loop, use AsyncShoppingListClient instead, whose methods are
+coroutines and never block the loop.
+
+Each message is a 4-byte big-endian length followed by a marshal payload:
+requests are (method, args) tuples, responses are (ok, result) tuples.
+Items travel as their storage dicts and are rebuilt on the client side.
+
+Usage: STATE_SOCKET=shopping_lists.sock python state_server.py
+"""
+
+import os
+import sys
+import time
+import asyncio
+import socket
+import struct
+import marshal
+import signal
+import logging
+import threading
+import socketserver
+from concurrent.futures import Future
+from item import Item, ListSnapshot
+from shopping_list import ShoppingList
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SOCKET = "shopping_lists.sock"
+
+# Length prefix of every message
+HEADER = struct.Struct(">I")
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+
+# ShoppingList methods that clients can call
+REMOTE_METHODS = frozenset({
+    "add_item", "add_items", "get_items", "get_item", "get_item_names", "get_version",
+    "remove_item", "remove_items", "clear_list", "update_quantity", "update_item_quantity",
+    "cache_stats", "flush", "persisted",
+})
+
+class StateServerError(Exception):
+    """The state server could not be reached, or the call failed on the server."""
+
+def _encode(value):
+    """Convert a ShoppingList result to types marshal can write."""
+    if isinstance(value, ListSnapshot):
+        return {"__snapshot__": value.version, "items": [item.to_dict() for item in value]}
+    if isinstance(value, Item):
+        return {"__item__": value.to_dict()}
+    if isinstance(value, list):
+        return [_encode(element) for element in value]
+    if isinstance(value, tuple):
+        return tuple(_encode(element) for element in value)
+    return value
+
+def _decode(value):
+    """Rebuild the items and snapshots of a result written by _encode()."""
+    if isinstance(value, dict):
+        if "__snapshot__" in value:
+            return ListSnapshot([Item.from_dict(item) for item in value["items"]], value["__snapshot__"])
+        if "__item__" in value:
+            return Item.from_dict(value["__item__"])
+        return value
+    if isinstance(value, list):
+        return [_decode(element) for element in value]
+    if isinstance(value, tuple):
+        return tuple(_decode(element) for element in value)
+    return value
+
+def _send(sock, payload):
+    data = marshal.dumps(payload)
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+def _receive(stream):
+    """
+    Read one message.
+
+    Args:
+        stream: A binary file object of the socket
+
+    Returns:
+        The decoded payload, or None if the connection was closed
+    """
+    header = stream.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None
+    size, = HEADER.unpack(header)
+    if size > MAX_MESSAGE_SIZE:
+        raise ValueError(f"Message too large: {size} bytes")
+    data = stream.read(size)
+    if len(data) < size:
+        return None
+    return marshal.loads(data)
+
+async def _receive_async(reader):
+    """
+    Read one message from an asyncio stream.
+
+    Args:
+        reader: The asyncio.StreamReader of the connection
+
+    Returns:
+        The decoded payload, or None if the connection was closed
+    """
+    try:
+        header = await reader.readexactly(HEADER.size)
+        size, = HEADER.unpack(header)
+        if size > MAX_MESSAGE_SIZE:
+            raise ValueError(f"Message too large: {size} bytes")
+        data = await reader.readexactly(size)
+    except asyncio.IncompleteReadError:
+        return None
+    return marshal.loads(data)
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    """Serve the requests of one client connection, one at a time."""
+
+    def handle(self):
+        shopping_list = self.server.shopping_list
+        while True:
+            try:
+                request = _receive(self.rfile)
+            except (OSError, ValueError, EOFError) as e:
+                logger.error(f"Error reading state request: {e}")
+                return
+            if request is None:
+                return
+            try:
+                method, args = request
+                if method not in REMOTE_METHODS:
+                    raise AttributeError(f"Unknown method: {method}")
+                result = getattr(shopping_list, method)(*args)
+                if method == "persisted":
+                    # Reply once the changes are written
+                    result.result()
+                    result = None
+                response = (True, _encode(result))
+            except Exception as e:
+                logger.error(f"Error serving {request[0] if isinstance(request, tuple) else request}: {e}")
+                response = (False, f"{type(e).__name__}: {e}")
+            try:
+                _send(self.connection, response)
+            except OSError:
+                return
+
+class StateServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Serve a ShoppingList over a Unix domain socket, one thread per client."""
+
+    daemon_threads = True
+
+    def __init__(self, path, shopping_list=None):
+        """
+        Bind the socket.
+
+        Args:
+            path: The path of the Unix domain socket
+            shopping_list: The ShoppingList to serve, a new one by default
+
+        Raises:
+            StateServerError: If another server is listening on path
+        """
+        if os.path.exists(path):
+            self._remove_stale_socket(path)
+        self.path = path
+        self.shopping_list = shopping_list if shopping_list is not None else ShoppingList(background_writes=True)
+        # Only processes of the same user can connect
+        old_umask = os.umask(0o177)
+        try:
+            super().__init__(path, _RequestHandler)
+        finally:
+            os.umask(old_umask)
+
+    @staticmethod
+    def _remove_stale_socket(path):
+        """
+        Remove a socket left behind by a server that didn't stop cleanly.
+
+        The socket of a running server is kept: taking it over would split
+        the clients between two copies of the lists.
+
+        Args:
+            path: The path of the Unix domain socket
+
+        Raises:
+            StateServerError: If a server still accepts connections on it
+        """
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            # Nobody listens on it any more
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            return
+        finally:
+            probe.close()
+        raise StateServerError(f"Another state server is listening on {path}")
+
+    def server_close(self):
+        """Stop listening, remove the socket and write the pending changes."""
+        super().server_close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.shopping_list.close()
+
+class ShoppingListClient:
+    """
+    A ShoppingList living in the state server.
+
+    It has the same methods as ShoppingList. Results are copies: the
+    snapshots returned by get_items() are immutable as in ShoppingList,
+    and the methods that only depend on the chat run locally.
+
+    Calls block until the server replies. Every thread gets a connection of
+    its own, so threads don't wait for each other's calls; in an event loop
+    use AsyncShoppingListClient.
+    """
+
+    # Methods that don't need the lists
+    _get_list_id = ShoppingList._get_list_id
+    get_list_id = ShoppingList.get_list_id
+    is_group_chat = ShoppingList.is_group_chat
+    get_list_type = ShoppingList.get_list_type
+
+    def __init__(self, path=None, connect_timeout=10.0):
+        """
+        Initialize the client. The connection is opened on the first call.
+
+        Args:
+            path: The path of the state server socket, defaults to STATE_SOCKET
+            connect_timeout: Seconds to wait for a server that is still starting
+        """
+        self.path = path or os.environ.get("STATE_SOCKET", DEFAULT_SOCKET)
+        self.connect_timeout = connect_timeout
+        # The (socket, stream) of each thread, and all of them to close them
+        self._local = threading.local()
+        self._connections = set()
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        deadline = time.monotonic() + self.connect_timeout
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.path)
+                break
+            except OSError as e:
+                sock.close()
+                if time.monotonic() >= deadline:
+                    raise StateServerError(f"Cannot connect to the state server at {self.path}: {e}")
+                time.sleep(0.1)
+        connection = (sock, sock.makefile("rb"))
+        with self._lock:
+            self._connections.add(connection)
+        self._local.connection = connection
+        return connection
+
+    def _disconnect(self, connection):
+        sock, stream = connection
+        stream.close()
+        sock.close()
+        with self._lock:
+            self._connections.discard(connection)
+        if getattr(self._local, "connection", None) is connection:
+            self._local.connection = None
+
+    def _call(self, method, *args):
+        """
+        Call a ShoppingList method on the server.
+
+        A broken connection, e.g. after a server restart, is opened again
+        once. Requests are not retried after they were sent, since they may
+        have been applied.
+
+        Returns:
+            The decoded result
+        """
+        for attempt in (1, 2):
+            connection = getattr(self._local, "connection", None) or self._connect()
+            sock, stream = connection
+            try:
+                _send(sock, (method, args))
+            except OSError:
+                self._disconnect(connection)
+                if attempt == 2:
+                    raise StateServerError(f"Cannot send {method} to the state server")
+                continue
+            try:
+                response = _receive(stream)
+            except (OSError, ValueError, EOFError) as e:
+                response = None
+                logger.error(f"Error reading the state server response: {e}")
+            if response is None:
+                self._disconnect(connection)
+                raise StateServerError(f"The state server closed the connection during {method}")
+            break
+        ok, result = response
+        if not ok:
+            raise StateServerError(result)
+        return _decode(result)
+
+    def add_item(self, chat_id, item_text, user_id=None):
+        return self._call("add_item", chat_id, item_text, user_id)
+
+    def add_items(self, chat_id, item_texts, user_id=None):
+        return self._call("add_items", chat_id, list(item_texts), user_id)
+
+    def get_items(self, chat_id, user_id=None):
+        return self._call("get_items", chat_id, user_id)
+
+    def get_item(self, chat_id, item_id, user_id=None):
+        return self._call("get_item", chat_id, item_id, user_id)
+
+    def get_item_names(self, chat_id, user_id=None):
+        return self._call("get_item_names", chat_id, user_id)
+
+    def get_version(self, chat_id, user_id=None):
+        return self._call("get_version", chat_id, user_id)
+
+    def remove_item(self, chat_id, index, user_id=None):
+        return self._call("remove_item", chat_id, index, user_id)
+
+    def remove_items(self, chat_id, item_ids, user_id=None):
+        return self._call("remove_items", chat_id, list(item_ids), user_id)
+
+    def clear_list(self, chat_id, user_id=None):
+        return self._call("clear_list", chat_id, user_id)
+
+    def update_quantity(self, chat_id, index, quantity, user_id=None):
+        return self._call("update_quantity", chat_id, index, quantity, user_id)
+
+    def update_item_quantity(self, chat_id, item_id, quantity, user_id=None):
+        return self._call("update_item_quantity", chat_id, item_id, quantity, user_id)
+
+    def cache_stats(self):
+        return self._call("cache_stats")
+
+    def flush(self):
+        return self._call("flush")
+
+    def persisted(self):
+        """
+        Get a future that completes once every change made so far is written.
+
+        Returns:
+            A concurrent.futures.Future, already completed: the server only
+            replies once the changes are written
+        """
+        self._call("persisted")
+        future = Future()
+        future.set_result(None)
+        return future
+
+    def close(self):
+        """Close the connections of every thread. The server keeps the lists."""
+        with self._lock:
+            connections = list(self._connections)
+        for connection in connections:
+            self._disconnect(connection)
+
+class AsyncShoppingList:
+    """
+    The ShoppingList of this process, with coroutine methods for the bot handlers.
+
+    ShoppingList calls run on a worker thread: even with the writes on a
+    background thread, loading a list that is not in memory, or reloading
+    one another process changed, reads the disk. The methods that only
+    depend on the chat are plain functions.
+    """
+
+    def __init__(self, shopping_list):
+        """
+        Initialize the wrapper.
+
+        Args:
+            shopping_list: The ShoppingList to call
+        """
+        self.shopping_list = shopping_list
+
+    def get_list_id(self, chat_id, user_id=None):
+        return self.shopping_list.get_list_id(chat_id, user_id)
+
+    def is_group_chat(self, chat_id):
+        return self.shopping_list.is_group_chat(chat_id)
+
+    def get_list_type(self, chat_id):
+        return self.shopping_list.get_list_type(chat_id)
+
+    async def _call(self, method, *args):
+        return await asyncio.to_thread(getattr(self.shopping_list, method), *args)
+
+    async def add_item(self, chat_id, item_text, user_id=None):
+        return await self._call("add_item", chat_id, item_text, user_id)
+
+    async def add_items(self, chat_id, item_texts, user_id=None):
+        return await self._call("add_items", chat_id, list(item_texts), user_id)
+
+    async def get_items(self, chat_id, user_id=None):
+        return await self._call("get_items", chat_id, user_id)
+
+    async def get_item(self, chat_id, item_id, user_id=None):
+        return await self._call("get_item", chat_id, item_id, user_id)
+
+    async def get_item_names(self, chat_id, user_id=None):
+        return await self._call("get_item_names", chat_id, user_id)
+
+    async def get_version(self, chat_id, user_id=None):
+        return await self._call("get_version", chat_id, user_id)
+
+    async def remove_item(self, chat_id, index, user_id=None):
+        return await self._call("remove_item", chat_id, index, user_id)
+
+    async def remove_items(self, chat_id, item_ids, user_id=None):
+        return await self._call("remove_items", chat_id, list(item_ids), user_id)
+
+    async def clear_list(self, chat_id, user_id=None):
+        return await self._call("clear_list", chat_id, user_id)
+
+    async def update_quantity(self, chat_id, index, quantity, user_id=None):
+        return await self._call("update_quantity", chat_id, index, quantity, user_id)
+
+    async def update_item_quantity(self, chat_id, item_id, quantity, user_id=None):
+        return await self._call("update_item_quantity", chat_id, item_id, quantity, user_id)
+
+    async def cache_stats(self):
+        return await self._call("cache_stats")
+
+    async def flush(self):
+        """Write all pending changes to storage, on a worker thread."""
+        await asyncio.to_thread(self.shopping_list.flush)
+
+    async def persisted(self):
+        """Wait until every change made so far is written."""
+        await asyncio.wrap_future(self.shopping_list.persisted())
+
+    def close(self):
+        """Write all pending changes and release the storage."""
+        self.shopping_list.close()
+
+class AsyncShoppingListClient(AsyncShoppingList):
+    """
+    A ShoppingList living in the state server, with coroutine methods.
+
+    Calls wait for the server without blocking the event loop. Each call
+    takes a connection of its own from a small pool, and the server serves
+    every connection on its own thread, so a slow call, e.g. persisted()
+    waiting for the disk, doesn't hold up the other handlers.
+
+    The connections belong to the event loop of the first call: if the
+    client is used from a new loop, e.g. after asyncio.run() returned,
+    they are opened again.
+    """
+
+    # Methods that don't need the lists
+    _get_list_id = ShoppingList._get_list_id
+    get_list_id = ShoppingList.get_list_id
+    is_group_chat = ShoppingList.is_group_chat
+    get_list_type = ShoppingList.get_list_type
+
+    def __init__(self, path=None, connect_timeout=10.0, max_connections=None):
+        """
+        Initialize the client. Connections are opened when calls need them.
+
+        Args:
+            path: The path of the state server socket, defaults to STATE_SOCKET
+            connect_timeout: Seconds to wait for a server that is still starting
+            max_connections: Calls in flight at once, each on its own connection.
+                Defaults to STATE_CONNECTIONS or 8.
+        """
+        super().__init__(None)
+        self.path = path or os.environ.get("STATE_SOCKET", DEFAULT_SOCKET)
+        self.connect_timeout = connect_timeout
+        if max_connections is None:
+            max_connections = int(os.environ.get("STATE_CONNECTIONS", "8"))
+        self.max_connections = max_connections
+        self._loop = None
+        self._slots = None
+        # (socket, reader, writer) of the open connections, and those not in use
+        self._connections = set()
+        self._idle = []
+
+    def _bind(self):
+        """Use the running event loop, dropping the connections of a previous one."""
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self.close()
+            self._loop = loop
+            self._slots = asyncio.Semaphore(self.max_connections)
+
+    async def _connect(self):
+        deadline = time.monotonic() + self.connect_timeout
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            try:
+                await self._loop.sock_connect(sock, self.path)
+                break
+            except OSError as e:
+                sock.close()
+                if time.monotonic() >= deadline:
+                    raise StateServerError(f"Cannot connect to the state server at {self.path}: {e}")
+                await asyncio.sleep(0.1)
+        reader, writer = await asyncio.open_unix_connection(sock=sock)
+        connection = (sock, reader, writer)
+        self._connections.add(connection)
+        return connection
+
+    async def _acquire(self):
+        """Get an idle connection, or open a new one."""
+        while self._idle:
+            connection = self._idle.pop()
+            if not connection[1].at_eof():
+                return connection
+            # Closed by the server, e.g. after a restart
+            self._disconnect(connection)
+        return await self._connect()
+
+    def _disconnect(self, connection):
+        sock, reader, writer = connection
+        self._connections.discard(connection)
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if self._loop is None or self._loop.is_closed():
+            sock.close()
+        elif self._loop is running:
+            writer.close()
+        else:
+            self._loop.call_soon_threadsafe(writer.close)
+
+    async def _call(self, method, *args):
+        """
+        Call a ShoppingList method on the server.
+
+        Requests are not retried, since they may have been applied. A call
+        cancelled while waiting for the response drops its connection, where
+        the response would still arrive.
+
+        Returns:
+            The decoded result
+        """
+        self._bind()
+        data = marshal.dumps((method, args))
+        async with self._slots:
+            connection = await self._acquire()
+            sock, reader, writer = connection
+            try:
+                writer.write(HEADER.pack(len(data)) + data)
+                await writer.drain()
+                response = await _receive_async(reader)
+            except (OSError, ValueError, EOFError) as e:
+                self._disconnect(connection)
+                raise StateServerError(f"The state server connection failed during {method}: {e}")
+            except BaseException:
+                self._disconnect(connection)
+                raise
+            if response is None:
+                self._disconnect(connection)
+                raise StateServerError(f"The state server closed the connection during {method}")
+            self._idle.append(connection)
+        ok, result = response
+        if not ok:
+            raise StateServerError(result)
+        return _decode(result)
+
+    async def flush(self):
+        return await self._call("flush")
+
+    async def persisted(self):
+        """Wait until every change made so far is written: the server only replies then."""
+        await self._call("persisted")
+
+    def close(self):
+        """Close the connections. The server keeps the lists."""
+        for connection in list(self._connections):
+            self._disconnect(connection)
+        self._idle = []
+
+def create_shopping_list(**kwargs):
+    """
+    Get the shopping list of this process: a client of the state server if
+    STATE_SOCKET is set, otherwise a ShoppingList of its own.
+
+    Args:
+        kwargs: ShoppingList arguments, used without a state server
+
+    Returns:
+        A ShoppingListClient or a ShoppingList
+    """
+    path = os.environ.get("STATE_SOCKET")
+    if path:
+        logger.info(f"Using the shared state server at {path}")
+        return ShoppingListClient(path)
+    return ShoppingList(**kwargs)
+
+def create_async_shopping_list(**kwargs):
+    """
+    Get the shopping list of this process for code running in an event loop,
+    like the bot handlers: a client of the state server if STATE_SOCKET is
+    set, otherwise a ShoppingList of its own.
+
+    Args:
+        kwargs: ShoppingList arguments, used without a state server. Pass
+            background_writes=True, so that no call waits for the disk.
+
+    Returns:
+        An AsyncShoppingListClient or an AsyncShoppingList
+    """
+    path = os.environ.get("STATE_SOCKET")
+    if path:
+        logger.info(f"Using the shared state server at {path}")
+        return AsyncShoppingListClient(path)
+    return AsyncShoppingList(ShoppingList(**kwargs))
+
+def main():
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+    )
+    path = os.environ.get("STATE_SOCKET", DEFAULT_SOCKET)
+    try:
+        server = StateServer(path)
+    except StateServerError as e:
+        logger.error(f"State server not started: {e}")
+        return 1
+
+    def stop(signum, frame):
+        # shutdown() waits for serve_forever(), which runs in this thread
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    logger.info(f"State server listening on {path}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        logger.info("State server stopped")
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,20 +1,165 @@
+import gc
 import json
 import os
+import zlib
+import struct
+import marshal
 import logging
+import sqlite3
+import threading
+from contextlib import contextmanager
+from urllib.parse import quote, unquote
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows: writes are still atomic but not coordinated
+    fcntl = None
 
 logger = logging.getLogger(__name__)
 
+# Binary snapshot: a fixed header followed by the marshal-encoded data.
+# Header fields: magic, snapshot format version, flags, schema version of the
+# lists (the schema_version metadata, see ShoppingList.SCHEMA_VERSION), marshal
+# version used to encode it, payload length and CRC-32.
+SNAPSHOT_MAGIC = b"CPLS"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct(">4sBBHB3xII")
+SNAPSHOT_FLAG_ZLIB = 1
+
+def _write_atomic(filename, content, fsync=True):
+    """
+    Write a file atomically by writing a temporary file and renaming it.
+    
+    Args:
+        filename: The file to write
+        content: The text or bytes to write
+        fsync: Whether to flush the file and its directory to disk
+    """
+    # Unique per thread: processes that don't hold the write lock, like one
+    # rebuilding a missing manifest, may write the same file at the same time
+    tmp_filename = f"{filename}.{os.getpid()}.{threading.get_ident()}.tmp"
+    if isinstance(content, bytes):
+        f = open(tmp_filename, 'wb')
+    else:
+        f = open(tmp_filename, 'w', encoding='utf-8')
+    with f:
+        f.write(content)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp_filename, filename)
+    if fsync and hasattr(os, "O_DIRECTORY"):
+        dir_fd = os.open(os.path.dirname(os.path.abspath(filename)), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+@contextmanager
+def _try_lock(lock):
+    """
+    Hold a lock only if it's free, without waiting for it.
+    
+    Args:
+        lock: A threading lock
+    
+    Yields:
+        True if the lock was acquired, False if another thread holds it
+    """
+    acquired = lock.acquire(blocking=False)
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            lock.release()
+
 class Storage:
-    """Class to handle persistent storage of data in JSON format."""
+    """
+    Class to handle persistent storage of data in JSON format.
+    
+    Several processes can share the same file: writers hold an advisory lock
+    on a separate lock file and replace the file atomically, and a writer
+    that finds the file changed by another process merges its changes into
+    the new version. Readers call refresh() to reload the file only when its
+    inode, mtime or size changed.
+    
+    refresh() never waits for a writer of the same process: while one holds
+    the data lock it returns nothing, and the changes of other processes the
+    writer finds are reported by the next call.
+    
+    The file is pretty-printed JSON by default, or a binary snapshot (see
+    SNAPSHOT_HEADER) that is about half the size and several times faster to
+    write and read. Both formats are recognized on load.
+    """
     
-    def __init__(self, filename):
+    def __init__(self, filename, fsync=False, snapshot_format="json", compress=False,
+                 legacy_filename=None, schema_version=None):
         """
         Initialize the storage with a filename.
         
         Args:
             filename: The name of the file to store data in
+            fsync: Whether to flush every write to disk
+            snapshot_format: "json" or "binary"
+            compress: Whether to compress binary snapshots with zlib
+            legacy_filename: Optional file to load when filename doesn't exist yet,
+                e.g. the JSON file when switching to the binary format
+            schema_version: The newest schema version of the lists this code
+                can read; binary snapshots of a newer one are refused
         """
+        if snapshot_format not in ("json", "binary"):
+            raise ValueError(f"Unknown snapshot format: {snapshot_format}")
         self.filename = filename
+        self.lock_filename = filename + ".lock"
+        self.fsync = fsync
+        self.snapshot_format = snapshot_format
+        self.compress = compress
+        self.legacy_filename = legacy_filename
+        self.schema_version = schema_version
+        # Schema version of the stored lists, from the metadata, read on first use
+        self._stored_schema_version = None
+        # Last document loaded or saved, used to persist single lists
+        self._data = {}
+        self._loaded = False
+        # Identity of the file version _data comes from
+        self._signature = None
+        self._data_lock = threading.RLock()
+        # Lists changed by other processes, found while writing, for refresh()
+        self._changed = set()
+    
+    def _file_signature(self, fd=None):
+        """
+        Get a cheap identifier of the current version of the storage file.
+        
+        Every save replaces the file with a new one, so the inode changes
+        even when the mtime resolution is too coarse to tell writes apart.
+        
+        Args:
+            fd: Optional open file descriptor to stat instead of the path
+        
+        Returns:
+            An (inode, mtime_ns, size) tuple, or None if the file doesn't exist
+        """
+        try:
+            st = os.fstat(fd) if fd is not None else os.stat(self.filename)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+    
+    @contextmanager
+    def _locked(self):
+        """Hold the exclusive cross-process write lock."""
+        if fcntl is None:
+            yield
+            return
+        fd = os.open(self.lock_filename, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            # Closing the descriptor releases the lock
+            os.close(fd)
     
     def load(self):
         """
@@ -23,15 +168,122 @@ class Storage:
         Returns:
             The loaded data, or None if the file doesn't exist or there's an error
         """
-        if not os.path.exists(self.filename):
+        with self._data_lock:
+            self._loaded = True
+            if not os.path.exists(self.filename):
+                self._signature = None
+                if self.legacy_filename and os.path.exists(self.legacy_filename):
+                    return self._load_legacy()
+                return None
+            
+            try:
+                with open(self.filename, 'rb') as f:
+                    # The file is replaced atomically, so the open file is one consistent version
+                    signature = self._file_signature(f.fileno())
+                    data = self._decode(f.read())
+                if isinstance(data, dict):
+                    self._data = data
+                    self._signature = signature
+                return data
+            except Exception as e:
+                logger.error(f"Error loading data from {self.filename}: {e}")
+                return None
+    
+    def _load_legacy(self):
+        """Load the legacy file. It is replaced by filename on the first save."""
+        try:
+            with open(self.legacy_filename, 'rb') as f:
+                data = self._decode(f.read())
+            if isinstance(data, dict):
+                self._data = data
+            logger.info(f"Loaded {self.legacy_filename}, it will be saved to {self.filename}")
+            return data
+        except Exception as e:
+            logger.error(f"Error loading data from {self.legacy_filename}: {e}")
             return None
+    
+    def _encode(self, data):
+        """
+        Serialize the data in the configured snapshot format.
+        
+        Args:
+            data: The data to serialize
+        
+        Returns:
+            The file content, as str for JSON and bytes for binary snapshots
+        """
+        if self.snapshot_format == "json":
+            return json.dumps(data, ensure_ascii=False, indent=2)
+        payload = marshal.dumps(data)
+        flags = 0
+        if self.compress:
+            payload = zlib.compress(payload, 1)
+            flags |= SNAPSHOT_FLAG_ZLIB
+        if self._stored_schema_version is None:
+            self._stored_schema_version = self.get_meta("schema_version", 0)
+        header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, flags, self._stored_schema_version,
+                                      marshal.version, len(payload), zlib.crc32(payload))
+        return header + payload
+    
+    def _decode(self, raw):
+        """
+        Deserialize a file written in either snapshot format.
+        
+        Args:
+            raw: The file content as bytes
+        
+        Returns:
+            The data
         
+        Raises:
+            ValueError: If a binary snapshot is truncated, corrupted or was
+                written by a newer version
+        """
+        # Decoding creates millions of containers that can't be garbage:
+        # pausing the collector meanwhile makes loading up to twice as fast
+        gc_enabled = gc.isenabled()
+        gc.disable()
         try:
-            with open(self.filename, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            return self._decode_snapshot(raw)
+        finally:
+            if gc_enabled:
+                gc.enable()
+    
+    def _decode_snapshot(self, raw):
+        if not raw.startswith(SNAPSHOT_MAGIC):
+            return json.loads(raw.decode('utf-8'))
+        if len(raw) < SNAPSHOT_HEADER.size:
+            raise ValueError("truncated snapshot header")
+        (_, version, flags, schema_version, marshal_version,
+         length, checksum) = SNAPSHOT_HEADER.unpack_from(raw)
+        if version > SNAPSHOT_VERSION or marshal_version > marshal.version:
+            raise ValueError(f"snapshot format {version}/{marshal_version} is newer than this version")
+        if self.schema_version is not None and schema_version > self.schema_version:
+            raise ValueError(f"schema version {schema_version} is newer than this version ({self.schema_version})")
+        payload = raw[SNAPSHOT_HEADER.size:]
+        if len(payload) != length or zlib.crc32(payload) != checksum:
+            raise ValueError("snapshot checksum mismatch")
+        if flags & SNAPSHOT_FLAG_ZLIB:
+            payload = zlib.decompress(payload)
+        return marshal.loads(payload)
+    
+    def export_json(self, filename):
+        """
+        Export all the lists as pretty-printed JSON, whatever the backend.
+        
+        Args:
+            filename: The JSON file to write
+        
+        Returns:
+            True if successful, False otherwise
+        """
+        try:
+            data = self.load() or {}
+            _write_atomic(filename, json.dumps(data, ensure_ascii=False, indent=2), fsync=False)
+            return True
         except Exception as e:
-            logger.error(f"Error loading data from {self.filename}: {e}")
-            return None
+            logger.error(f"Error exporting data to {filename}: {e}")
+            return False
     
     def save(self, data):
         """
@@ -40,13 +292,1181 @@ class Storage:
         Args:
             data: The data to save
             
+        Returns:
+            True if successful, False otherwise
+        """
+        with self._data_lock, self._locked():
+            return self._write(data)
+    
+    def _write(self, data):
+        """Replace the storage file with data. The caller holds the write lock."""
+        try:
+            _write_atomic(self.filename, self._encode(data), fsync=self.fsync)
+            self._data = data
+            self._signature = self._file_signature()
+            return True
+        except Exception as e:
+            logger.error(f"Error saving data to {self.filename}: {e}")
+            return False
+    
+    def refresh(self):
+        """
+        Reload the storage file if another process changed it.
+        
+        Returns:
+            The list_ids whose content changed, empty if the file didn't change
+        """
+        # Checked without the lock: the signature only changes with the file
+        if not self._loaded or (self._file_signature() == self._signature and not self._changed):
+            return []
+        with _try_lock(self._data_lock) as acquired:
+            if not acquired:
+                # A writer is saving: it records what other processes changed
+                return []
+            changed = self._changed
+            self._changed = set()
+            if self._file_signature() != self._signature:
+                changed |= self._reload()
+            return list(changed)
+    
+    def _reload(self):
+        """
+        Load the file again. The caller holds the data lock.
+        
+        Returns:
+            The set of list_ids whose content changed
+        """
+        old_data = self._data
+        self.load()
+        return {list_id for list_id in set(old_data) | set(self._data)
+                if old_data.get(list_id) != self._data.get(list_id)}
+    
+    def list_ids(self):
+        """
+        Get the identifiers of all stored lists.
+        
+        Returns:
+            A list of list_id strings
+        """
+        if not self._loaded:
+            self.load()
+        return list(self._data)
+    
+    def load_list(self, list_id):
+        """
+        Load a single list.
+        
+        The JSON file can only be read as a whole, so it is loaded on the
+        first call and kept in memory.
+        
+        Args:
+            list_id: The identifier of the list
+        
+        Returns:
+            The list items, or None if the list doesn't exist
+        """
+        if not self._loaded:
+            self.load()
+        return self._data.get(list_id)
+    
+    def save_list(self, list_id, items, change=None):
+        """
+        Save a single shopping list.
+        
+        The JSON file can only be written as a whole, so this rewrites the
+        full document with the updated list.
+        
+        Args:
+            list_id: The identifier of the list that changed
+            items: The new content of the list
+            change: Optional (operation, index) tuple describing a single-item
+                change ("append", "update" or "delete"). Backends that store
+                items as rows use it to avoid rewriting the whole list.
+        
+        Returns:
+            True if successful, False otherwise
+        """
+        return self.save_delta({list_id: items})
+    
+    def save_delta(self, changed_lists):
+        """
+        Save only the lists that changed.
+        
+        Backends that can write partially override this. The JSON file is
+        rewritten once for all the changed lists.
+        
+        Args:
+            changed_lists: A dict mapping each changed list_id to its new
+                content, or to None if the list was deleted
+        
+        Returns:
+            True if successful, False otherwise
+        """
+        with self._data_lock, self._locked():
+            if self._file_signature() != self._signature:
+                # Another process wrote the file: apply the changes to its version
+                self._changed |= self._reload()
+            for list_id, items in changed_lists.items():
+                if items is None:
+                    self._data.pop(list_id, None)
+                else:
+                    self._data[list_id] = items
+            return self._write(self._data)
+    
+    def get_meta(self, key, default=None):
+        """
+        Read a metadata value, such as the schema version of the stored lists.
+        
+        Metadata is kept in a small JSON file next to the storage file.
+        
+        Args:
+            key: The metadata key
+            default: Value returned when the key is not set
+        
+        Returns:
+            The stored value, or default
+        """
+        try:
+            with open(self.filename + ".meta", 'r', encoding='utf-8') as f:
+                return json.load(f).get(key, default)
+        except FileNotFoundError:
+            return default
+        except Exception as e:
+            logger.error(f"Error reading metadata of {self.filename}: {e}")
+            return default
+    
+    def set_meta(self, key, value):
+        """
+        Write a metadata value.
+        
+        Args:
+            key: The metadata key
+            value: A JSON-serializable value
+        
+        Returns:
+            True if successful, False otherwise
+        """
+        meta_filename = self.filename + ".meta"
+        try:
+            with self._data_lock, self._locked():
+                meta = {}
+                if os.path.exists(meta_filename):
+                    with open(meta_filename, 'r', encoding='utf-8') as f:
+                        meta = json.load(f)
+                meta[key] = value
+                _write_atomic(meta_filename, json.dumps(meta, ensure_ascii=False), fsync=self.fsync)
+            if key == "schema_version":
+                self._stored_schema_version = value
+                if self.snapshot_format == "binary" and self._loaded and os.path.exists(self.filename):
+                    # The snapshot written by a migration still has the old version in its header
+                    return self.save_delta({})
+            return True
+        except Exception as e:
+            logger.error(f"Error writing metadata of {self.filename}: {e}")
+            return False
+    
+    def close(self):
+        """Release any resource held by the storage."""
+
+
+class WALStorage(Storage):
+    """
+    JSON storage with an append-only write-ahead log.
+    
+    Every changed list is appended to the log as one compact JSON line, so the
+    cost of a mutation depends on the size of the list and not on the number
+    of lists. The log is replayed on load and compacted into the JSON snapshot
+    every `compact_every` records.
+    
+    Several processes can share the log: appends and compactions hold the
+    cross-process write lock, and each process remembers the identity of the
+    log and the offset it has read up to. A writer first applies the records
+    appended by the others; compaction replaces the log with a new file, so
+    the others know to reload the snapshot. refresh() returns the lists
+    changed by other processes.
+    """
+    
+    def __init__(self, filename, compact_every=1000, fsync=False):
+        """
+        Initialize the storage.
+        
+        Args:
+            filename: The name of the JSON snapshot file
+            compact_every: Number of log records after which the log is compacted
+            fsync: Whether to fsync the log after every record
+        """
+        super().__init__(filename)
+        self.log_filename = filename + ".wal"
+        self.compact_every = compact_every
+        self.fsync = fsync
+        self._log = None
+        self._log_records = 0
+        # Inode of the log and offset after the last record applied to _data
+        self._log_position = (None, 0)
+        # Lists changed by other processes, found while writing, for refresh()
+        self._changed = set()
+    
+    def _log_signature(self):
+        """
+        Get the inode and size of the log.
+        
+        Returns:
+            An (inode, size) tuple, or (None, 0) if the log doesn't exist
+        """
+        try:
+            st = os.stat(self.log_filename)
+        except OSError:
+            return (None, 0)
+        return (st.st_ino, st.st_size)
+    
+    def load(self):
+        """
+        Load the snapshot and replay the log on top of it.
+        
+        Returns:
+            The loaded data, or None if neither the snapshot nor the log exist
+        """
+        with self._data_lock, self._locked():
+            return self._load()
+    
+    def _load(self):
+        """Load the snapshot and the log. The caller holds the write lock."""
+        data = super().load()
+        if not isinstance(data, dict):
+            data = {}
+        self._close_log()
+        try:
+            f = open(self.log_filename, 'rb')
+        except FileNotFoundError:
+            self._data = data
+            self._log_records = 0
+            self._log_position = (None, 0)
+            return data if os.path.exists(self.filename) else None
+        
+        with f:
+            inode = os.fstat(f.fileno()).st_ino
+            replayed, offset, _ = self._replay(f, 0, data)
+        self._data = data
+        self._log_records = replayed
+        self._log_position = (inode, offset)
+        return data
+    
+    def _replay(self, f, offset, data):
+        """
+        Apply the log records from offset to data. The caller holds the write lock.
+        
+        Args:
+            f: The log, opened in binary mode
+            offset: Where to start reading
+            data: The lists to update
+        
+        Returns:
+            A tuple (records, offset, list_ids) with the number of records
+            applied, the offset after the last one and the lists they changed
+        """
+        f.seek(offset)
+        replayed = 0
+        list_ids = set()
+        try:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # A crash can leave a partial last line behind
+                    logger.warning(f"Dropping truncated record in {self.log_filename}")
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logger.warning(f"Dropping corrupted records in {self.log_filename}")
+                    break
+                if record.get("items") is None:
+                    data.pop(record["id"], None)
+                else:
+                    data[record["id"]] = record["items"]
+                list_ids.add(record["id"])
+                replayed += 1
+                offset += len(line)
+            if offset < os.fstat(f.fileno()).st_size:
+                # Writers hold the lock, so the rest is not being written: new
+                # records must not be appended after it
+                os.truncate(self.log_filename, offset)
+        except Exception as e:
+            logger.error(f"Error replaying log {self.log_filename}: {e}")
+        return replayed, offset, list_ids
+    
+    def _catch_up(self):
+        """
+        Apply the changes written by other processes since the last read.
+        The caller holds the write lock.
+        
+        Returns:
+            The set of list_ids they changed
+        """
+        inode, offset = self._log_position
+        current_inode, size = self._log_signature()
+        if current_inode == inode and size == offset:
+            return set()
+        if current_inode != inode or size < offset:
+            # Compacted by another process: its snapshot has every change up to the new log
+            old_data = dict(self._data)
+            self._load()
+            return {list_id for list_id in set(old_data) | set(self._data)
+                    if old_data.get(list_id) != self._data.get(list_id)}
+        try:
+            with open(self.log_filename, 'rb') as f:
+                replayed, offset, list_ids = self._replay(f, offset, self._data)
+        except OSError as e:
+            logger.error(f"Error reading log {self.log_filename}: {e}")
+            return set()
+        self._log_records += replayed
+        self._log_position = (inode, offset)
+        return list_ids
+    
+    def refresh(self):
+        """
+        Apply the changes other processes appended to the log.
+        
+        Returns:
+            The list_ids whose content changed, empty if the log didn't change
+        """
+        # Checked without the locks: only a changed log needs reading
+        if not self._loaded or (self._log_signature() == self._log_position and not self._changed):
+            return []
+        with _try_lock(self._data_lock) as acquired:
+            if not acquired:
+                # A writer is appending: it records what other processes changed
+                return []
+            with self._locked():
+                changed = self._catch_up() | self._changed
+            self._changed = set()
+            return list(changed)
+    
+    def save(self, data):
+        """
+        Write a full snapshot and start a new log.
+        
+        Args:
+            data: The data to save
+        
+        Returns:
+            True if successful, False otherwise
+        """
+        with self._data_lock, self._locked():
+            return self._write_snapshot(data)
+    
+    def _write_snapshot(self, data):
+        """Write the snapshot and replace the log. The caller holds the write lock."""
+        try:
+            _write_atomic(self.filename, json.dumps(data, ensure_ascii=False, indent=2))
+        except Exception as e:
+            logger.error(f"Error saving data to {self.filename}: {e}")
+            return False
+        
+        self._data = data
+        self._loaded = True
+        # The snapshot now contains every logged change. The log is replaced
+        # rather than truncated, so other processes see a new inode and reload.
+        self._close_log()
+        try:
+            _write_atomic(self.log_filename, b"")
+        except OSError as e:
+            logger.error(f"Error replacing log {self.log_filename}: {e}")
+        self._log_records = 0
+        self._log_position = (self._log_signature()[0], 0)
+        return True
+    
+    def save_list(self, list_id, items, change=None):
+        """
+        Append the new content of a list to the log.
+        
+        Args:
+            list_id: The identifier of the list that changed
+            items: The new content of the list, or None if it was deleted
+            change: Ignored, the whole list is always written
+        
+        Returns:
+            True if successful, False otherwise
+        """
+        return self.save_delta({list_id: items})
+    
+    def save_delta(self, changed_lists):
+        """
+        Append one record per changed list to the log, with a single write.
+        
+        Args:
+            changed_lists: A dict mapping each changed list_id to its new
+                content, or to None if the list was deleted
+        
+        Returns:
+            True if successful, False otherwise
+        """
+        records = "".join(
+            json.dumps({"id": list_id, "items": items}, ensure_ascii=False, separators=(",", ":")) + "\n"
+            for list_id, items in changed_lists.items()).encode('utf-8')
+        with self._data_lock, self._locked():
+            if not self._loaded:
+                self._load()
+            self._changed |= self._catch_up()
+            inode, offset = self._log_position
+            try:
+                if self._log is None or os.fstat(self._log.fileno()).st_ino != inode:
+                    self._close_log()
+                    self._log = open(self.log_filename, 'ab')
+                    inode = os.fstat(self._log.fileno()).st_ino
+                if os.fstat(self._log.fileno()).st_size > offset:
+                    # Drop the partial record of a failed write
+                    self._log.truncate(offset)
+                self._log.write(records)
+                self._log.flush()
+                if self.fsync:
+                    os.fsync(self._log.fileno())
+            except Exception as e:
+                logger.error(f"Error appending to log {self.log_filename}: {e}")
+                self._close_log()
+                return False
+            self._log_position = (inode, offset + len(records))
+            
+            for list_id, items in changed_lists.items():
+                if items is None:
+                    self._data.pop(list_id, None)
+                else:
+                    self._data[list_id] = items
+            self._log_records += len(changed_lists)
+            if self._log_records >= self.compact_every:
+                self._write_snapshot(self._data)
+            return True
+    
+    def compact(self):
+        """
+        Fold the log into the snapshot.
+        
+        Returns:
+            True if successful, False otherwise
+        """
+        with self._data_lock, self._locked():
+            self._changed |= self._catch_up()
+            return self._write_snapshot(self._data)
+    
+    def close(self):
+        """Close the log file."""
+        self._close_log()
+    
+    def _close_log(self):
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+
+class ShardedStorage(Storage):
+    """
+    Storage that keeps every list in its own JSON file.
+    
+    Shards live in a directory and are named after the list_id. A manifest
+    file lists the known lists, so startup does not need to scan the
+    directory. A mutation only rewrites (and fsyncs) the shard it touched.
+    
+    Several processes can share the directory: writers hold the cross-process
+    write lock and append the IDs of the lists they wrote to a change log,
+    which the other processes read from the offset they reached in refresh().
+    """
+    
+    MANIFEST = "manifest.json"
+    CHANGES = "changes.log"
+    # Size after which the change log is replaced by an empty one
+    CHANGES_MAX_SIZE = 1024 * 1024
+    
+    def __init__(self, directory, legacy_filename=None, fsync=True):
+        """
+        Initialize the storage.
+        
+        Args:
+            directory: The directory holding the shards
+            legacy_filename: Optional single-file JSON storage to import on first use
+            fsync: Whether to fsync every written shard
+        """
+        super().__init__(directory)
+        self.directory = directory
+        self.legacy_filename = legacy_filename
+        self.fsync = fsync
+        self._manifest = None
+        # Inode of the change log and offset read up to. Changes made before
+        # this process started are already in the shards.
+        self._changes_position = self._changes_signature()
+        # Lists changed by other processes, found while writing, for refresh()
+        self._changed = set()
+    
+    def _shard_path(self, list_id):
+        return os.path.join(self.directory, quote(list_id, safe="") + ".json")
+    
+    def _manifest_path(self):
+        return os.path.join(self.directory, self.MANIFEST)
+    
+    def _changes_path(self):
+        return os.path.join(self.directory, self.CHANGES)
+    
+    def _changes_signature(self):
+        """
+        Get the inode and size of the change log.
+        
+        Returns:
+            An (inode, size) tuple, or (None, 0) if the log doesn't exist
+        """
+        try:
+            st = os.stat(self._changes_path())
+        except OSError:
+            return (None, 0)
+        return (st.st_ino, st.st_size)
+    
+    def _read_changes(self):
+        """
+        Read the lists changed by other processes since the last read. The
+        caller holds the write lock.
+        
+        Returns:
+            The set of list_ids they changed
+        """
+        inode, offset = self._changes_position
+        current_inode, size = self._changes_signature()
+        if current_inode == inode and size == offset:
+            return set()
+        # The manifest may have changed too
+        self._manifest = None
+        self._changes_position = (current_inode, size)
+        if current_inode == inode and size > offset:
+            try:
+                with open(self._changes_path(), 'rb') as f:
+                    f.seek(offset)
+                    return {json.loads(line) for line in f.read(size - offset).splitlines() if line}
+            except (OSError, ValueError) as e:
+                logger.error(f"Error reading the change log in {self.directory}: {e}")
+        # Replaced or unreadable: what changed is unknown, so every list may have
+        return set(self._current_manifest())
+    
+    def _current_manifest(self):
+        """Get the manifest, reading it if it's not in memory."""
+        if self._manifest is None:
+            self._manifest = self._read_manifest()
+        return self._manifest
+    
+    def _log_changes(self, list_ids):
+        """
+        Append the lists this process wrote to the change log. The caller holds the write lock.
+        
+        Args:
+            list_ids: The identifiers of the lists written, or None when every list was
+        """
+        path = self._changes_path()
+        inode, size = self._changes_signature()
+        if list_ids is None or size >= self.CHANGES_MAX_SIZE:
+            # A new log tells the other processes to reload every list
+            _write_atomic(path, b"", fsync=False)
+            self._changes_position = self._changes_signature()
+            return
+        records = "".join(json.dumps(list_id, ensure_ascii=False) + "\n" for list_id in list_ids).encode('utf-8')
+        with open(path, 'ab') as f:
+            f.write(records)
+            inode = os.fstat(f.fileno()).st_ino
+        self._changes_position = (inode, size + len(records))
+    
+    def refresh(self):
+        """
+        Read the change log for lists written by other processes.
+        
+        Returns:
+            The list_ids whose content changed, empty if the log didn't change
+        """
+        # Checked without the locks: only a changed log needs reading
+        if self._changes_signature() == self._changes_position and not self._changed:
+            return []
+        with _try_lock(self._data_lock) as acquired:
+            if not acquired:
+                # A writer is saving: it records what other processes changed
+                return []
+            with self._locked():
+                changed = self._read_changes() | self._changed
+            self._changed = set()
+            return list(changed)
+    
+    def list_ids(self):
+        """
+        Get the identifiers of all stored lists without reading the shards.
+        
+        Returns:
+            A list of list_id strings
+        """
+        if self._manifest is None:
+            self._manifest = self._read_manifest()
+            if not self._manifest:
+                self._import_legacy()
+        return list(self._manifest)
+    
+    def _import_legacy(self):
+        if not self.legacy_filename or not os.path.exists(self.legacy_filename):
+            return None
+        logger.info(f"Importing {self.legacy_filename} into {self.directory}")
+        data = Storage(self.legacy_filename).load()
+        if isinstance(data, dict) and self.save(data):
+            return data
+        return None
+    
+    def _read_manifest(self):
+        if not os.path.isdir(self.directory):
+            return {}
+        try:
+            with open(self._manifest_path(), 'r', encoding='utf-8') as f:
+                return dict.fromkeys(json.load(f)["lists"])
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error(f"Error reading manifest in {self.directory}, rebuilding it: {e}")
+        
+        # Rebuild the manifest from the shard files
+        manifest = {}
+        for entry in os.listdir(self.directory):
+            if entry.endswith(".json") and entry != self.MANIFEST:
+                manifest[unquote(entry[:-len(".json")])] = None
+        self._write_manifest(manifest)
+        return manifest
+    
+    def _write_manifest(self, manifest):
+        os.makedirs(self.directory, exist_ok=True)
+        content = json.dumps({"lists": sorted(manifest)}, ensure_ascii=False, separators=(",", ":"))
+        _write_atomic(self._manifest_path(), content, self.fsync)
+        self._manifest = manifest
+    
+    def load_list(self, list_id):
+        """
+        Load a single list from its shard.
+        
+        Args:
+            list_id: The identifier of the list
+        
+        Returns:
+            The list items, or None if the list doesn't exist or there's an error
+        """
+        if self._manifest is None:
+            self.list_ids()
+        try:
+            with open(self._shard_path(list_id), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.error(f"Error loading list {list_id} from {self.directory}: {e}")
+            return None
+    
+    def load(self):
+        """
+        Load every shard listed in the manifest.
+        
+        Returns:
+            The loaded data, or None if the storage is empty
+        """
+        list_ids = self.list_ids()
+        if not list_ids:
+            return None
+        
+        data = {}
+        for list_id in list_ids:
+            items = self.load_list(list_id)
+            if items is not None:
+                data[list_id] = items
+        return data
+    
+    def save(self, data):
+        """
+        Write every list to its shard and remove shards of deleted lists.
+        
+        Args:
+            data: The data to save
+        
+        Returns:
+            True if successful, False otherwise
+        """
+        with self._data_lock, self._locked():
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                for list_id, items in data.items():
+                    _write_atomic(self._shard_path(list_id),
+                                  json.dumps(items, ensure_ascii=False, separators=(",", ":")),
+                                  self.fsync)
+                # Also the lists other processes added
+                for list_id in set(self._read_manifest()) - set(data):
+                    os.remove(self._shard_path(list_id))
+                self._write_manifest(dict.fromkeys(data))
+                self._log_changes(None)
+                return True
+            except Exception as e:
+                logger.error(f"Error saving data to {self.directory}: {e}")
+                return False
+    
+    def save_list(self, list_id, items, change=None):
+        """
+        Write a single list to its shard.
+        
+        Args:
+            list_id: The identifier of the list that changed
+            items: The new content of the list, or None if it was deleted
+            change: Ignored, the whole list is always written
+        
+        Returns:
+            True if successful, False otherwise
+        """
+        return self.save_delta({list_id: items})
+    
+    def save_delta(self, changed_lists):
+        """
+        Write the shards of the changed lists, updating the manifest at most once.
+        
+        Args:
+            changed_lists: A dict mapping each changed list_id to its new
+                content, or to None if the list was deleted
+        
+        Returns:
+            True if successful, False otherwise
+        """
+        with self._data_lock, self._locked():
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                # Also makes the manifest below the current one
+                self._changed |= self._read_changes()
+                manifest = self._current_manifest()
+                manifest_changed = False
+                for list_id, items in changed_lists.items():
+                    if items is None:
+                        if os.path.exists(self._shard_path(list_id)):
+                            os.remove(self._shard_path(list_id))
+                        if list_id in manifest:
+                            del manifest[list_id]
+                            manifest_changed = True
+                        continue
+                    
+                    _write_atomic(self._shard_path(list_id),
+                                  json.dumps(items, ensure_ascii=False, separators=(",", ":")),
+                                  self.fsync)
+                    if list_id not in manifest:
+                        manifest[list_id] = None
+                        manifest_changed = True
+                if manifest_changed:
+                    self._write_manifest(manifest)
+                self._log_changes(changed_lists)
+                return True
+            except Exception as e:
+                logger.error(f"Error saving lists to {self.directory}: {e}")
+                return False
+
+
+class SQLiteStorage(Storage):
+    """
+    Storage based on SQLite, with one row per item.
+    
+    Items are keyed by list_id and position, so adding, updating or removing
+    an item is a single-row statement instead of a rewrite of the document.
+    Positions only grow, so removing an item never renumbers the others.
+    
+    Several processes can share the database. Every write of a list bumps
+    its version; when PRAGMA data_version shows that another connection
+    committed, refresh() compares the versions with the ones last seen, and
+    writers rewrite the lists changed meanwhile instead of trusting their
+    cached positions.
+    """
+    
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS lists (list_id TEXT PRIMARY KEY, version INTEGER NOT NULL DEFAULT 0)",
+        "CREATE TABLE IF NOT EXISTS items ("
+        " list_id TEXT NOT NULL,"
+        " position INTEGER NOT NULL,"
+        " name TEXT NOT NULL,"
+        " quantity TEXT NOT NULL,"
+        " category TEXT,"
+        " item_id TEXT,"
+        " PRIMARY KEY (list_id, position)"
+        ") WITHOUT ROWID",
+    )
+    
+    # Statements are constant strings, so sqlite3 prepares them once per connection
+    SQL_INSERT_LIST = "INSERT OR IGNORE INTO lists (list_id) VALUES (?)"
+    SQL_DELETE_LIST = "DELETE FROM lists WHERE list_id = ?"
+    SQL_TOUCH_LIST = "UPDATE lists SET version = version + 1 WHERE list_id = ?"
+    SQL_GET_LIST_VERSION = "SELECT version FROM lists WHERE list_id = ?"
+    SQL_GET_LIST_VERSIONS = "SELECT list_id, version FROM lists"
+    SQL_INSERT_ITEM = ("INSERT INTO items (list_id, position, name, quantity, category, item_id) "
+                       "VALUES (?, ?, ?, ?, ?, ?)")
+    SQL_UPDATE_ITEM = ("UPDATE items SET name = ?, quantity = ?, category = ?, item_id = ? "
+                       "WHERE list_id = ? AND position = ?")
+    SQL_DELETE_ITEM = "DELETE FROM items WHERE list_id = ? AND position = ?"
+    SQL_CLEAR_LIST = "DELETE FROM items WHERE list_id = ?"
+    SQL_GET_META = "SELECT value FROM meta WHERE key = ?"
+    SQL_SET_META = "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)"
+    
+    def __init__(self, filename, legacy_filename=None):
+        """
+        Initialize the storage.
+        
+        Args:
+            filename: The SQLite database file
+            legacy_filename: Optional JSON storage file to import when the database is empty
+        """
+        super().__init__(filename)
+        self.legacy_filename = legacy_filename
+        # Position of every item, in list order, for each list
+        self._positions = {}
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(filename, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            for statement in self.SCHEMA:
+                self._conn.execute(statement)
+            columns = [row[1] for row in self._conn.execute("PRAGMA table_info(items)")]
+            if "item_id" not in columns:
+                # Databases created before items had stable IDs
+                self._conn.execute("ALTER TABLE items ADD COLUMN item_id TEXT")
+            columns = [row[1] for row in self._conn.execute("PRAGMA table_info(lists)")]
+            if "version" not in columns:
+                # Databases created before lists had versions
+                self._conn.execute("ALTER TABLE lists ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        # Version of every list as last seen, and the data_version it was read at
+        self._list_versions = dict(self._conn.execute(self.SQL_GET_LIST_VERSIONS))
+        self._data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        # Lists changed by other processes, found while writing, for refresh()
+        self._changed = set()
+        if legacy_filename and os.path.exists(legacy_filename) and not self.list_ids():
+            self.import_json(legacy_filename)
+    
+    def list_ids(self):
+        """
+        Get the identifiers of all stored lists.
+        
+        Returns:
+            A list of list_id strings
+        """
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT list_id FROM lists")]
+    
+    def load_list(self, list_id):
+        """
+        Load a single list.
+        
+        Args:
+            list_id: The identifier of the list
+        
+        Returns:
+            The list items, or None if the list doesn't exist
+        """
+        with self._lock:
+            if self._conn.execute("SELECT 1 FROM lists WHERE list_id = ?", (list_id,)).fetchone() is None:
+                return None
+            rows = self._conn.execute(
+                "SELECT position, name, quantity, category, item_id FROM items WHERE list_id = ? ORDER BY position",
+                (list_id,)).fetchall()
+        items = []
+        positions = []
+        for position, name, quantity, category, item_id in rows:
+            items.append(self._row_to_item(name, quantity, category, item_id))
+            positions.append(position)
+        self._positions[list_id] = positions
+        return items
+    
+    def load(self):
+        """
+        Load all lists from the database.
+        
+        Returns:
+            The loaded data, or None if the database is empty
+        """
+        list_ids = self.list_ids()
+        if not list_ids:
+            return None
+        
+        data = {list_id: [] for list_id in list_ids}
+        positions = {list_id: [] for list_id in list_ids}
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT list_id, position, name, quantity, category, item_id FROM items ORDER BY list_id, position")
+            for list_id, position, name, quantity, category, item_id in rows:
+                data.setdefault(list_id, []).append(self._row_to_item(name, quantity, category, item_id))
+                positions.setdefault(list_id, []).append(position)
+        self._positions = positions
+        return data
+    
+    def import_json(self, json_filename):
+        """
+        Import the content of a JSON storage file, replacing the database content.
+        
+        Args:
+            json_filename: The JSON file written by Storage
+        
+        Returns:
+            The imported data, or None if the file could not be read
+        """
+        data = Storage(json_filename).load()
+        if not isinstance(data, dict):
+            return None
+        logger.info(f"Importing {json_filename} into {self.filename}")
+        if not self.save(data):
+            return None
+        return data
+    
+    @staticmethod
+    def _row_to_item(name, quantity, category, item_id):
+        item = {"name": name, "quantity": quantity}
+        if category is not None:
+            item["category"] = category
+        if item_id is not None:
+            item["id"] = item_id
+        return item
+    
+    def _insert_rows(self, list_id, items):
+        rows = []
+        for position, item in enumerate(items):
+            # An imported JSON file may hold items of older schema versions, which only
+            # ShoppingList migrates: keep the ones a row can hold, so they are not lost
+            if isinstance(item, str):
+                # First format: just the name
+                item = {"name": item, "quantity": "1"}
+            name = item.get("name") if isinstance(item, dict) else None
+            while isinstance(name, dict):
+                # Names nested by an old bug, see ShoppingList._repair_corrupted_data
+                name = name.get("name")
+            if not isinstance(name, str):
+                # Entries that are not items have no row representation
+                continue
+            rows.append((list_id, position, name, str(item.get("quantity", "1")), item.get("category"),
+                         item.get("id")))
+        self._conn.executemany(self.SQL_INSERT_ITEM, rows)
+        self._positions[list_id] = [row[1] for row in rows]
+    
+    def save(self, data):
+        """
+        Replace the content of the database.
+        
+        Args:
+            data: The data to save
+        
         Returns:
             True if successful, False otherwise
         """
         try:
-            with open(self.filename, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            with self._lock, self._conn:
+                self._conn.execute("BEGIN IMMEDIATE")
+                # Versions keep growing, so other processes see every list as changed
+                versions = {list_id: version + 1 for list_id, version in self._conn.execute(
+                    self.SQL_GET_LIST_VERSIONS) if list_id in data}
+                self._conn.execute("DELETE FROM items")
+                self._conn.execute("DELETE FROM lists")
+                self._positions = {}
+                self._conn.executemany("INSERT INTO lists (list_id, version) VALUES (?, ?)",
+                                       [(list_id, versions.get(list_id, 1)) for list_id in data])
+                for list_id, items in data.items():
+                    self._insert_rows(list_id, items if isinstance(items, list) else [])
+                self._list_versions = dict(self._conn.execute(self.SQL_GET_LIST_VERSIONS))
             return True
         except Exception as e:
             logger.error(f"Error saving data to {self.filename}: {e}")
             return False
+    
+    def save_list(self, list_id, items, change=None):
+        """
+        Save a single list, using a single-row statement when possible.
+        
+        Args:
+            list_id: The identifier of the list that changed
+            items: The new content of the list, or None if it was deleted
+            change: Optional (operation, index) tuple describing a single-item change
+        
+        Returns:
+            True if successful, False otherwise
+        """
+        operation, index = change if change else (None, None)
+        if items is None or operation not in ("append", "update", "delete"):
+            return self.save_delta({list_id: items})
+        try:
+            with self._lock, self._conn:
+                self._conn.execute("BEGIN IMMEDIATE")
+                self._changed |= self._read_changes()
+                self._touch_list(list_id)
+                positions = self._positions.get(list_id)
+                
+                if positions is None:
+                    # New, or changed by another process: its rows are rewritten
+                    self._conn.execute(self.SQL_CLEAR_LIST, (list_id,))
+                    self._insert_rows(list_id, items)
+                elif operation == "append" and index == len(positions):
+                    item = items[index]
+                    position = positions[-1] + 1 if positions else 0
+                    self._conn.execute(self.SQL_INSERT_ITEM, (
+                        list_id, position, item["name"], str(item["quantity"]), item.get("category"), item.get("id")))
+                    positions.append(position)
+                elif operation == "update" and 0 <= index < len(positions):
+                    item = items[index]
+                    self._conn.execute(self.SQL_UPDATE_ITEM, (
+                        item["name"], str(item["quantity"]), item.get("category"), item.get("id"),
+                        list_id, positions[index]))
+                elif operation == "delete" and 0 <= index < len(positions):
+                    self._conn.execute(self.SQL_DELETE_ITEM, (list_id, positions.pop(index)))
+                else:
+                    # Positions out of sync with the list, rewrite its rows
+                    self._conn.execute(self.SQL_CLEAR_LIST, (list_id,))
+                    self._insert_rows(list_id, items)
+            return True
+        except Exception as e:
+            logger.error(f"Error saving list {list_id} to {self.filename}: {e}")
+            return False
+    
+    def save_delta(self, changed_lists):
+        """
+        Replace the rows of the changed lists in a single transaction.
+        
+        Args:
+            changed_lists: A dict mapping each changed list_id to its new
+                content, or to None if the list was deleted
+        
+        Returns:
+            True if successful, False otherwise
+        """
+        try:
+            with self._lock, self._conn:
+                self._conn.execute("BEGIN IMMEDIATE")
+                self._changed |= self._read_changes()
+                for list_id, items in changed_lists.items():
+                    self._conn.execute(self.SQL_CLEAR_LIST, (list_id,))
+                    if items is None:
+                        self._conn.execute(self.SQL_DELETE_LIST, (list_id,))
+                        self._positions.pop(list_id, None)
+                        self._list_versions.pop(list_id, None)
+                        continue
+                    self._touch_list(list_id)
+                    self._insert_rows(list_id, items)
+            return True
+        except Exception as e:
+            logger.error(f"Error saving lists to {self.filename}: {e}")
+            return False
+    
+    def _touch_list(self, list_id):
+        """Create a list if needed and bump its version. Call in a write transaction with _lock held."""
+        self._conn.execute(self.SQL_INSERT_LIST, (list_id,))
+        self._conn.execute(self.SQL_TOUCH_LIST, (list_id,))
+        self._list_versions[list_id] = self._conn.execute(self.SQL_GET_LIST_VERSION, (list_id,)).fetchone()[0]
+    
+    def _read_changes(self):
+        """
+        Find the lists other connections wrote since the last check. Call with _lock held.
+        
+        Returns:
+            The set of list_ids they changed
+        """
+        data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        if data_version == self._data_version:
+            return set()
+        self._data_version = data_version
+        versions = dict(self._conn.execute(self.SQL_GET_LIST_VERSIONS))
+        changed = {list_id for list_id in set(versions) | set(self._list_versions)
+                   if versions.get(list_id) != self._list_versions.get(list_id)}
+        self._list_versions = versions
+        for list_id in changed:
+            # Its rows may have changed: the cached positions no longer apply
+            self._positions.pop(list_id, None)
+        return changed
+    
+    def refresh(self):
+        """
+        Find the lists written by other processes.
+        
+        Returns:
+            The list_ids whose content changed, empty if no other process wrote
+        """
+        with _try_lock(self._lock) as acquired:
+            if not acquired:
+                # A writer is committing: it records what other connections changed
+                return []
+            changed = self._read_changes() | self._changed
+            self._changed = set()
+        return list(changed)
+    
+    def get_meta(self, key, default=None):
+        """
+        Read a metadata value from the meta table.
+        
+        Args:
+            key: The metadata key
+            default: Value returned when the key is not set
+        
+        Returns:
+            The stored value, or default
+        """
+        try:
+            with self._lock:
+                row = self._conn.execute(self.SQL_GET_META, (key,)).fetchone()
+            return json.loads(row[0]) if row else default
+        except Exception as e:
+            logger.error(f"Error reading metadata from {self.filename}: {e}")
+            return default
+    
+    def set_meta(self, key, value):
+        """
+        Write a metadata value to the meta table.
+        
+        Args:
+            key: The metadata key
+            value: A JSON-serializable value
+        
+        Returns:
+            True if successful, False otherwise
+        """
+        try:
+            with self._lock, self._conn:
+                self._conn.execute(self.SQL_SET_META, (key, json.dumps(value)))
+            return True
+        except Exception as e:
+            logger.error(f"Error writing metadata to {self.filename}: {e}")
+            return False
+    
+    def close(self):
+        """Close the database connection."""
+        with self._lock:
+            self._conn.close()
+
+
+def create_storage(filename, schema_version=None):
+    """
+    Create the storage backend selected by the STORAGE_BACKEND environment variable.
+    
+    Supported values are "json" (default), "wal", "sharded" and "sqlite".
+    With the json backend STORAGE_FORMAT=binary switches to a binary snapshot
+    next to the JSON file, imported from it on first start.
+    
+    Every backend can be shared by several processes, each with its own
+    ShoppingList: writes are coordinated across processes and refresh()
+    reports the lists the others changed. Concurrent changes of the same
+    list are last-writer-wins.
+    
+    Args:
+        filename: The name of the file to store data in
+        schema_version: The newest schema version of the lists the caller can read
+    
+    Returns:
+        A Storage instance
+    """
+    backend = os.environ.get("STORAGE_BACKEND", "json").lower()
+    if backend == "wal":
+        compact_every = int(os.environ.get("STORAGE_WAL_COMPACT_EVERY", "1000"))
+        fsync = os.environ.get("STORAGE_FSYNC", "0") == "1"
+        return WALStorage(filename, compact_every=compact_every, fsync=fsync)
+    if backend == "sharded":
+        directory = os.path.splitext(filename)[0]
+        fsync = os.environ.get("STORAGE_FSYNC", "1") == "1"
+        return ShardedStorage(directory, legacy_filename=filename, fsync=fsync)
+    if backend == "sqlite":
+        return SQLiteStorage(os.path.splitext(filename)[0] + ".db", legacy_filename=filename)
+    if backend != "json":
+        logger.warning(f"Unknown storage backend '{backend}', using json")
+    fsync = os.environ.get("STORAGE_FSYNC", "0") == "1"
+    snapshot_format = os.environ.get("STORAGE_FORMAT", "json").lower()
+    if snapshot_format == "binary":
+        compress = os.environ.get("STORAGE_COMPRESS", "0") == "1"
+        return Storage(os.path.splitext(filename)[0] + ".snap", fsync=fsync, snapshot_format="binary",
+                       compress=compress, legacy_filename=filename, schema_version=schema_version)
+    if snapshot_format != "json":
+        logger.warning(f"Unknown storage format '{snapshot_format}', using json")
+    return Storage(filename, fsync=fsync, schema_version=schema_version)
@@ -28,16 +28,20 @@ logging.basicConfig(
 logger = logging.getLogger("telegram_bot")
 
 # Import required components
-from shopping_list import ShoppingList
+from shopping_list import split_items, parse_item_numbers
+from state_server import create_async_shopping_list
 from ai_assistant import AIAssistant
+from list_locks import ListLocks, ConversationOrderProcessor
+from webhook import webhook_config, run_webhook
+from send_scheduler import create_send_scheduler
 from constants import (
-    START_MSG, HELP_MSG, ITEM_ADDED_MSG, LIST_EMPTY_MSG, LIST_HEADER_MSG,
-    ITEM_REMOVED_MSG, LIST_CLEARED_MSG, QUANTITY_UPDATED_MSG, SUGGEST_RESPONSE_MSG,
+    START_MSG, HELP_MSG, ITEM_ADDED_MSG, ITEMS_ADDED_MSG, LIST_EMPTY_MSG, LIST_HEADER_MSG,
+    ITEM_REMOVED_MSG, ITEMS_REMOVED_MSG, LIST_CLEARED_MSG, LIST_CHANGED_MSG, LIST_FULL_MSG, QUANTITY_UPDATED_MSG, SUGGEST_RESPONSE_MSG,
     QUANTITY_PROMPT, BTN_ADD, BTN_LIST, BTN_REMOVE, BTN_CLEAR, BTN_SUGGEST,
     BTN_CATEGORIES, BTN_MEAL_PLAN, BTN_HELP, BTN_CANCEL, BTN_BACK,
     CB_ADD, CB_REMOVE, CB_SHOW, CB_CLEAR, CB_SUGGEST, CB_CATEGORIES, CB_MEAL,
     CB_CANCEL, CB_BACK, CB_SET_QTY, STATE_WAITING_ITEM, STATE_WAITING_QUANTITY,
-    STATE_WAITING_REMOVE, STATE_WAITING_QUESTION, ERROR_MSG
+    STATE_WAITING_REMOVE, STATE_WAITING_QUESTION, ALLOWED_UPDATES, ERROR_MSG
 )
 
 # Mappa delle emoji per ogni categoria
@@ -69,8 +73,30 @@ def get_category_emoji(category):
     return CATEGORY_EMOJI.get(category, "📦")
 
 # Initialize global variables
-shopping_list = ShoppingList()
+# Writes happen on a background thread so handlers never block the event loop
+# With STATE_SOCKET set, the lists live in the shared state server (state_server.py)
+shopping_list = create_async_shopping_list(background_writes=True)
 ai_assistant = AIAssistant()
+# Updates are processed concurrently: handlers hold the lock of a list while they change it
+list_locks = ListLocks()
+
+def list_lock(update):
+    """
+    Get the lock of the list of an update's chat, so that changes to the same
+    list are processed one at a time and in order.
+
+    Handlers hold it only while they read and change the list: the reply is
+    sent after releasing it, since the send scheduler may delay it by seconds
+    when a group chat is at its rate limit.
+
+    Args:
+        update: The update being handled
+
+    Returns:
+        An async context manager holding the lock
+    """
+    list_id = shopping_list.get_list_id(update.effective_chat.id, update.effective_user.id)
+    return list_locks.hold(list_id)
 
 # Main menu keyboard
 def get_main_keyboard():
@@ -157,7 +183,12 @@ async def process_add_item(update: Update, context: ContextTypes.DEFAULT_TYPE, i
             
         item_text = update.message.text
     
-    success, item_name, quantity, category = shopping_list.add_item(chat_id, item_text, user_id)
+    # Una lista incollata ("pane, latte e 2 kg di patate") viene aggiunta e salvata in una volta
+    async with list_lock(update):
+        results = await shopping_list.add_items(chat_id, split_items(item_text), user_id)
+    added = [result for result in results if result[0] and result[1]]
+    # Articoli nuovi rifiutati perché la lista ha già il numero massimo di articoli
+    refused = [result for result in results if not result[0] and result[1]]
     
     # Determina il tipo di lista (gruppo o personale)
     list_type = shopping_list.get_list_type(chat_id)
@@ -166,14 +197,29 @@ async def process_add_item(update: Update, context: ContextTypes.DEFAULT_TYPE, i
         InlineKeyboardButton("📋 Mostra Lista", callback_data=CB_SHOW)
     ]])
     
-    if success:
+    if len(added) > 1:
+        # Un solo messaggio di riepilogo per tutti gli articoli
+        reply_text = ITEMS_ADDED_MSG.format(count=len(added)) + "\n"
+        for _, item_name, quantity, category in added:
+            category_emoji = get_category_emoji(category)
+            if quantity == "1":
+                reply_text += f"\n{category_emoji} {item_name}"
+            else:
+                reply_text += f"\n{category_emoji} {item_name} - {quantity}"
+        reply_text += f"\n\n_{list_type}_"
+    elif added:
+        success, item_name, quantity, category = added[0]
         # Aggiungi emoji per la categoria
         category_emoji = get_category_emoji(category)
         reply_text = ITEM_ADDED_MSG.format(item=item_name, quantity=quantity) + f"\n{category_emoji} Categoria: *{category}*"
         # Aggiungi l'informazione sul tipo di lista
         reply_text += f"\n\n_{list_type}_"
+    elif refused:
+        reply_text = LIST_FULL_MSG
     else:
         reply_text = "Non sono riuscito ad aggiungere l'articolo. Riprova."
+    if added and refused:
+        reply_text += "\n\n" + LIST_FULL_MSG
     
     # Invia la risposta in base al tipo di update
     if update.callback_query:
@@ -190,23 +236,35 @@ async def process_add_item(update: Update, context: ContextTypes.DEFAULT_TYPE, i
     
     return ConversationHandler.END
 
-async def show_list(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Display the current shopping list with buttons for each item."""
-    user_id = update.effective_user.id
-    chat_id = update.effective_chat.id
-    items = shopping_list.get_items(chat_id, user_id)
+def parse_item_callback(data):
+    """
+    Split the callback_data of an item button.
     
-    # Handle both message and callback query
-    if update.callback_query:
-        await update.callback_query.answer()
-        message = update.callback_query.message
-    else:
-        message = update.message
+    Args:
+        data: e.g. "remove:k3x9a:81234", action, item ID and list version
+        
+    Returns:
+        A tuple (item_id, version), version is None for buttons rendered without one
+    """
+    parts = data.split(":")
+    if len(parts) not in (2, 3) or not parts[1]:
+        raise ValueError(f"Invalid callback data: {data}")
+    return parts[1], int(parts[2]) if len(parts) == 3 else None
+
+def render_list(chat_id, items):
+    """
+    Build the text and the buttons that show a shopping list.
     
-    if not items:
-        await message.reply_text(LIST_EMPTY_MSG)
-        return
+    The buttons carry the ID of their item and the version of the list they
+    were rendered from, so a tap on an outdated message can be recognized.
     
+    Args:
+        chat_id: The telegram chat ID
+        items: The ListSnapshot to show, not empty
+        
+    Returns:
+        A tuple (message_text, reply_markup)
+    """
     # Get list type (group or personal)
     list_type = shopping_list.get_list_type(chat_id)
     message_text = f"*{LIST_HEADER_MSG}*\n_{list_type}_\n\n"
@@ -226,7 +284,7 @@ async def show_list(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             "index": index,
             "name": item_name,
             "quantity": quantity,
-            "item_index": index-1  # Zero-based index for callbacks
+            "item_id": item.id  # Stable ID for callbacks
         })
     
     # Sort categories alphabetically, but put "Altro" at the end
@@ -251,8 +309,10 @@ async def show_list(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             
             # Add buttons for each item with clear labels
             keyboard.append([
-                InlineKeyboardButton(f"🗑️ Rimuovi {index}", callback_data=f"{CB_REMOVE}:{item['item_index']}"),
-                InlineKeyboardButton(f"📝 Modifica {index}", callback_data=f"{CB_SET_QTY}:{item['item_index']}")
+                InlineKeyboardButton(f"🗑️ Rimuovi {index}",
+                                     callback_data=f"{CB_REMOVE}:{item['item_id']}:{items.version}"),
+                InlineKeyboardButton(f"📝 Modifica {index}",
+                                     callback_data=f"{CB_SET_QTY}:{item['item_id']}:{items.version}")
             ])
     
     # Add common action buttons
@@ -261,28 +321,65 @@ async def show_list(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         InlineKeyboardButton("🧹 Svuota", callback_data=CB_CLEAR)
     ])
     
+    return message_text, InlineKeyboardMarkup(keyboard)
+
+async def show_list(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Display the current shopping list with buttons for each item."""
+    user_id = update.effective_user.id
+    chat_id = update.effective_chat.id
+    items = await shopping_list.get_items(chat_id, user_id)
+    
+    # Handle both message and callback query
+    if update.callback_query:
+        await update.callback_query.answer()
+        message = update.callback_query.message
+    else:
+        message = update.message
+    
+    if not items:
+        await message.reply_text(LIST_EMPTY_MSG)
+        return
+    
+    message_text, reply_markup = render_list(chat_id, items)
     await message.reply_text(
         message_text,
-        reply_markup=InlineKeyboardMarkup(keyboard),
+        reply_markup=reply_markup,
+        parse_mode=ParseMode.MARKDOWN
+    )
+
+async def show_changed_list(query, chat_id, user_id, reply_text=LIST_CHANGED_MSG) -> None:
+    """
+    Show the current list in place of an outdated message, once, so that
+    its new buttons match the list again.
+    
+    Args:
+        query: The callback query of the outdated button
+        chat_id: The telegram chat ID
+        user_id: The telegram user ID
+        reply_text: The text shown above the list
+    """
+    items = await shopping_list.get_items(chat_id, user_id)
+    if not items:
+        await query.message.edit_text(f"{reply_text}\n\n{LIST_EMPTY_MSG}", parse_mode=ParseMode.MARKDOWN)
+        return
+    message_text, reply_markup = render_list(chat_id, items)
+    await query.message.edit_text(
+        f"{reply_text}\n\n{message_text}",
+        reply_markup=reply_markup,
         parse_mode=ParseMode.MARKDOWN
     )
 
 async def start_removing_item(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Start the conversation to remove an item."""
     if update.message and update.message.text and update.message.text.startswith("/rimuovi"):
-        # Command format: /rimuovi <index>
+        # Command format: /rimuovi <numeri>, e.g. /rimuovi 1,3,5-7
         text = update.message.text.split(" ", 1)
-        if len(text) > 1:
-            try:
-                index = int(text[1].strip()) - 1
-                return await process_remove_item(update, context, index)
-            except ValueError:
-                await update.message.reply_text("Inserisci un numero valido.")
-                return ConversationHandler.END
+        if len(text) > 1 and text[1].strip():
+            return await process_remove_item(update, context)
     
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
-    items = shopping_list.get_items(chat_id, user_id)
+    items = await shopping_list.get_items(chat_id, user_id)
     
     # Check if the list is empty
     if not items:
@@ -294,7 +391,7 @@ async def start_removing_item(update: Update, context: ContextTypes.DEFAULT_TYPE
             await update.message.reply_text("La tua lista della spesa è vuota.")
         return ConversationHandler.END
     
-    message = "Quale articolo vuoi rimuovere? Inserisci il numero:\n\n"
+    message = "Quale articolo vuoi rimuovere? Inserisci il numero (o più numeri, es. 1,3,5-7):\n\n"
     for index, item in enumerate(items, start=1):
         item_name = item["name"]
         quantity = item["quantity"]
@@ -312,8 +409,8 @@ async def start_removing_item(update: Update, context: ContextTypes.DEFAULT_TYPE
     row = []
     
     # Create a grid of number buttons, 3 per row
-    for index in range(1, len(items) + 1):
-        row.append(InlineKeyboardButton(str(index), callback_data=f"{CB_REMOVE}:{index-1}"))
+    for index, item in enumerate(items, start=1):
+        row.append(InlineKeyboardButton(str(index), callback_data=f"{CB_REMOVE}:{item.id}:{items.version}"))
         if len(row) == 3 or index == len(items):
             keyboard.append(row)
             row = []
@@ -346,31 +443,66 @@ async def process_remove_callback(update: Update, context: ContextTypes.DEFAULT_
         await query.message.edit_text("Operazione annullata.")
         return ConversationHandler.END
     
-    # Extract the index from the callback data
+    # Extract the item ID and the list version from the callback data
     try:
-        _, index_str = query.data.split(":")
-        index = int(index_str)
-        return await process_remove_item(update, context, index)
-    except (ValueError, IndexError):
-        await query.message.edit_text("Errore: indice non valido. Riprova.")
+        item_id, version = parse_item_callback(query.data)
+    except ValueError:
+        await query.message.edit_text("Errore: articolo non valido. Riprova.")
         return ConversationHandler.END
+    return await process_remove_item(update, context, [item_id], version)
+
+async def process_remove_item(update: Update, context: ContextTypes.DEFAULT_TYPE, item_ids=None, version=None) -> int:
+    """
+    Remove items from the shopping list.
 
-async def process_remove_item(update: Update, context: ContextTypes.DEFAULT_TYPE, index) -> int:
-    """Remove an item from the shopping list by index."""
+    Args:
+        item_ids: The IDs of the items to remove. If None, the item numbers
+            are read from the message text, e.g. "1,3,5-7".
+        version: The list version the tapped button was rendered from, if any
+    """
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
     
     try:
-        removed_item = shopping_list.remove_item(chat_id, index, user_id)
+        # Someone changed the list after the button was rendered. The item ID
+        # still names the item the user saw, so the removal goes on (rebased
+        # by ID) and the reply shows the current list.
+        async with list_lock(update):
+            current_version = await shopping_list.get_version(chat_id, user_id)
+            stale = version is not None and version != current_version
+            if stale:
+                logger.info(f"Outdated remove button in chat {chat_id}: version {version}, now {current_version}")
+            
+            if item_ids is None:
+                # Map the numbers shown to the user to the IDs of the current list
+                text = update.message.text
+                if text.startswith("/rimuovi"):
+                    text = text.split(" ", 1)[1] if " " in text else ""
+                items = await shopping_list.get_items(chat_id, user_id)
+                numbers = parse_item_numbers(text, len(items))
+                item_ids = [items[number - 1].id for number in numbers] if numbers else []
+            
+            removed_items = await shopping_list.remove_items(chat_id, item_ids, user_id)
         
-        if removed_item:
-            reply_text = ITEM_REMOVED_MSG.format(item=removed_item["name"])
+        if removed_items:
+            if len(removed_items) == 1:
+                reply_text = ITEM_REMOVED_MSG.format(item=removed_items[0]["name"])
+            else:
+                reply_text = ITEMS_REMOVED_MSG.format(
+                    count=len(removed_items),
+                    items=", ".join(item["name"] for item in removed_items)
+                )
+            
+            # Reply based on the type of update
+            if update.callback_query and stale:
+                # The current list already says whose list it is
+                await show_changed_list(update.callback_query, chat_id, user_id, reply_text)
+                return ConversationHandler.END
             
             # Get list type (group or personal)
             list_type = shopping_list.get_list_type(chat_id)
             reply_text += f"\n\n_{list_type}_"
             
-            # Reply based on the type of update
             if update.callback_query:
                 await update.callback_query.message.edit_text(
                     reply_text,
@@ -391,7 +523,8 @@ async def process_remove_item(update: Update, context: ContextTypes.DEFAULT_TYPE
             reply_text = "Numero non valido. Usa /lista per vedere i numeri degli articoli."
             
             if update.callback_query:
-                await update.callback_query.message.edit_text(reply_text)
+                # The button of an item already removed, e.g. from an older message
+                await show_changed_list(update.callback_query, chat_id, user_id)
             else:
                 await update.message.reply_text(reply_text)
     except Exception as e:
@@ -410,17 +543,16 @@ async def start_setting_quantity(update: Update, context: ContextTypes.DEFAULT_T
     query = update.callback_query
     await query.answer()
     
-    # Extract the index from the callback data
+    # Extract the item ID from the callback data
     try:
-        _, index_str = query.data.split(":")
-        index = int(index_str)
+        # The version isn't needed: the ID finds the item even if the list changed
+        item_id, version = parse_item_callback(query.data)
         user_id = update.effective_user.id
         chat_id = update.effective_chat.id
-        items = shopping_list.get_items(chat_id, user_id)
+        item = await shopping_list.get_item(chat_id, item_id, user_id)
         
-        if 0 <= index < len(items):
-            item = items[index]
-            context.user_data["current_item_index"] = index
+        if item is not None:
+            context.user_data["current_item_id"] = item_id
             context.user_data["current_item_name"] = item["name"]
             
             await query.message.edit_text(
@@ -431,10 +563,11 @@ async def start_setting_quantity(update: Update, context: ContextTypes.DEFAULT_T
             )
             return STATE_WAITING_QUANTITY
         else:
-            await query.message.edit_text("Errore: articolo non trovato.")
+            # Removed after the button was rendered
+            await show_changed_list(query, chat_id, user_id)
             return ConversationHandler.END
-    except (ValueError, IndexError):
-        await query.message.edit_text("Errore: indice non valido. Riprova.")
+    except ValueError:
+        await query.message.edit_text("Errore: articolo non valido. Riprova.")
         return ConversationHandler.END
 
 async def process_set_quantity(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -447,11 +580,12 @@ async def process_set_quantity(update: Update, context: ContextTypes.DEFAULT_TYP
     chat_id = update.effective_chat.id
     new_quantity = update.message.text.strip()
     
-    if "current_item_index" in context.user_data:
-        index = context.user_data["current_item_index"]
+    if "current_item_id" in context.user_data:
+        item_id = context.user_data["current_item_id"]
         item_name = context.user_data["current_item_name"]
         
-        success = shopping_list.update_quantity(chat_id, index, new_quantity, user_id)
+        async with list_lock(update):
+            success = await shopping_list.update_item_quantity(chat_id, item_id, new_quantity, user_id)
         
         if success:
             await update.message.reply_text(
@@ -461,13 +595,19 @@ async def process_set_quantity(update: Update, context: ContextTypes.DEFAULT_TYP
                 ]])
             )
         else:
-            await update.message.reply_text("Si è verificato un errore. Riprova.")
+            # Removed by someone else while the quantity was being typed
+            await update.message.reply_text(
+                f"\"{item_name}\" non è più nella lista.",
+                reply_markup=InlineKeyboardMarkup([[
+                    InlineKeyboardButton("📋 Mostra Lista", callback_data=CB_SHOW)
+                ]])
+            )
     else:
         await update.message.reply_text("Si è verificato un errore. Riprova dall'inizio.")
     
     # Clear the user data
-    if "current_item_index" in context.user_data:
-        del context.user_data["current_item_index"]
+    if "current_item_id" in context.user_data:
+        del context.user_data["current_item_id"]
     if "current_item_name" in context.user_data:
         del context.user_data["current_item_name"]
     
@@ -495,7 +635,8 @@ async def clear_list(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
         
         if "confirm" in query.data:
             # User confirmed clearing the list
-            shopping_list.clear_list(chat_id, user_id)
+            async with list_lock(update):
+                await shopping_list.clear_list(chat_id, user_id)
             message_text = f"{LIST_CLEARED_MSG}\n\n_{list_type}_"
             await query.message.edit_text(message_text, parse_mode=ParseMode.MARKDOWN)
         else:
@@ -529,7 +670,7 @@ async def suggest(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Get AI-powered suggestions based on the current shopping list."""
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
-    items = shopping_list.get_items(chat_id, user_id)
+    items = await shopping_list.get_items(chat_id, user_id)
     item_names = [item["name"] for item in items]  # Extract just the names for AI
     
     # Handle both message and callback query
@@ -596,7 +737,7 @@ async def process_ai_question(update: Update, context: ContextTypes.DEFAULT_TYPE
             
         question = update.message.text
     
-    items = shopping_list.get_items(chat_id, user_id)
+    items = await shopping_list.get_items(chat_id, user_id)
     item_names = [item["name"] for item in items]  # Extract just the names for AI
     
     if not items:
@@ -638,7 +779,7 @@ async def categorize(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     """Categorize items in the shopping list."""
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
-    items = shopping_list.get_items(chat_id, user_id)
+    items = await shopping_list.get_items(chat_id, user_id)
     item_names = [item["name"] for item in items]  # Extract just the names for AI
     
     # Handle both message and callback query
@@ -673,7 +814,7 @@ async def meal_plan(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Generate a meal plan based on items in the shopping list."""
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
-    items = shopping_list.get_items(chat_id, user_id)
+    items = await shopping_list.get_items(chat_id, user_id)
     item_names = [item["name"] for item in items]  # Extract just the names for AI
     
     # Handle both message and callback query
@@ -756,16 +897,39 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await query.answer("Operazione non riconosciuta")
 
 
-if __name__ == "__main__":
-    # This code only runs when the script is executed directly, not when imported
-    token = os.environ.get("TELEGRAM_TOKEN")
-    if not token:
-        logger.error("TELEGRAM_TOKEN environment variable not set!")
-        sys.exit(1)
+def build_application(token, request=None):
+    """
+    Create the bot Application with all its handlers.
+
+    Args:
+        token: The Telegram bot token
+        request: The telegram.request.BaseRequest used to call the Bot API,
+            an HTTPXRequest by default
+
+    Returns:
+        The Application, not initialized yet
+    """
+    # Updates are processed concurrently, so a slow AI call in one chat doesn't
+    # hold up the others. The updates of a conversation are processed in order,
+    # since ConversationHandler state isn't safe otherwise, and changes to the
+    # same list are serialized by list_locks.
+    concurrent_updates = int(os.environ.get("BOT_CONCURRENT_UPDATES", "64"))
     
     # Create the Application with custom request handler
-    request = HTTPXRequest(connection_pool_size=8)  # Configure only essential parameters
-    application = ApplicationBuilder().token(token).request(request).build()
+    # One connection per update being processed, so replies don't queue for a connection
+    if request is None:
+        request = HTTPXRequest(connection_pool_size=max(8, concurrent_updates))
+    builder = (
+        ApplicationBuilder()
+        .token(token)
+        .request(request)
+        .concurrent_updates(ConversationOrderProcessor(concurrent_updates))
+    )
+    # Outgoing messages are queued per chat and sent within Telegram's rate limits
+    send_scheduler = create_send_scheduler()
+    if send_scheduler:
+        builder.rate_limiter(send_scheduler)
+    application = builder.build()
     
     # Add conversation handlers
     add_item_conv = ConversationHandler(
@@ -847,6 +1011,23 @@ if __name__ == "__main__":
     # Add callback query handler
     application.add_handler(CallbackQueryHandler(handle_callback))
     
-    # Start the Bot
-    logger.info("Starting bot polling...")
-    application.run_polling(allowed_updates=["message", "callback_query"])
\ No newline at end of file
+    return application
+
+if __name__ == "__main__":
+    # This code only runs when the script is executed directly, not when imported
+    token = os.environ.get("TELEGRAM_TOKEN")
+    if not token:
+        logger.error("TELEGRAM_TOKEN environment variable not set!")
+        sys.exit(1)
+    
+    application = build_application(token)
+    
+    # Start the Bot: with WEBHOOK_URL or BOT_MODE=webhook Telegram pushes the
+    # updates to the embedded webhook server, otherwise they are polled
+    config = webhook_config()
+    if config:
+        logger.info("Starting bot webhook...")
+        run_webhook(application, config, allowed_updates=ALLOWED_UPDATES)
+    else:
+        logger.info("Starting bot polling...")
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
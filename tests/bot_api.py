@@ -0,0 +1,65 @@
+"""
+A fake Telegram Bot API and recorded updates, shared by the tests and by
+benchmark.py.
+"""
+
+import json
+import time
+
+def fake_bot_api(on_send=None, on_initialize=None, on_shutdown=None):
+    """
+    A telegram.request.BaseRequest answering the Bot API calls locally.
+
+    Args:
+        on_send: Called with the chat_id and text of every message sent
+        on_initialize: Called when the bot initializes its requests
+        on_shutdown: Called when the bot shuts down its requests
+
+    Returns:
+        The request object, to pass to telegram_bot.build_application()
+    """
+    from telegram.request import BaseRequest
+
+    class FakeBotAPI(BaseRequest):
+        async def initialize(self):
+            if on_initialize:
+                on_initialize()
+
+        async def shutdown(self):
+            if on_shutdown:
+                on_shutdown()
+
+        async def do_request(self, url, method, request_data=None, **kwargs):
+            endpoint = url.rsplit("/", 1)[-1]
+            parameters = request_data.parameters if request_data else {}
+            if endpoint == "getMe":
+                result = {"id": 1, "is_bot": True, "first_name": "Spesa", "username": "spesa_bot"}
+            elif endpoint == "sendMessage":
+                chat_id = int(parameters["chat_id"])
+                result = {"message_id": 1, "date": int(time.time()), "text": parameters["text"],
+                          "chat": {"id": chat_id, "type": "group" if chat_id < 0 else "private"}}
+                if on_send:
+                    on_send(chat_id, parameters["text"])
+            else:
+                result = True
+            return 200, json.dumps({"ok": True, "result": result}).encode()
+
+    return FakeBotAPI()
+
+def recorded_update(update_id, chat_id, text, user_id=None):
+    """An update with a text message as Telegram POSTs it to the webhook."""
+    user_id = user_id or chat_id
+    if chat_id < 0:
+        chat = {"id": chat_id, "title": "Spesa di casa", "type": "group"}
+    else:
+        chat = {"id": chat_id, "first_name": "Mario", "type": "private"}
+    message = {
+        "message_id": update_id,
+        "from": {"id": user_id, "is_bot": False, "first_name": "Mario", "language_code": "it"},
+        "chat": chat,
+        "date": 1700000000 + update_id,
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"offset": 0, "length": len(text.split(" ", 1)[0]), "type": "bot_command"}]
+    return {"update_id": update_id, "message": message}
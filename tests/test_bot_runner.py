@@ -0,0 +1,50 @@
+"""Stopping bot_runner.py with handlers still running."""
+
+import os
+import asyncio
+import importlib
+import pytest
+from telegram import Update
+from telegram.ext import ApplicationBuilder, TypeHandler
+from tests.bot_api import fake_bot_api, recorded_update
+
+@pytest.fixture(scope="module")
+def bot_runner(tmp_path_factory):
+    """bot_runner, imported in an empty directory, where its shopping list creates its files."""
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("runner"))
+    try:
+        module = importlib.import_module("bot_runner")
+        yield module
+        module.shopping_list.close()
+    finally:
+        os.chdir(cwd)
+
+@pytest.mark.parametrize("concurrent_updates", [False, 8])
+def test_drain_cancels_the_handlers_before_shutdown(bot_runner, concurrent_updates):
+    cancelled = []
+
+    async def stuck(update, context):
+        try:
+            await asyncio.sleep(3600)
+        except asyncio.CancelledError:
+            cancelled.append(update.update_id)
+            raise
+
+    async def run():
+        application = (ApplicationBuilder().token("1:TEST").request(fake_bot_api())
+                       .concurrent_updates(concurrent_updates).updater(None).build())
+        application.add_handler(TypeHandler(Update, stuck))
+        await application.initialize()
+        await application.start()
+        for update_id in (1, 2, 3):
+            application.update_queue.put_nowait(Update.de_json(recorded_update(update_id, -1001, "/lista"), application.bot))
+        await asyncio.sleep(0.1)
+        await bot_runner.drain(application, timeout=0.2)
+        # Nothing of the application runs anymore when it shuts down
+        assert not bot_runner.update_tasks(application)
+        await application.shutdown()
+
+    asyncio.run(run())
+    # One at a time only the first update started, concurrently all of them
+    assert sorted(cancelled) == ([1, 2, 3] if concurrent_updates else [1])
@@ -0,0 +1,40 @@
+"""Differential check of the compiled categorizer against the original keyword scan."""
+
+import random
+from categorizer import CATEGORY_KEYWORDS, Categorizer, DEFAULT_CATEGORY
+
+def reference_categorize(name):
+    """The original nested keyword scan."""
+    name = name.lower().strip()
+    for category, keywords in CATEGORY_KEYWORDS.items():
+        for keyword in keywords:
+            if keyword in name or name in keyword:
+                return category
+    return DEFAULT_CATEGORY
+
+def test_every_keyword_substring():
+    categorizer = Categorizer(CATEGORY_KEYWORDS, cache=None)
+    keywords = [keyword for words in CATEGORY_KEYWORDS.values() for keyword in words]
+    names = {keyword[start:end] for keyword in keywords
+             for start in range(len(keyword)) for end in range(start + 1, len(keyword) + 1)}
+    for name in sorted(names | {""}):
+        assert categorizer.categorize(name) == reference_categorize(name), name
+
+def test_random_names():
+    categorizer = Categorizer(CATEGORY_KEYWORDS, cache=None)
+    rng = random.Random(7)
+    keywords = [keyword for words in CATEGORY_KEYWORDS.values() for keyword in words]
+    alphabet = sorted(set("".join(keywords)))
+    for _ in range(20000):
+        first, second = rng.choice(keywords), rng.choice(keywords)
+        for name in (f"{first} {second}", f"{first} di {second}", first + second,
+                     f"{first[:rng.randint(1, len(first))]}{second[rng.randint(0, len(second) - 1):]}",
+                     "".join(rng.choice(alphabet) for _ in range(rng.randint(1, 16))),
+                     f"  {first.upper()} "):
+            assert categorizer.categorize(name) == reference_categorize(name), name
+
+def test_cached_results_follow_the_table():
+    categorizer = Categorizer({"Latticini": ["latte"]})
+    assert categorizer.categorize("latte intero") == "Latticini"
+    categorizer.update({"Bevande": ["latte"]})
+    assert categorizer.categorize("latte intero") == "Bevande"
@@ -0,0 +1,47 @@
+"""Item numbers and ranges typed with /rimuovi."""
+
+import pytest
+from shopping_list import parse_item_numbers
+
+@pytest.mark.parametrize("text, count, expected", [
+    ("2", 3, [2]),
+    ("1,3,5-7", 10, [1, 3, 5, 6, 7]),
+    ("2 4", 5, [2, 4]),
+    ("1;2", 3, [1, 2]),
+    (" 2 ", 3, [2]),
+    ("1 - 3", 5, [1, 2, 3]),
+    ("2-2", 3, [2]),
+    ("1-3", 3, [1, 2, 3]),
+    # Duplicates and overlapping ranges are removed once
+    ("1,1,2", 3, [1, 2]),
+    ("1-3,2-4", 5, [1, 2, 3, 4]),
+    ("3,1,2-3", 3, [1, 2, 3]),
+    ("1,,2", 3, [1, 2]),
+])
+def test_parse_item_numbers(text, count, expected):
+    assert parse_item_numbers(text, count) == expected
+
+@pytest.mark.parametrize("text, count", [
+    # Reversed ranges
+    ("7-5", 10),
+    ("3-1", 3),
+    # Numbers not in the list: the whole text is refused
+    ("0", 3),
+    ("4", 3),
+    ("1,4", 3),
+    ("2-4", 3),
+    ("1", 0),
+    # Garbage
+    ("", 3),
+    (" ", 3),
+    ("abc", 3),
+    ("1,a", 3),
+    ("-2", 3),
+    ("3-", 3),
+    ("1--3", 5),
+    ("1-2-3", 5),
+    ("1.5", 5),
+    ("primo", 5),
+])
+def test_invalid_item_numbers(text, count):
+    assert parse_item_numbers(text, count) is None
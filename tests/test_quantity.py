@@ -0,0 +1,66 @@
+"""Parsing, summing and formatting of item quantities."""
+
+import pytest
+from quantity import Quantity, parse_quantity, add_quantities, format_quantity
+
+@pytest.mark.parametrize("text, expected", [
+    ("1,5 kg", Quantity(1500, "g")),
+    ("1.5 kg", Quantity(1500, "g")),
+    ("500g", Quantity(500, "g")),
+    ("2 etti", Quantity(200, "g")),
+    ("250 mg", Quantity(0.25, "g")),
+    ("  1 L ", Quantity(1000, "ml")),
+    ("33 cl", Quantity(330, "ml")),
+    ("3", Quantity(3, "pz")),
+    ("3 pz.", Quantity(3, "pz")),
+    ("2 pezzi", Quantity(2, "pz")),
+    # Units that are not weights, volumes or pieces are kept as typed
+    ("2 bottiglie", Quantity(2, "bottiglie")),
+    ("4 Lattine", Quantity(4, "lattine")),
+])
+def test_parse_quantity(text, expected):
+    assert parse_quantity(text) == expected
+
+@pytest.mark.parametrize("text", ["", "kg", "tanto", "-1", "1,5,3", "1 1/2", "2 kg di patate", "1e3", "½"])
+def test_parse_invalid_quantity(text):
+    assert parse_quantity(text) is None
+
+@pytest.mark.parametrize("first, second, expected", [
+    ("1 kg", "500 g", "1,5 kg"),
+    ("500 g", "500 g", "1 kg"),
+    ("300 g", "2 etti", "500 g"),
+    ("1 l", "50 cl", "1,5 l"),
+    ("1", "2", "3 pz"),
+    ("2 bottiglie", "1 bottiglie", "3 bottiglie"),
+])
+def test_add_quantities(first, second, expected):
+    assert format_quantity(add_quantities(parse_quantity(first), parse_quantity(second))) == expected
+
+@pytest.mark.parametrize("first, second", [
+    # Incompatible units stay separate: the caller keeps the new quantity as typed
+    ("1 kg", "1 l"),
+    ("2 pz", "500 g"),
+    ("2 bottiglie", "1 lattine"),
+    ("1 kg", "tanto"),
+    ("tanto", "1 kg"),
+])
+def test_add_incompatible_quantities(first, second):
+    assert add_quantities(parse_quantity(first), parse_quantity(second)) is None
+
+@pytest.mark.parametrize("quantity, expected", [
+    (Quantity(1, "pz"), "1"),
+    (Quantity(3, "pz"), "3 pz"),
+    (Quantity(999, "g"), "999 g"),
+    (Quantity(1000, "g"), "1 kg"),
+    (Quantity(1250, "g"), "1,25 kg"),
+    (Quantity(0.5, "g"), "0,5 g"),
+    (Quantity(750, "ml"), "750 ml"),
+    (Quantity(2000, "ml"), "2 l"),
+    (Quantity(2.5, "bottiglie"), "2,5 bottiglie"),
+])
+def test_format_quantity(quantity, expected):
+    assert format_quantity(quantity) == expected
+
+@pytest.mark.parametrize("text", ["1,5 kg", "500 g", "2 l", "3 pz", "2 bottiglie"])
+def test_format_round_trip(text):
+    assert format_quantity(parse_quantity(text)) == text
@@ -0,0 +1,141 @@
+"""Token buckets, per-chat order, priorities, edit coalescing and RetryAfter of the send scheduler."""
+
+import asyncio
+import pytest
+from telegram.error import RetryAfter
+from send_scheduler import TokenBucket, SendScheduler, PRIORITY_NOTIFICATION
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=2, burst=3, now=0)
+    assert bucket.full(0)
+    for _ in range(3):
+        assert bucket.delay(0) == 0
+        bucket.take()
+    # Empty: the next token comes after 1 / rate seconds
+    assert bucket.delay(0) == pytest.approx(0.5)
+    assert bucket.delay(0.25) == pytest.approx(0.25)
+    assert bucket.delay(0.5) == 0
+    assert not bucket.full(0.5)
+    # Refilled up to the burst, not beyond
+    assert bucket.full(10)
+    assert bucket.tokens == 3
+
+class FakeAPI:
+    """Bot API calls through a scheduler, recording when each one is sent."""
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.sent = []
+        self.in_flight = {}
+        self.max_in_flight = 0
+        self.failures = {}
+
+    async def call(self, chat_id, text, endpoint="sendMessage", message_id=None, priority=None, delay=0.0):
+        data = {"chat_id": chat_id}
+        if message_id is not None:
+            data["message_id"] = message_id
+        return await self.scheduler.process_request(self._send, (chat_id, text, delay), {}, endpoint, data, priority)
+
+    async def _send(self, chat_id, text, delay):
+        self.in_flight[chat_id] = self.in_flight.get(chat_id, 0) + 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight[chat_id])
+        try:
+            await asyncio.sleep(delay)
+            self.sent.append((chat_id, text, asyncio.get_running_loop().time()))
+            if self.failures.get(text):
+                self.failures[text] -= 1
+                raise RetryAfter(0.3)
+            return text
+        finally:
+            self.in_flight[chat_id] -= 1
+
+def run(scheduler, test):
+    async def main():
+        try:
+            return await test(FakeAPI(scheduler))
+        finally:
+            await scheduler.shutdown()
+    return asyncio.run(main())
+
+def fast_scheduler(**kwargs):
+    """A scheduler whose limits don't slow the tests down, unless overridden."""
+    limits = dict(global_rate=1000, chat_rate=1000, group_rate=1000, chat_burst=100)
+    limits.update(kwargs)
+    return SendScheduler(**limits)
+
+def test_chat_order_and_one_request_in_flight():
+    async def test(api):
+        results = await asyncio.gather(*(api.call(chat_id, f"{chat_id}:{i}", delay=0.01)
+                                         for i in range(5) for chat_id in (1, -2)))
+        return results, api
+    results, api = run(fast_scheduler(), test)
+    assert results == [f"{chat_id}:{i}" for i in range(5) for chat_id in (1, -2)]
+    for chat_id in (1, -2):
+        assert [text for sent_chat, text, _ in api.sent if sent_chat == chat_id] == \
+            [f"{chat_id}:{i}" for i in range(5)]
+    assert api.max_in_flight == 1
+
+def test_chat_rate():
+    async def test(api):
+        await asyncio.gather(*(api.call(1, str(i)) for i in range(4)))
+        return [time for _, _, time in api.sent]
+    times = run(fast_scheduler(chat_rate=10, chat_burst=2), test)
+    # The burst goes at once, then one message every 1 / chat_rate seconds
+    assert times[1] - times[0] < 0.05
+    assert times[2] - times[0] >= 0.09
+    assert times[3] - times[2] >= 0.09
+
+def test_interactive_replies_go_before_notifications():
+    async def test(api):
+        # Takes the only global token, so the next two wait and are chosen by priority
+        await api.call(1, "first")
+        await asyncio.gather(api.call(2, "notification", endpoint="deleteMessage"),
+                             api.call(3, "background", priority=PRIORITY_NOTIFICATION),
+                             api.call(4, "reply"))
+        return [text for _, text, _ in api.sent]
+    assert run(fast_scheduler(global_rate=10), test) == ["first", "reply", "notification", "background"]
+
+def test_queued_edits_are_coalesced():
+    async def test(api):
+        # The chat is busy with a slow request, so the edits wait in its queue
+        first = asyncio.create_task(api.call(1, "message", delay=0.1))
+        await asyncio.sleep(0.02)
+        edits = await asyncio.gather(*(api.call(1, f"edit {i}", endpoint="editMessageText", message_id=7)
+                                       for i in range(3)),
+                                     api.call(1, "other", endpoint="editMessageText", message_id=8))
+        await first
+        return edits, [text for _, text, _ in api.sent], api.scheduler.coalesced
+    edits, sent, coalesced = run(fast_scheduler(), test)
+    # Every caller of the coalesced edits gets the result of the last one
+    assert edits == ["edit 2", "edit 2", "edit 2", "other"]
+    assert sent == ["message", "edit 2", "other"]
+    assert coalesced == 2
+
+def test_retry_after_pauses_the_chat():
+    async def test(api):
+        api.failures["first"] = 1
+        start = asyncio.get_running_loop().time()
+        results = await asyncio.gather(api.call(1, "first"), api.call(1, "second"), api.call(2, "other"))
+        return results, [(text, time - start) for _, text, time in api.sent], api.scheduler.retries
+    results, sent, retries = run(fast_scheduler(), test)
+    assert results == ["first", "second", "other"]
+    assert retries == 1
+    texts = [text for text, _ in sent]
+    # Sent again before the later requests of the chat, after the pause; other chats go on
+    assert texts.index("other") < texts.index("second")
+    assert [text for text in texts if text != "other"] == ["first", "first", "second"]
+    retried, second = [time for text, time in sent if text != "other"][1:]
+    assert retried >= 0.3 and second >= retried
+    assert dict(sent)["other"] < 0.3
+
+def test_retry_after_pause_outlives_the_request():
+    async def test(api):
+        api.failures["first"] = 1
+        start = asyncio.get_running_loop().time()
+        with pytest.raises(RetryAfter):
+            await api.call(1, "first")
+        # Nothing is queued for the chat, but Telegram asked to wait
+        await asyncio.sleep(0.05)
+        await api.call(1, "second")
+        return api.sent[-1][2] - start
+    assert run(fast_scheduler(max_retries=0), test) >= 0.3
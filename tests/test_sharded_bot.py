@@ -0,0 +1,114 @@
+"""Dispatching updates to the worker processes of sharded_bot.py."""
+
+import socket
+import asyncio
+import pytest
+from aiohttp import web
+import sharded_bot
+from sharded_bot import ShardDispatcher, shard_of
+from tests.bot_api import recorded_update
+
+def test_workers_need_a_shared_backend(monkeypatch):
+    monkeypatch.delenv("STORAGE_BACKEND", raising=False)
+    ShardDispatcher("1:TEST", 1)
+    for backend in ("json", "wal"):
+        monkeypatch.setenv("STORAGE_BACKEND", backend)
+        with pytest.raises(ValueError, match="STORAGE_BACKEND"):
+            ShardDispatcher("1:TEST", 2)
+    for backend in ("sharded", "sqlite"):
+        monkeypatch.setenv("STORAGE_BACKEND", backend)
+        ShardDispatcher("1:TEST", 2)
+
+def test_updates_of_a_list_go_to_one_worker(monkeypatch):
+    monkeypatch.setenv("STORAGE_BACKEND", "sharded")
+    dispatcher = ShardDispatcher("1:TEST", 4)
+    for update_id, (chat_id, user_id) in enumerate([(-1001, 11), (-1001, 12), (42, 42), (-1002, 11)], 1):
+        shard = dispatcher.dispatch(recorded_update(update_id, chat_id, "/lista", user_id=user_id))
+        list_id = f"group_{-chat_id}" if chat_id < 0 else f"user_{user_id}"
+        assert shard == shard_of(list_id, 4)
+    assert sum(dispatcher.dispatched) == 4
+
+def test_poll_confirms_the_last_updates_on_stop(monkeypatch):
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    monkeypatch.setenv("STORAGE_BACKEND", "sharded")
+    monkeypatch.setattr(sharded_bot, "TELEGRAM_API_URL", f"http://127.0.0.1:{port}/bot{{token}}/{{method}}")
+    dispatcher = ShardDispatcher("1:TEST", 2)
+    stop_event = asyncio.Event()
+    offsets = []
+
+    async def handle(request):
+        method = request.match_info["method"]
+        if method == "getUpdates":
+            parameters = await request.json()
+            offsets.append((parameters["offset"], parameters["timeout"]))
+            if len(offsets) == 1:
+                result = [recorded_update(update_id, -1001, f"/aggiungi articolo {update_id}")
+                          for update_id in (7, 8, 9)]
+            else:
+                # A long poll with nothing new, while the bot stops
+                stop_event.set()
+                if parameters["timeout"]:
+                    # Shorter than a real one, the server waits for it when it stops
+                    await asyncio.sleep(0.5)
+                result = []
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def run():
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        try:
+            await asyncio.wait_for(dispatcher.poll(stop_event), 10)
+        finally:
+            await runner.cleanup()
+
+    asyncio.run(run())
+    assert sum(dispatcher.dispatched) == 3
+    # The stop sends the offset after the last update dispatched
+    assert offsets[0] == (0, sharded_bot.POLL_TIMEOUT)
+    assert offsets[-1] == (10, 0)
+
+def test_poll_retries_delete_webhook(monkeypatch):
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    monkeypatch.setenv("STORAGE_BACKEND", "sharded")
+    monkeypatch.setattr(sharded_bot, "TELEGRAM_API_URL", f"http://127.0.0.1:{port}/bot{{token}}/{{method}}")
+    monkeypatch.setattr(sharded_bot, "RETRY_DELAY", 0.01)
+    dispatcher = ShardDispatcher("1:TEST", 2)
+    stop_event = asyncio.Event()
+    methods = []
+
+    async def handle(request):
+        method = request.match_info["method"]
+        methods.append(method)
+        if method == "deleteWebhook":
+            if methods.count(method) == 1:
+                return web.json_response({"ok": False, "description": "Too Many Requests"})
+            if methods.count(method) == 2:
+                # A proxy error page instead of the Bot API
+                return web.Response(status=502, text="<html>Bad Gateway</html>", content_type="text/html")
+            return web.json_response({"ok": True, "result": True})
+        stop_event.set()
+        return web.json_response({"ok": True, "result": []})
+
+    async def run():
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        try:
+            await asyncio.wait_for(dispatcher.poll(stop_event), 10)
+        finally:
+            await runner.cleanup()
+
+    asyncio.run(run())
+    # Polling only starts once the webhook is gone
+    assert methods == ["deleteWebhook", "deleteWebhook", "deleteWebhook", "getUpdates"]
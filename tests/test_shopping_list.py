@@ -0,0 +1,158 @@
+"""Concurrent changes to the same list, with reads and the write-behind flusher running."""
+
+import threading
+import pytest
+from shopping_list import ShoppingList
+
+GROUP = -1001
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """Run in an empty directory, where the storage creates its files."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("STORAGE_FSYNC", "0")
+    return tmp_path
+
+@pytest.mark.parametrize("backend", ["json", "wal", "sharded", "sqlite"])
+def test_concurrent_add_and_remove(workdir, monkeypatch, backend, writers=4, additions=100):
+    monkeypatch.setenv("STORAGE_BACKEND", backend)
+    # Tiny cache, so that other lists get evicted while the group list changes
+    shopping_list = ShoppingList(flush_interval=0.01, flush_max_pending=7, cache_size=2, cache_idle=0)
+    stop = threading.Event()
+    inconsistent = []
+
+    def write(writer):
+        for i in range(additions):
+            shopping_list.add_item(GROUP, f"articolo {writer} {i}")
+            # Other lists, to exercise evictions
+            shopping_list.add_item(-(2000 + writer), f"extra {i}")
+            if i % 2:
+                items = shopping_list.get_items(GROUP)
+                own = [item.id for item in items if item.name == f"articolo {writer} {i - 1}"]
+                assert len(own) == 1
+                assert [removed.name for removed in shopping_list.remove_items(GROUP, own)] == \
+                    [f"articolo {writer} {i - 1}"]
+
+    def read():
+        while not stop.is_set():
+            items = shopping_list.get_items(GROUP)
+            names = [item.name for item in items]
+            # A snapshot never changes and never holds the same item twice
+            if len(set(names)) != len(names) or names != [item.name for item in items]:
+                inconsistent.append(names)
+
+    readers = [threading.Thread(target=read) for _ in range(2)]
+    threads = [threading.Thread(target=write, args=(writer,)) for writer in range(writers)]
+    for thread in readers + threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stop.set()
+    for thread in readers:
+        thread.join()
+
+    expected = {f"articolo {writer} {i}" for writer in range(writers) for i in range(1, additions, 2)}
+    assert not inconsistent
+    assert {item.name for item in shopping_list.get_items(GROUP)} == expected
+    assert len(shopping_list.get_items(GROUP)) == len(expected)
+    shopping_list.close()
+
+    # Everything reached the storage
+    reloaded = ShoppingList(flush_interval=0)
+    assert {item.name for item in reloaded.get_items(GROUP)} == expected
+    for writer in range(writers):
+        assert len(reloaded.get_items(-(2000 + writer))) == additions
+    reloaded.close()
+
+def test_snapshot_does_not_change(workdir):
+    shopping_list = ShoppingList(flush_interval=0)
+    shopping_list.add_items(GROUP, ["pane", "latte"])
+    snapshot = shopping_list.get_items(GROUP)
+    shopping_list.add_item(GROUP, "uova")
+    shopping_list.remove_items(GROUP, [snapshot[0].id])
+    assert [item.name for item in snapshot] == ["pane", "latte"]
+    assert [item.name for item in shopping_list.get_items(GROUP)] == ["latte", "uova"]
+    shopping_list.close()
+
+def test_removing_a_duplicate_name_keeps_the_index(workdir):
+    shopping_list = ShoppingList(flush_interval=0)
+    # Duplicate names only come from old data: write the list directly
+    shopping_list.storage.save_list("group_1001", [
+        {"name": name, "quantity": "1", "category": "Altro", "id": f"id{position}"}
+        for position, name in enumerate(["a", "b", "a", "c"])
+    ])
+    assert shopping_list.remove_item(GROUP, 0).id == "id0"
+    shopping_list.add_item(GROUP, "5 a")
+    shopping_list.add_item(GROUP, "2 c")
+    items = shopping_list.get_items(GROUP)
+    assert [(item.name, item.quantity) for item in items] == [("b", "1"), ("a", "6 pz"), ("c", "3 pz")]
+    shopping_list.close()
+
+@pytest.mark.parametrize("backend", ["json", "wal", "sharded", "sqlite"])
+def test_reads_dont_wait_for_a_writer(workdir, monkeypatch, backend):
+    monkeypatch.setenv("STORAGE_BACKEND", backend)
+    # Two ShoppingLists on the same storage, as in two processes
+    shopping_list = ShoppingList(flush_interval=0)
+    other = ShoppingList(flush_interval=0)
+    shopping_list.add_item(GROUP, "pane")
+    assert [item.name for item in other.get_items(GROUP)] == ["pane"]
+    shopping_list.add_item(GROUP, "latte")
+
+    # A writer of the other process holding the storage lock, e.g. during an fsync
+    storage_lock = other.storage._lock if backend == "sqlite" else other.storage._data_lock
+    locked, release = threading.Event(), threading.Event()
+
+    def write():
+        with storage_lock:
+            locked.set()
+            release.wait(10)
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    locked.wait(10)
+    read = []
+    reader = threading.Thread(target=lambda: read.append([item.name for item in other.get_items(GROUP)]))
+    reader.start()
+    reader.join(5)
+    finished = not reader.is_alive()
+    release.set()
+    writer.join()
+    reader.join()
+    assert finished
+    # The cached version until the writer is done, then the new one
+    assert read == [["pane"]]
+    assert [item.name for item in other.get_items(GROUP)] == ["pane", "latte"]
+    shopping_list.close()
+    other.close()
+
+def test_full_list_only_changes_existing_items(workdir):
+    shopping_list = ShoppingList(flush_interval=0, max_items=2)
+    assert [result[0] for result in shopping_list.add_items(GROUP, ["pane", "latte", "uova"])] == \
+        [True, True, False]
+    # Existing items still merge their quantities, and removing one makes room
+    assert shopping_list.add_item(GROUP, "2 pane")[0]
+    shopping_list.remove_item(GROUP, 1)
+    assert shopping_list.add_item(GROUP, "uova")[0]
+    assert [(item.name, item.quantity) for item in shopping_list.get_items(GROUP)] == [("pane", "3 pz"), ("uova", "1")]
+    shopping_list.close()
+
+def test_failed_flush_is_retried(workdir, monkeypatch):
+    shopping_list = ShoppingList(background_writes=True)
+    save_delta = shopping_list.storage.save_delta
+    calls = []
+
+    def failing_save_delta(changed_lists):
+        calls.append(list(changed_lists))
+        if len(calls) == 1:
+            raise OSError("disk full")
+        return save_delta(changed_lists)
+
+    monkeypatch.setattr(shopping_list.storage, "save_delta", failing_save_delta)
+    shopping_list.add_item(GROUP, "pane")
+    # The first write raises: the list stays dirty and the flusher writes it again
+    shopping_list.persisted().result(timeout=5)
+    assert calls == [["group_1001"], ["group_1001"]]
+    shopping_list.close()
+    reloaded = ShoppingList(flush_interval=0)
+    assert reloaded.get_item_names(GROUP) == ["pane"]
+    reloaded.close()
@@ -0,0 +1,47 @@
+"""Splitting a pasted shopping list into its items."""
+
+import pytest
+from shopping_list import split_items
+
+@pytest.mark.parametrize("text, expected", [
+    ("pane, latte, 2 kg di patate, mele (6)", ["pane", "latte", "2 kg di patate", "mele (6)"]),
+    ("pane,latte", ["pane", "latte"]),
+    ("pane; latte;uova", ["pane", "latte", "uova"]),
+    # New lines, also blank ones and Windows ones
+    ("pane\nlatte\n\n2 kg di patate", ["pane", "latte", "2 kg di patate"]),
+    ("pane\r\nlatte", ["pane", "latte"]),
+    # The conjunction "e", in any case, also before a new line
+    ("pane e latte", ["pane", "latte"]),
+    ("pane E latte", ["pane", "latte"]),
+    ("sale e pepe e olio", ["sale", "pepe", "olio"]),
+    ("uova e\nlatte", ["uova", "latte"]),
+    ("pane, latte e 2 kg di patate", ["pane", "latte", "2 kg di patate"]),
+    # A comma next to a digit on one side only is a separator
+    ("2,latte", ["2", "latte"]),
+    ("latte,2 uova", ["latte", "2 uova"]),
+    # Empty items and spaces around the separators are dropped
+    ("pane,, latte,", ["pane", "latte"]),
+    ("  pane ,  latte  ", ["pane", "latte"]),
+    ("", []),
+    (" , ;\n", []),
+])
+def test_split_items(text, expected):
+    assert split_items(text) == expected
+
+@pytest.mark.parametrize("text", [
+    # Decimal commas inside quantities
+    "1,5 kg di farina",
+    "mele (1,5kg)",
+    "0,75 l di vino",
+    # Words that contain an "e" but are not the conjunction
+    "pere",
+    "caffè espresso",
+    "e",
+    "latte e",
+    "emmental",
+])
+def test_no_split(text):
+    assert split_items(text) == [text]
+
+def test_decimal_commas_among_separators():
+    assert split_items("1,5 kg di farina, 2,5 l di latte e 3 uova") == ["1,5 kg di farina", "2,5 l di latte", "3 uova"]
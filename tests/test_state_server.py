@@ -0,0 +1,187 @@
+"""Round trips through the state server, with the blocking and the asyncio clients."""
+
+import asyncio
+import socket
+import threading
+import multiprocessing
+import pytest
+import state_server
+from item import ListSnapshot
+from shopping_list import ShoppingList
+from state_server import StateServer, StateServerError, ShoppingListClient, AsyncShoppingList, AsyncShoppingListClient
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    """A state server on a thread, serving a ShoppingList in an empty directory."""
+    monkeypatch.chdir(tmp_path)
+    server = StateServer(str(tmp_path / "state.sock"), ShoppingList(background_writes=True))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+def test_round_trip(server):
+    client = ShoppingListClient(server.path)
+    assert client.add_items(-1001, ["pane", "2 kg di patate"]) == [
+        (True, "pane", "1", "Pane e Cereali"), (True, "patate", "2 kg", "Frutta e Verdura")]
+    items = client.get_items(-1001)
+    assert isinstance(items, ListSnapshot)
+    assert items.version == client.get_version(-1001)
+    assert [(item.name, item.quantity) for item in items] == [("pane", "1"), ("patate", "2 kg")]
+    assert client.get_item(-1001, items[1].id) == items[1]
+    assert [item.name for item in client.remove_items(-1001, [items[0].id])] == ["pane"]
+    assert client.get_item_names(-1001) == ["patate"]
+    assert client.get_list_type(-1001) == "Lista del gruppo"
+    assert client.persisted().result() is None
+    # The changes are in the server's ShoppingList, not a copy of the client
+    assert server.shopping_list.get_item_names(-1001) == ["patate"]
+    with pytest.raises(StateServerError):
+        client._call("storage")
+    client.close()
+
+def test_second_server_does_not_take_the_socket(server):
+    with pytest.raises(StateServerError):
+        StateServer(server.path)
+    # The running server still owns the socket
+    assert ShoppingListClient(server.path).add_item(-1001, "pane")[0]
+
+def test_stale_socket_is_replaced(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    path = str(tmp_path / "state.sock")
+    # Left behind by a server that was killed: the file exists but nobody listens
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(path)
+    stale.close()
+    server = StateServer(path)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    assert ShoppingListClient(path).add_item(-1001, "pane")[0]
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+def test_threads_use_their_own_connection(server):
+    client = ShoppingListClient(server.path)
+
+    def add(thread):
+        for i in range(50):
+            client.add_item(-1001, f"articolo {thread} {i}")
+
+    threads = [threading.Thread(target=add, args=(thread,)) for thread in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(client._connections) == 4
+    assert len(client.get_items(-1001)) == 200
+    client.close()
+
+def test_async_round_trip(server):
+    client = AsyncShoppingListClient(server.path, max_connections=4)
+
+    async def run():
+        # Many handlers at once, on a few connections
+        await asyncio.gather(*(client.add_item(-(2000 + chat), f"articolo {i}")
+                               for chat in range(20) for i in range(10)))
+        await client.persisted()
+        lists = await asyncio.gather(*(client.get_item_names(-(2000 + chat)) for chat in range(20)))
+        assert len(client._connections) <= 4
+        with pytest.raises(StateServerError):
+            await client._call("storage")
+        # A failed call doesn't lose its connection
+        assert len(client._idle) == len(client._connections)
+        client.close()
+        return lists
+
+    # Calls of different handlers may reach the server in any order: the
+    # bot keeps the changes to a list in order with its list locks
+    assert [sorted(names) for names in asyncio.run(run())] == [[f"articolo {i}" for i in range(10)]] * 20
+
+    async def names():
+        # The client works again in a new event loop
+        result = await client.get_item_names(-2000)
+        client.close()
+        return result
+
+    assert len(asyncio.run(names())) == 10
+
+def test_async_calls_do_not_block_the_loop(server):
+    client = AsyncShoppingListClient(server.path)
+    started, release = threading.Event(), threading.Event()
+    get_items = server.shopping_list.get_items
+
+    def slow_get_items(*args):
+        # The server is busy with this call until the test releases it
+        started.set()
+        release.wait(5)
+        return get_items(*args)
+
+    server.shopping_list.get_items = slow_get_items
+
+    async def run():
+        call = asyncio.create_task(client.get_items(-1001))
+        while not started.is_set():
+            await asyncio.sleep(0.01)
+        # Another handler goes on while the first one waits for the server
+        assert await client.add_item(-1002, "latte") == (True, "latte", "1", "Latticini")
+        release.set()
+        items = await call
+        client.close()
+        return items
+
+    assert list(asyncio.run(run())) == []
+
+def test_local_loads_do_not_block_the_loop(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    shopping_list = AsyncShoppingList(ShoppingList(background_writes=True))
+    started, release = threading.Event(), threading.Event()
+    load_list = shopping_list.shopping_list.storage.load_list
+
+    def slow_load_list(list_id):
+        # A cold list read from a slow disk
+        if list_id == "group_1001":
+            started.set()
+            # Only released by the loop if the load doesn't block it
+            assert release.wait(2)
+        return load_list(list_id)
+
+    shopping_list.shopping_list.storage.load_list = slow_load_list
+
+    async def run():
+        call = asyncio.create_task(shopping_list.get_items(-1001))
+        while not started.is_set():
+            await asyncio.sleep(0.01)
+        # Another handler goes on while the first one waits for the disk
+        assert await shopping_list.add_item(-1002, "latte") == (True, "latte", "1", "Latticini")
+        release.set()
+        return await call
+
+    assert list(asyncio.run(run())) == []
+    shopping_list.close()
+
+def test_async_client_reconnects_after_a_restart(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("STATE_SOCKET", str(tmp_path / "state.sock"))
+    client = AsyncShoppingListClient()
+
+    async def run():
+        for name in ("pane", "latte"):
+            # The server in its own process, stopped with SIGTERM as on a deploy
+            process = multiprocessing.get_context("fork").Process(target=state_server.main)
+            process.start()
+            await client.add_item(-1001, name)
+            process.terminate()
+            process.join()
+            await asyncio.sleep(0.05)
+            # The server closed the connection, which the client opens again
+            assert all(connection[1].at_eof() for connection in client._connections)
+        connections = len(client._connections)
+        client.close()
+        return connections
+
+    assert asyncio.run(run()) == 1
+    stored = ShoppingList()
+    assert stored.get_item_names(-1001) == ["pane", "latte"]
+    stored.close()
@@ -0,0 +1,294 @@
+"""Round trips, migrations and cross-process coordination of the storage backends."""
+
+import os
+import json
+import zlib
+import multiprocessing
+import pytest
+from storage import (Storage, WALStorage, ShardedStorage, SQLiteStorage, SNAPSHOT_HEADER, SNAPSHOT_MAGIC,
+                     SNAPSHOT_VERSION, SNAPSHOT_FLAG_ZLIB)
+from shopping_list import ShoppingList
+
+BACKENDS = ["json", "binary", "binary_zlib", "wal", "sharded", "sqlite"]
+
+def make_storage(backend, directory):
+    """A storage of the given backend in directory, opened again on every call."""
+    directory = str(directory)
+    if backend == "json":
+        return Storage(os.path.join(directory, "liste.json"), fsync=False)
+    if backend in ("binary", "binary_zlib"):
+        return Storage(os.path.join(directory, "liste.snap"), fsync=False, snapshot_format="binary",
+                       compress=backend == "binary_zlib", schema_version=ShoppingList.SCHEMA_VERSION)
+    if backend == "wal":
+        return WALStorage(os.path.join(directory, "liste.json"), compact_every=1000)
+    if backend == "sharded":
+        return ShardedStorage(os.path.join(directory, "liste"), fsync=False)
+    return SQLiteStorage(os.path.join(directory, "liste.db"))
+
+def item(name, quantity="1", category="Altro", item_id=None):
+    return {"name": name, "quantity": quantity, "category": category, "id": item_id or name[:4]}
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_round_trip(tmp_path, backend):
+    storage = make_storage(backend, tmp_path)
+    assert storage.load() is None
+    assert storage.save_delta({
+        "group_1001": [item("pane"), item("patate", "2 kg", "Frutta e Verdura")],
+        "user_5": [item("latte", category="Latticini")],
+        "group_1002": [item("olio")],
+    })
+    # Single-item changes, as ShoppingList writes them without write-behind
+    assert storage.save_list("group_1001", [item("pane"), item("patate", "2 kg", "Frutta e Verdura"),
+                                            item("mele")], ("append", 2))
+    assert storage.save_list("group_1001", [item("pane", "3 pz"), item("patate", "2 kg", "Frutta e Verdura"),
+                                            item("mele")], ("update", 0))
+    assert storage.save_list("user_5", [], ("delete", 0))
+    assert storage.save_delta({"group_1002": None})
+    storage.close()
+
+    expected = {
+        "group_1001": [item("pane", "3 pz"), item("patate", "2 kg", "Frutta e Verdura"), item("mele")],
+        "user_5": [],
+    }
+    reopened = make_storage(backend, tmp_path)
+    assert sorted(reopened.list_ids()) == sorted(expected)
+    assert reopened.load_list("group_1001") == expected["group_1001"]
+    assert reopened.load_list("group_1002") is None
+    assert reopened.load() == expected
+    reopened.close()
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_full_save_replaces_everything(tmp_path, backend):
+    storage = make_storage(backend, tmp_path)
+    storage.save_delta({"group_1001": [item("pane")], "group_1002": [item("olio")]})
+    assert storage.save({"group_1002": [item("sale")], "group_1003": []})
+    storage.close()
+    reopened = make_storage(backend, tmp_path)
+    assert reopened.load() == {"group_1002": [item("sale")], "group_1003": []}
+    reopened.close()
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_refresh_reports_other_processes(tmp_path, backend):
+    storage = make_storage(backend, tmp_path)
+    storage.save_delta({"group_1001": [item("pane")], "group_1002": [item("olio")]})
+    # Another process, started afterwards
+    other = make_storage(backend, tmp_path)
+    other.load_list("group_1001")
+    assert other.refresh() == []
+    storage.save_delta({"group_1002": [item("sale")]})
+    assert other.refresh() == ["group_1002"]
+    assert other.load_list("group_1002") == [item("sale")]
+    assert other.refresh() == []
+    storage.close()
+    other.close()
+
+def test_wal_replay_after_a_crash(tmp_path):
+    storage = make_storage("wal", tmp_path)
+    storage.save_delta({"group_1001": [item("pane")]})
+    storage.save_list("group_1001", [item("pane"), item("latte")])
+    storage.save_delta({"group_1002": [item("olio")], "user_5": [item("sale")]})
+    storage.save_delta({"user_5": None})
+    # Crash: no close, no compaction, and half of a record written
+    with open(storage.log_filename, "ab") as f:
+        f.write(b'{"id":"group_1001","items":[{"name":"mel')
+    assert not os.path.exists(storage.filename)
+
+    recovered = make_storage("wal", tmp_path)
+    assert recovered.load() == {"group_1001": [item("pane"), item("latte")], "group_1002": [item("olio")]}
+    # The partial record is gone, so new records are readable after the others
+    recovered.save_list("group_1002", [item("olio"), item("aceto")])
+    recovered.close()
+    reopened = make_storage("wal", tmp_path)
+    assert reopened.load_list("group_1002") == [item("olio"), item("aceto")]
+    reopened.close()
+
+def test_wal_compaction(tmp_path):
+    storage = WALStorage(str(tmp_path / "liste.json"), compact_every=3)
+    for i in range(7):
+        storage.save_delta({f"group_{i}": [item(f"articolo {i}")]})
+    # Compacted after the 3rd and 6th record: one record left in the log
+    with open(storage.log_filename, "rb") as f:
+        assert len(f.read().splitlines()) == 1
+    with open(storage.filename, encoding="utf-8") as f:
+        assert len(json.load(f)) == 6
+    storage.close()
+    reopened = WALStorage(str(tmp_path / "liste.json"))
+    assert reopened.load() == {f"group_{i}": [item(f"articolo {i}")] for i in range(7)}
+    reopened.close()
+
+def _shards(storage):
+    return {entry for entry in os.listdir(storage.directory)
+            if entry.endswith(".json") and entry != ShardedStorage.MANIFEST}
+
+def _manifest(storage):
+    with open(os.path.join(storage.directory, ShardedStorage.MANIFEST), encoding="utf-8") as f:
+        return json.load(f)["lists"]
+
+def test_sharded_manifest_consistency(tmp_path):
+    storage = make_storage("sharded", tmp_path)
+    storage.save_delta({"group_1001": [item("pane")], "user_5": [], "gruppo/strano": [item("olio")]})
+    storage.save_list("group_1002", [item("sale")])
+    storage.save_delta({"user_5": None, "group_1003": [item("uova")]})
+    expected = ["group_1001", "group_1002", "group_1003", "gruppo/strano"]
+    assert _manifest(storage) == expected
+    # Every list in the manifest has its shard and no shard is left over
+    assert _shards(storage) == {os.path.basename(storage._shard_path(list_id)) for list_id in expected}
+    assert storage.load_list("gruppo/strano") == [item("olio")]
+
+    # A corrupted manifest is rebuilt from the shards
+    with open(os.path.join(storage.directory, ShardedStorage.MANIFEST), "w") as f:
+        f.write("{")
+    reopened = make_storage("sharded", tmp_path)
+    assert sorted(reopened.list_ids()) == expected
+    assert _manifest(reopened) == expected
+
+def test_sharded_import(tmp_path):
+    legacy = tmp_path / "liste.json"
+    Storage(str(legacy), fsync=False).save({"group_1001": [item("pane")]})
+    storage = ShardedStorage(str(tmp_path / "liste"), legacy_filename=str(legacy), fsync=False)
+    assert storage.list_ids() == ["group_1001"]
+    assert storage.load_list("group_1001") == [item("pane")]
+
+def test_sqlite_import(tmp_path):
+    legacy = tmp_path / "liste.json"
+    data = {
+        "group_1001": [item("pane"), {"name": "latte", "quantity": 2}, "uova", {"name": {"name": "olio"}}, 42,
+                       {"nome": "sale"}],
+        "user_5": [],
+    }
+    Storage(str(legacy), fsync=False).save(data)
+    storage = SQLiteStorage(str(tmp_path / "liste.db"), legacy_filename=str(legacy))
+    # Items of older schema versions are kept for the migrations, entries that are not
+    # items have no row, and quantities are stored as text
+    assert storage.load() == {"group_1001": [item("pane"), {"name": "latte", "quantity": "2"},
+                                             {"name": "uova", "quantity": "1"}, {"name": "olio", "quantity": "1"}],
+                              "user_5": []}
+    storage.save_list("user_5", [item("sale")], ("append", 0))
+    storage.close()
+
+    # Only an empty database is imported
+    Storage(str(legacy), fsync=False).save({"group_9": []})
+    reopened = SQLiteStorage(str(tmp_path / "liste.db"), legacy_filename=str(legacy))
+    assert sorted(reopened.list_ids()) == ["group_1001", "user_5"]
+    assert reopened.load_list("user_5") == [item("sale")]
+    reopened.close()
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_binary_header(tmp_path, compress):
+    storage = make_storage("binary_zlib" if compress else "binary", tmp_path)
+    storage.set_meta("schema_version", 3)
+    data = {"group_1001": [item("pane"), item("latte")]}
+    assert storage.save(data)
+    with open(storage.filename, "rb") as f:
+        raw = f.read()
+    magic, version, flags, schema_version, _, length, checksum = SNAPSHOT_HEADER.unpack_from(raw)
+    payload = raw[SNAPSHOT_HEADER.size:]
+    assert (magic, version, schema_version) == (SNAPSHOT_MAGIC, SNAPSHOT_VERSION, 3)
+    assert bool(flags & SNAPSHOT_FLAG_ZLIB) == compress
+    assert (length, checksum) == (len(payload), zlib.crc32(payload))
+    assert make_storage("binary", tmp_path).load() == data
+
+def _rewrite_header(filename, **fields):
+    with open(filename, "rb") as f:
+        raw = f.read()
+    names = ["magic", "version", "flags", "schema_version", "marshal_version", "length", "checksum"]
+    header = dict(zip(names, SNAPSHOT_HEADER.unpack_from(raw)))
+    header.update(fields)
+    with open(filename, "wb") as f:
+        f.write(SNAPSHOT_HEADER.pack(*(header[name] for name in names)) + raw[SNAPSHOT_HEADER.size:])
+
+@pytest.mark.parametrize("corrupt", [
+    lambda filename: _rewrite_header(filename, checksum=0),
+    lambda filename: _rewrite_header(filename, length=1),
+    lambda filename: _rewrite_header(filename, version=SNAPSHOT_VERSION + 1),
+    lambda filename: _rewrite_header(filename, schema_version=ShoppingList.SCHEMA_VERSION + 1),
+    lambda filename: os.truncate(filename, SNAPSHOT_HEADER.size - 1),
+    lambda filename: os.truncate(filename, os.path.getsize(filename) - 1),
+], ids=["checksum", "length", "format_version", "schema_version", "truncated_header", "truncated_payload"])
+def test_binary_header_validation(tmp_path, corrupt):
+    storage = make_storage("binary", tmp_path)
+    storage.save({"group_1001": [item("pane")]})
+    corrupt(storage.filename)
+    # Refused rather than loaded wrong: the lists are left untouched on disk
+    assert make_storage("binary", tmp_path).load() is None
+
+def test_binary_imports_json(tmp_path):
+    Storage(str(tmp_path / "liste.json"), fsync=False).save({"group_1001": [item("pane")]})
+    storage = Storage(str(tmp_path / "liste.snap"), fsync=False, snapshot_format="binary",
+                      legacy_filename=str(tmp_path / "liste.json"))
+    assert storage.load_list("group_1001") == [item("pane")]
+    storage.save_delta({"group_1002": []})
+    with open(storage.filename, "rb") as f:
+        assert f.read(len(SNAPSHOT_MAGIC)) == SNAPSHOT_MAGIC
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """Run in an empty directory, where ShoppingList creates its storage."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("STORAGE_FSYNC", "0")
+    return tmp_path
+
+@pytest.mark.parametrize("backend", ["json", "wal", "sharded", "sqlite"])
+def test_migrations_from_the_first_format(workdir, monkeypatch, backend):
+    monkeypatch.setenv("STORAGE_BACKEND", backend)
+    # The JSON file of the first versions, without a schema version: the
+    # sharded and sqlite backends import it on their first start
+    Storage("shopping_lists.json", fsync=False).save({
+        # Items were plain strings
+        "group_1001": ["pane", "latte"],
+        "group_1002": [
+            {"name": {"name": {"name": "olio"}}, "quantity": "1 l"},
+            {"name": "sale", "quantity": "1"},
+            {"name": "pepe", "quantity": "1", "category": "Condimenti", "id": "aaaa"},
+            {"name": "aceto", "quantity": "1", "category": "Condimenti", "id": "aaaa"},
+            42,
+        ],
+    })
+
+    shopping_list = ShoppingList(flush_interval=0)
+    assert shopping_list.storage.get_meta("schema_version") == ShoppingList.SCHEMA_VERSION
+    assert [(item.name, item.quantity) for item in shopping_list.get_items(-1001)] == [("pane", "1"), ("latte", "1")]
+    items = shopping_list.get_items(-1002)
+    assert [item.name for item in items] == ["olio", "sale", "pepe", "aceto"]
+    assert all(item.category for item in items)
+    ids = [item.id for item in items]
+    assert len(set(ids)) == len(ids) and "aaaa" in ids
+    migrated = shopping_list.storage.load()
+    shopping_list.close()
+
+    # Stored migrated: the next start changes nothing
+    shopping_list = ShoppingList(flush_interval=0)
+    assert shopping_list.storage.load() == migrated
+    shopping_list.close()
+
+def test_migrations_from_version_1(workdir):
+    shopping_list = ShoppingList(flush_interval=0)
+    shopping_list.storage.save_delta({"group_1001": [{"name": "pane", "quantity": "1"}, "stringa"]})
+    shopping_list.storage.set_meta("schema_version", 1)
+    shopping_list.close()
+    # Only the repair and the IDs run: a string is not converted any more, it's dropped
+    migrated = ShoppingList(flush_interval=0)
+    items = migrated.get_items(-1001)
+    assert [(item.name, item.category) for item in items] == [("pane", "Pane e Cereali")]
+    assert items[0].id
+    migrated.close()
+
+def _rebuild_manifest(directory, rounds):
+    """Open the sharded storage again and again while its manifest keeps disappearing."""
+    for _ in range(rounds):
+        ShardedStorage(directory, fsync=False).list_ids()
+        try:
+            os.remove(os.path.join(directory, ShardedStorage.MANIFEST))
+        except FileNotFoundError:
+            pass
+
+def test_processes_rebuild_the_manifest_together(tmp_path):
+    directory = str(tmp_path / "shards")
+    os.makedirs(directory)
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=_rebuild_manifest, args=(directory, 200)) for _ in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert [process.exitcode for process in processes] == [0] * 4
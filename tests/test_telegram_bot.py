@@ -0,0 +1,99 @@
+"""Handlers of telegram_bot.py, run against a local fake of the Bot API."""
+
+import os
+import asyncio
+import importlib
+import pytest
+from telegram import Update
+from telegram.request import BaseRequest
+from tests.bot_api import fake_bot_api, recorded_update
+
+class SlowBotAPI(BaseRequest):
+    """The fake Bot API, answering after a short delay like the real one."""
+
+    def __init__(self, latency=0.01):
+        self.inner = fake_bot_api()
+        self.latency = latency
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        return await self.inner.do_request(url=url, method=method, request_data=request_data, **kwargs)
+
+@pytest.fixture(scope="module")
+def telegram_bot(tmp_path_factory):
+    """telegram_bot, imported in an empty directory, where its shopping list creates its files."""
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("bot"))
+    saved = os.environ.get("BOT_SEND_RATE")
+    os.environ["BOT_SEND_RATE"] = "0"
+    try:
+        module = importlib.import_module("telegram_bot")
+        yield module
+        module.shopping_list.close()
+    finally:
+        os.chdir(cwd)
+        if saved is None:
+            os.environ.pop("BOT_SEND_RATE", None)
+        else:
+            os.environ["BOT_SEND_RATE"] = saved
+
+async def _run_conversations(telegram_bot, first_chat, chats):
+    """Every chat sends /aggiungi, an item, /aggiungi and another item, all at once."""
+    application = telegram_bot.build_application("1:TEST", request=SlowBotAPI())
+    await application.initialize()
+    await application.start()
+    update_id = 0
+    for chat in range(chats):
+        for text in ("/aggiungi", "uova", "/aggiungi", "latte"):
+            update_id += 1
+            update = Update.de_json(recorded_update(update_id, first_chat - chat, text, user_id=10 + chat), application.bot)
+            application.update_queue.put_nowait(update)
+    await application.stop()
+    await application.shutdown()
+    return [await telegram_bot.shopping_list.get_item_names(first_chat - chat) for chat in range(chats)]
+
+def test_conversations_keep_their_order(telegram_bot):
+    lists = asyncio.run(_run_conversations(telegram_bot, -1000, 50))
+    assert lists == [["uova", "latte"]] * 50
+
+class BlockedBotAPI(SlowBotAPI):
+    """The fake Bot API, holding every sent message until released."""
+
+    def __init__(self):
+        super().__init__(latency=0)
+        self.released = asyncio.Event()
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        if url.endswith("/sendMessage"):
+            await self.released.wait()
+        return await super().do_request(url=url, method=method, request_data=request_data, **kwargs)
+
+def test_replies_are_sent_outside_the_list_lock(telegram_bot):
+    async def run():
+        request = BlockedBotAPI()
+        application = telegram_bot.build_application("1:TEST", request=request)
+        await application.initialize()
+        await application.start()
+        # Two members of the group add an item each: the second change must
+        # not wait for the reply to the first
+        for update_id, (user_id, text) in enumerate([(11, "/aggiungi pane"), (12, "/aggiungi latte")], 1):
+            update = Update.de_json(recorded_update(update_id, -3000, text, user_id=user_id), application.bot)
+            application.update_queue.put_nowait(update)
+        try:
+            for _ in range(200):
+                if len(await telegram_bot.shopping_list.get_items(-3000)) == 2:
+                    break
+                await asyncio.sleep(0.01)
+            return await telegram_bot.shopping_list.get_item_names(-3000)
+        finally:
+            request.released.set()
+            await application.stop()
+            await application.shutdown()
+
+    assert sorted(asyncio.run(run())) == ["latte", "pane"]
@@ -0,0 +1,103 @@
+"""Webhook configuration and server lifecycle."""
+
+import json
+import socket
+import asyncio
+import pytest
+from telegram.error import BadRequest
+from telegram.ext import ApplicationBuilder
+from telegram.request import BaseRequest
+from webhook import WebhookConfig, webhook_config, serve_webhook
+from tests.bot_api import fake_bot_api
+
+@pytest.fixture
+def environ(monkeypatch):
+    """A clean environment for the webhook settings."""
+    for name in ("WEBHOOK_URL", "BOT_MODE", "WEBHOOK_SECRET", "WEBHOOK_PATH", "WEBHOOK_LISTEN", "WEBHOOK_PORT"):
+        monkeypatch.delenv(name, raising=False)
+    return monkeypatch
+
+def test_polling_by_default(environ):
+    assert webhook_config() is None
+    environ.setenv("WEBHOOK_URL", "https://example.org/telegram")
+    environ.setenv("BOT_MODE", "polling")
+    assert webhook_config() is None
+
+@pytest.mark.parametrize("url", ["https://example.org/hook", None])
+def test_webhook_requires_a_secret(environ, url):
+    environ.setenv("BOT_MODE", "webhook")
+    if url:
+        environ.setenv("WEBHOOK_URL", url)
+    with pytest.raises(ValueError, match="WEBHOOK_SECRET"):
+        webhook_config()
+    environ.setenv("WEBHOOK_SECRET", "non valido!")
+    with pytest.raises(ValueError, match="WEBHOOK_SECRET"):
+        webhook_config()
+    environ.setenv("WEBHOOK_SECRET", "segreto_condiviso-1")
+    config = webhook_config()
+    assert config.secret_token == "segreto_condiviso-1"
+    assert config.url == url
+    assert config.path == ("/hook" if url else "/telegram")
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+class RefusingBotAPI(BaseRequest):
+    """The fake Bot API, refusing setWebhook."""
+
+    def __init__(self):
+        self.inner = fake_bot_api()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        if url.endswith("/setWebhook"):
+            return 400, json.dumps({"ok": False, "error_code": 400, "description": "Bad Request: bad webhook"}).encode()
+        return await self.inner.do_request(url=url, method=method, request_data=request_data, **kwargs)
+
+def _application():
+    return ApplicationBuilder().token("1:TEST").request(RefusingBotAPI()).updater(None).build()
+
+def test_failed_start_keeps_its_exception():
+    application = _application()
+    stop = application.stop
+    stopped = []
+
+    async def failing_stop():
+        await stop()
+        stopped.append(True)
+        raise RuntimeError("stop failed")
+
+    application.stop = failing_stop
+    port = _free_port()
+    config = WebhookConfig(url=None, listen="127.0.0.1", port=port, path="/telegram", secret_token="segreto")
+
+    async def run():
+        with socket.socket() as busy:
+            busy.bind(("127.0.0.1", port))
+            busy.listen()
+            await serve_webhook(application, config, stop_event=asyncio.Event())
+
+    # The port in use, not the error of the cleanup
+    with pytest.raises(OSError):
+        asyncio.run(run())
+    assert stopped
+    assert not application._initialized
+
+def test_failed_registration_stops_listening():
+    application = _application()
+    port = _free_port()
+    config = WebhookConfig(url="https://example.org/telegram", listen="127.0.0.1", port=port,
+                           path="/telegram", secret_token="segreto")
+    with pytest.raises(BadRequest):
+        asyncio.run(serve_webhook(application, config, stop_event=asyncio.Event()))
+    assert not application.running
+    # The server doesn't listen anymore
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", port))
@@ -0,0 +1,238 @@
+"""
+Webhook mode for the Telegram bot.
+
+With polling the bot keeps a long-poll getUpdates request open to Telegram
+all the time, and an update waits for the next poll round trip. In webhook
+mode Telegram POSTs every update to an embedded aiohttp server as soon as
+it happens. Each request is checked against the secret token Telegram was
+given with setWebhook, then the update is put on the application's update
+queue, the same queue the polling updater feeds.
+
+Telegram only calls HTTPS URLs: the server listens on plain HTTP behind the
+TLS-terminating proxy of the host (e.g. Railway), which forwards to it.
+"""
+
+import os
+import re
+import sys
+import hmac
+import signal
+import asyncio
+import logging
+from typing import NamedTuple
+from urllib.parse import urlsplit
+from aiohttp import web
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+# Header in which Telegram sends the secret token of setWebhook
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+# Secret tokens accepted by Telegram
+SECRET_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,256}")
+
+class WebhookConfig(NamedTuple):
+    """Where the webhook server listens and how Telegram reaches it."""
+
+    # Public HTTPS URL registered with Telegram, None to leave the registration alone
+    url: str
+    listen: str
+    port: int
+    path: str
+    secret_token: str
+    max_connections: int = 40
+
+def webhook_config():
+    """
+    Read the webhook settings from the environment.
+
+    Webhook mode is used when BOT_MODE is "webhook", or when WEBHOOK_URL is
+    set and BOT_MODE isn't "polling". It needs WEBHOOK_SECRET: a secret made
+    up at startup would differ in every process registering the webhook, and
+    without a URL to register Telegram would never learn it.
+
+    Returns:
+        A WebhookConfig, or None to use polling
+
+    Raises:
+        ValueError: In webhook mode, if WEBHOOK_SECRET is missing or invalid
+    """
+    url = os.environ.get("WEBHOOK_URL") or None
+    mode = os.environ.get("BOT_MODE", "webhook" if url else "polling").lower()
+    if mode != "webhook":
+        return None
+    path = os.environ.get("WEBHOOK_PATH") or (urlsplit(url).path if url else "") or "/telegram"
+    secret_token = os.environ.get("WEBHOOK_SECRET")
+    if not secret_token:
+        raise ValueError("WEBHOOK_SECRET must be set in webhook mode")
+    if not SECRET_PATTERN.fullmatch(secret_token):
+        raise ValueError("WEBHOOK_SECRET must be 1-256 characters among A-Z, a-z, 0-9, _ and -")
+    return WebhookConfig(
+        url=url,
+        listen=os.environ.get("WEBHOOK_LISTEN", "0.0.0.0"),
+        port=int(os.environ.get("WEBHOOK_PORT", "8443")),
+        path=path if path.startswith("/") else f"/{path}",
+        secret_token=secret_token,
+        max_connections=int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", "40")),
+    )
+
+class WebhookServer:
+    """Receive updates over HTTP and feed them to a telegram.ext.Application."""
+
+    def __init__(self, application, config):
+        """
+        Initialize the server. Nothing listens until start().
+
+        Args:
+            application: The Application the updates are for. Subclasses that
+                override deliver() only need its bot, to register the webhook
+            config: A WebhookConfig
+        """
+        self.application = application
+        self.config = config
+        self._secret = config.secret_token.encode()
+        self._runner = None
+
+        # Counters of the requests received
+        self.received = 0
+        self.rejected = 0
+
+        self.app = web.Application()
+        self.app.router.add_post(config.path, self._handle_update)
+
+    async def _handle_update(self, request):
+        # Anyone who knows the URL could post fake updates
+        secret = request.headers.get(SECRET_HEADER, "").encode()
+        if not hmac.compare_digest(secret, self._secret):
+            self.rejected += 1
+            logger.warning(f"Webhook request from {request.remote} with a wrong secret token")
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+            if not isinstance(data, dict) or "update_id" not in data:
+                raise ValueError("not an update")
+            # Answer right away: Telegram waits for the response before sending
+            # the next update of the same chat
+            await self.deliver(data)
+        except (ValueError, TypeError, KeyError) as e:
+            # ValueError includes malformed JSON
+            self.rejected += 1
+            logger.error(f"Invalid update received on the webhook: {e}")
+            return web.Response(status=400)
+        self.received += 1
+        return web.Response()
+
+    async def deliver(self, data):
+        """
+        Hand an update over to the application.
+
+        Args:
+            data: The update as received, a dict
+        """
+        await self.application.update_queue.put(Update.de_json(data, self.application.bot))
+
+    async def start(self, allowed_updates=None, drop_pending_updates=False):
+        """
+        Start listening and, with a public URL, register the webhook with Telegram.
+
+        Args:
+            allowed_updates: The update types to receive, None for Telegram's default
+            drop_pending_updates: Discard the updates Telegram kept while the bot was down
+        """
+        self._runner = web.AppRunner(self.app, access_log=None)
+        try:
+            await self._runner.setup()
+            site = web.TCPSite(self._runner, self.config.listen, self.config.port)
+            await site.start()
+            logger.info(f"Webhook listening on {self.config.listen}:{self.config.port}{self.config.path}")
+            if self.config.url:
+                await self.application.bot.set_webhook(
+                    url=self.config.url,
+                    secret_token=self.config.secret_token,
+                    allowed_updates=allowed_updates,
+                    max_connections=self.config.max_connections,
+                    drop_pending_updates=drop_pending_updates,
+                )
+                logger.info(f"Webhook registered at {self.config.url}")
+        except BaseException:
+            # Not started: the caller won't stop it
+            await _cleanup(self.stop)
+            raise
+
+    async def stop(self):
+        """
+        Stop listening. The webhook stays registered, so Telegram keeps the
+        updates until the bot is back.
+        """
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+            logger.info("Webhook server stopped")
+
+    def stats(self):
+        """
+        Get statistics about the webhook requests.
+
+        Returns:
+            A dict with the updates received and the requests rejected
+        """
+        return {"received": self.received, "rejected": self.rejected}
+
+async def _cleanup(step):
+    """
+    Run a cleanup step. While another exception is being raised, an error of
+    the step is only logged, so that it doesn't replace the original one.
+
+    Args:
+        step: The coroutine function to run, e.g. application.stop
+    """
+    if sys.exc_info()[1] is None:
+        await step()
+        return
+    try:
+        await step()
+    except Exception as e:
+        logger.error(f"Error in {step.__qualname__} while stopping after an error: {e}")
+
+async def serve_webhook(application, config, allowed_updates=None, stop_event=None):
+    """
+    Run an application in webhook mode until it's stopped.
+
+    Args:
+        application: The Application to run
+        config: A WebhookConfig
+        allowed_updates: The update types to receive
+        stop_event: An asyncio.Event that stops the bot, by default one set by SIGINT and SIGTERM
+    """
+    if stop_event is None:
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop_event.set)
+    server = WebhookServer(application, config)
+    await application.initialize()
+    # Each step is undone only if it completed
+    try:
+        await application.start()
+        try:
+            await server.start(allowed_updates)
+            try:
+                await stop_event.wait()
+            finally:
+                # Stop receiving first, then let the application finish the queued updates
+                await _cleanup(server.stop)
+        finally:
+            await _cleanup(application.stop)
+    finally:
+        await _cleanup(application.shutdown)
+
+def run_webhook(application, config, allowed_updates=None):
+    """
+    Run an application in webhook mode, blocking like Application.run_polling().
+
+    Args:
+        application: The Application to run
+        config: A WebhookConfig
+        allowed_updates: The update types to receive
+    """
+    asyncio.run(serve_webhook(application, config, allowed_updates))
@@ -0,0 +1,150 @@
+"""
+Write-behind flushing for the shopping lists.
+
+Mutations only mark the state as dirty; a background thread writes the
+changes at most once per interval, or as soon as enough mutations are
+pending. The interval is the durability window: after a crash at most the
+changes of the last interval are lost, while a clean stop always flushes.
+With an interval of 0 the thread writes as soon as possible, which keeps
+serialization and file I/O out of the caller's thread.
+"""
+
+import time
+import heapq
+import logging
+import threading
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+class WriteBehind:
+    """Batch many mutations into a single flush performed by a background thread."""
+
+    def __init__(self, flush, interval=1.0, max_pending=100):
+        """
+        Initialize and start the background flusher.
+
+        Args:
+            flush: Callable that writes the pending changes
+            interval: Maximum number of seconds a change can stay unwritten
+            max_pending: Number of pending mutations that triggers an immediate flush
+        """
+        self._flush = flush
+        self.interval = interval
+        self.max_pending = max_pending
+        self._condition = threading.Condition()
+        # Serializes flushes from the background thread and from flush()
+        self._flush_lock = threading.Lock()
+        self._pending = 0
+        self._dirty_since = None
+        self._closed = False
+        # Sequence number of the last written mutation, and futures waiting for one
+        self._written = 0
+        self._waiters = []
+
+        # Counters to see how many writes were saved
+        self.mutations = 0
+        self.flushes = 0
+
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+
+    def mark_dirty(self):
+        """
+        Record a mutation that has to be written.
+
+        Returns:
+            The sequence number of the mutation
+        """
+        with self._condition:
+            self._pending += 1
+            self.mutations += 1
+            if self._dirty_since is None:
+                self._dirty_since = time.monotonic()
+                self._condition.notify()
+            elif self._pending >= self.max_pending:
+                self._condition.notify()
+            return self.mutations
+
+    def written(self, sequence=None):
+        """
+        Get a future that completes once a mutation has been written.
+
+        Futures complete in mutation order, since every flush writes all the
+        mutations recorded before it started.
+
+        Args:
+            sequence: The sequence number returned by mark_dirty(), by default
+                the last recorded mutation
+
+        Returns:
+            A concurrent.futures.Future
+        """
+        future = Future()
+        with self._condition:
+            if sequence is None:
+                sequence = self.mutations
+            if sequence <= self._written:
+                future.set_result(sequence)
+            else:
+                heapq.heappush(self._waiters, (sequence, id(future), future))
+        return future
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._closed and not self._pending:
+                    self._condition.wait()
+                if self._closed:
+                    return
+                # Wait for the end of the interval unless enough mutations piled up
+                while not self._closed and self._pending < self.max_pending:
+                    remaining = self._dirty_since + self.interval - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                if self._closed:
+                    return
+            if self.flush() is False:
+                # Don't retry a failing write in a tight loop
+                with self._condition:
+                    if not self._closed:
+                        self._condition.wait(max(self.interval, 1.0))
+
+    def flush(self):
+        """
+        Write the pending changes now, if there are any.
+
+        Returns:
+            False if the write failed, True otherwise
+        """
+        with self._flush_lock:
+            with self._condition:
+                if not self._pending:
+                    return True
+                self._pending = 0
+                self._dirty_since = None
+                sequence = self.mutations
+            try:
+                if self._flush() is False:
+                    return False
+                self.flushes += 1
+            except Exception as e:
+                logger.error(f"Error flushing pending changes: {e}")
+                return False
+            completed = []
+            with self._condition:
+                self._written = sequence
+                while self._waiters and self._waiters[0][0] <= sequence:
+                    completed.append(heapq.heappop(self._waiters)[2])
+            for future in completed:
+                future.set_result(sequence)
+            return True
+
+    def close(self):
+        """Stop the background thread and write the pending changes."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+        self.flush()